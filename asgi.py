@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+# DEPENDENCIES =========================================
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import asyncio
+import hmac
+import json
+import logging
+import uuid
+
+import aiomysql
+from asgiref.wsgi import WsgiToAsgi
+
+import modules.confirmations
+import modules.db
+import modules.idempotency
+import modules.jobs
+import modules.logs
+import modules.papertips
+import modules.registry
+import webhooks
+
+# CONFIG CONSTANTS =====================================
+config = modules.registry.config
+
+# Jobs run at once by this process for each lane worker worker.py would have started.  Set asgi_process_jobs to off to
+# only take in webhooks here and leave the jobs to worker.py.
+ASGI_PROCESS_JOBS = config.getboolean('webhooks', 'asgi_process_jobs', fallback=True)
+ASGI_JOBS_PER_WORKER = config.getint('webhooks', 'asgi_jobs_per_worker', fallback=8)
+DB_POOL_SIZE = config.getint('webhooks', 'asgi_db_pool_size', fallback=20)
+# Seconds between the sweeps worker.py would have made
+SWEEP_INTERVAL = 60
+
+# Set Log File
+modules.logs.setup('webhooks.log')
+
+# Every route apart from the webhooks is served by the Flask app
+flask_app = WsgiToAsgi(webhooks.app)
+
+db_pool = None
+consumer_tasks = []
+lane_executors = {}
+
+
+async def read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        request_message = await receive()
+        body += request_message.get('body', b'')
+        more_body = request_message.get('more_body', False)
+
+    return body
+
+
+async def respond(send, status, body=b''):
+    await send({
+        'type': 'http.response.start',
+        'status': int(status),
+        'headers': [(b'content-type', b'text/html; charset=utf-8')]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def enqueue_batch(jobs):
+    """
+    Queue a batch of jobs, the same as modules.jobs.enqueue_batch, over the shared async DB pool
+    """
+    async with db_pool.acquire() as db:
+        async with db.cursor() as db_cursor:
+            await db.begin()
+            try:
+                jobs, delivery_keys = await new_jobs(db_cursor, jobs)
+                job_rows = []
+                if jobs:
+                    await db_cursor.execute(modules.jobs.ADMISSION_CALL)
+                    job_rows = modules.jobs.admit_batch(jobs, await db_cursor.fetchall(),
+                                                        modules.jobs.JOB_MAX_ATTEMPTS)
+                if job_rows:
+                    await db_cursor.executemany(modules.jobs.ENQUEUE_CALL, job_rows)
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+    modules.idempotency.remember(delivery_keys)
+
+    return len(job_rows)
+
+
+async def new_jobs(db_cursor, jobs):
+    """
+    modules.idempotency.new_jobs on an async cursor.  The filter was loaded at startup, and if that failed it isn't
+    loaded here, as the load blocks the loop.
+    """
+    keys = [modules.idempotency.delivery_key(job_type, payload) for job_type, payload in jobs]
+    seen = set()
+    possible = modules.idempotency.possible_duplicates(keys, warm=False)
+    if possible:
+        await db_cursor.execute(modules.idempotency.SEEN_CALL.format(', '.join(['%s'] * len(possible))), possible)
+        seen = set(row[0] for row in await db_cursor.fetchall())
+    recorded = []
+    for key in modules.idempotency.keys_to_record(keys, seen):
+        if await db_cursor.execute(modules.idempotency.RECORD_CALL, (key,)) == 1:
+            recorded.append(key)
+
+    return modules.idempotency.split_redeliveries(jobs, keys, recorded)
+
+
+async def claim_job(lane):
+    claim_id = uuid.uuid4().hex
+    async with db_pool.acquire() as db:
+        async with db.cursor() as db_cursor:
+            claimed = await db_cursor.execute(modules.jobs.CLAIM_CALL, (claim_id, lane))
+            if claimed == 0:
+                return None
+            await db_cursor.execute(modules.jobs.CLAIMED_CALL, (claim_id,))
+            row = await db_cursor.fetchone()
+
+    return modules.jobs.job_from_row(row, claim_id)
+
+
+async def consume(lane, concurrency):
+    """
+    Claim jobs from the lane whenever fewer than concurrency are running.  Tip and command processing stays blocking
+    code: it isn't ported to coroutines, so each job runs on the lane's thread pool while the event loop keeps taking in
+    webhooks.  The module state those jobs share, e.g. the balance, work and user caches and the rate limit buckets, is
+    guarded by locks, which are also replaced after a fork.
+    """
+    loop = asyncio.get_event_loop()
+    running = asyncio.Semaphore(concurrency)
+    while True:
+        await running.acquire()
+        try:
+            job = await claim_job(lane)
+        except Exception as e:
+            logging.info("Error claiming job: %s", e)
+            job = None
+
+        if job is None:
+            running.release()
+            await asyncio.sleep(modules.jobs.JOB_POLL_INTERVAL)
+            continue
+
+        job_future = loop.run_in_executor(lane_executors[lane], modules.jobs.run_job, job)
+        job_future.add_done_callback(lambda future: running.release())
+
+
+async def sweep():
+    """
+    Make worker.py's periodic sweep: release expired job claims, replay the outbound spool and return expired paper
+    tips.  They're blocking, so they run off the loop.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, modules.jobs.sweep_jobs)
+        except Exception as e:
+            logging.info("Error sweeping jobs: %s", e)
+        try:
+            await loop.run_in_executor(None, modules.papertips.return_expired_tips)
+        except Exception as e:
+            logging.info("Error returning expired paper tips: %s", e)
+        await asyncio.sleep(SWEEP_INTERVAL)
+
+
+async def twitter_event(scope, receive, send):
+    body = await read_body(receive)
+    headers = dict(scope['headers'])
+    auth_header = headers.get(b'x-twitter-webhooks-signature', b'').decode()
+    if not hmac.compare_digest(auth_header, webhooks.twitter_signature(body)):
+        ip = headers.get(b'x-forwarded-for', b'').decode() or (scope.get('client') or ['unknown'])[0]
+        logging.info("auth header not provided, probable malicious access attempt from IP: %s", ip)
+        await respond(send, HTTPStatus.BAD_REQUEST, b'You are not allowed to access this webhook.')
+        return
+
+    try:
+        await enqueue_batch(webhooks.twitter_jobs(json.loads(body)))
+    except modules.jobs.QueueFull:
+        await respond(send, HTTPStatus.SERVICE_UNAVAILABLE)
+        return
+
+    await respond(send, HTTPStatus.OK)
+
+
+async def telegram_event(scope, receive, send):
+    body = await read_body(receive)
+    try:
+        await enqueue_batch([('telegram_update', json.loads(body))])
+    except modules.jobs.QueueFull:
+        # Telegram redelivers updates that weren't acknowledged
+        await respond(send, HTTPStatus.SERVICE_UNAVAILABLE)
+        return
+
+    await respond(send, HTTPStatus.OK, b'ok')
+
+
+async def startup():
+    global db_pool
+    # Filling the delivery filter is a blocking query, so it's done once here rather than on the first webhook
+    try:
+        await asyncio.get_event_loop().run_in_executor(None, modules.idempotency.warm_filter)
+    except Exception as e:
+        logging.info("Error loading recent deliveries: %s", e)
+    db_pool = await aiomysql.create_pool(host=modules.db.DB_HOST, port=3306, user=modules.db.DB_USER,
+                                         password=modules.db.DB_PW, db=modules.db.DB_SCHEMA, charset='utf8mb4',
+                                         autocommit=True, maxsize=DB_POOL_SIZE)
+    if ASGI_PROCESS_JOBS:
+        # worker.py isn't running, so the confirmation subscription is held here.  With several web processes, only one
+        # of them subscribes at a time.
+        modules.confirmations.start_subscription()
+        for lane, settings in modules.jobs.LANES.items():
+            concurrency = settings['workers'] * ASGI_JOBS_PER_WORKER
+            lane_executors[lane] = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='jobs-' + lane)
+            consumer_tasks.append(asyncio.ensure_future(consume(lane, concurrency)))
+            logging.info("Running up to %s %s jobs", concurrency, lane)
+        consumer_tasks.append(asyncio.ensure_future(sweep()))
+
+
+async def shutdown():
+    for task in consumer_tasks:
+        task.cancel()
+    # Waiting for the running jobs blocks, so it's done off the loop
+    loop = asyncio.get_event_loop()
+    for executor in lane_executors.values():
+        await loop.run_in_executor(None, executor.shutdown, True)
+    db_pool.close()
+    await db_pool.wait_closed()
+
+
+async def lifespan(receive, send):
+    while True:
+        lifespan_message = await receive()
+        if lifespan_message['type'] == 'lifespan.startup':
+            await startup()
+            await send({'type': 'lifespan.startup.complete'})
+        elif lifespan_message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """
+    ASGI entry point.  The Twitter and Telegram webhooks are handled on the event loop, everything else is passed to
+    the Flask app.
+    """
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == webhooks.TWITTER_URI:
+        await twitter_event(scope, receive, send)
+    elif scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == webhooks.TELEGRAM_URI:
+        await telegram_event(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks comparing the previous Decimal/float amount handling against modules.amount.RawAmount.
+
+Run from the repository root: python3 -m benchmarks.amounts
+"""
+import timeit
+from decimal import Decimal
+
+from modules.amount import RawAmount
+
+NUMBER = 200000
+TIP_TEXTS = ['1', '.001', '0.5', '12.34567', '0.000001']
+BALANCE = 1234567000000000000000000000000
+MIN_TIP = '0.00001'
+
+
+def decimal_parse():
+    for text in TIP_TEXTS:
+        tip_amount = Decimal(text)
+        if Decimal(tip_amount) < Decimal(MIN_TIP):
+            continue
+        tip_amount_raw = Decimal(tip_amount) * 1000000000000000000000000000000
+        if str(tip_amount)[0] == ".":
+            "0{}".format(str(tip_amount))
+        else:
+            str(tip_amount)
+
+
+def raw_parse():
+    min_tip_raw = RawAmount.from_nano(MIN_TIP)
+    for text in TIP_TEXTS:
+        tip_amount = RawAmount.from_nano(text)
+        if tip_amount < min_tip_raw:
+            continue
+        tip_amount.to_nano()
+
+
+def decimal_balance_check():
+    balance = BALANCE / 1000000000000000000000000000000
+    for text in TIP_TEXTS:
+        Decimal(balance) < Decimal(text)
+        BALANCE < (Decimal(text) * 3 * 1000000000000000000000000000000)
+
+
+def raw_balance_check():
+    balance = RawAmount(BALANCE)
+    for text in TIP_TEXTS:
+        tip_amount = RawAmount.from_nano(text)
+        balance < tip_amount
+        balance < tip_amount * 3
+
+
+def float_format():
+    balance = BALANCE / 1000000000000000000000000000000
+    if str(balance)[0] == ".":
+        "0{}".format(str(balance))
+    else:
+        str(balance)
+
+
+def raw_format():
+    RawAmount(BALANCE).to_nano()
+
+
+def run(name, func):
+    seconds = timeit.timeit(func, number=NUMBER)
+    print("{:<24} {:>8.3f} us/call".format(name, seconds / NUMBER * 1000000))
+
+
+if __name__ == "__main__":
+    run('decimal parse', decimal_parse)
+    run('raw parse', raw_parse)
+    run('decimal balance check', decimal_balance_check)
+    run('raw balance check', raw_balance_check)
+    run('float format', float_format)
+    run('raw format', raw_format)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks comparing the previous multi-pass tip and DM parsing against modules.commands.
+
+Run from the repository root: python3 -m benchmarks.commands
+"""
+import timeit
+
+from modules.amount import RawAmount
+from modules.commands import ALIASES, parse_dm, parse_tip, tokenize
+
+NUMBER = 20000
+SENDER = 'mitche50'
+
+# Shapes of tweets and group messages the bot sees
+TIP_TEXTS = [
+    '@NanoTipBot !tip 1 @user1',
+    '@NanoTipBot !tip .001 @user1 @user2 @user3 thanks for the help!',
+    'Great thread @alice!\n\n@NanoTipBot !tip 0.5 @bob @carol @dave @erin @frank',
+    '@NanoTipBot !tip 12.345 @Mitche50 @user1 have a coffee on me',
+    '@NanoTipBot !tip ten @user1',
+    '@somebody @NanoTipBot @other that was a great point, here you go !tip 2 @somebody',
+    '@NanoTipBot love this bot, no tip today',
+    'RT @NanoTipBot: check out the new tipping features'
+]
+DM_TEXTS = ['!balance', '/b', '!account', '!register', '!help', '/start', '!withdraw 1 xrb_1abc', '!donate 5',
+            '!privatetip @user1 1', 'hello?']
+
+# The command lists the DM commands used to be checked against, in order
+COMMAND_LISTS = [
+    ['!help', '!h', '/help', '/h', '/start'],
+    ['!balance', '!bal', '!b', '/balance', '/bal', '/b'],
+    ['!register', '!reg', '!r', '/register', '/reg', '/r'],
+    ['!tip', '!t', '/tip', '/t'],
+    ['!withdraw', '!w', '/withdraw', '/w'],
+    ['!donate', '!d', '/donate', '/d'],
+    ['!account', '!acc', '!a', '!deposit', '/account', '/acc', '/a', '/deposit'],
+    ['!privatetip', '!private', '!pt', '/privatetip', '/private', '/pt']
+]
+
+
+def multi_pass_tip():
+    for text in TIP_TEXTS:
+        tokens = text.replace('\n', ' ').lower().split(" ")
+        try:
+            action_index = tokens.index("!tip")
+        except ValueError:
+            continue
+        starting_point = action_index + 1
+        try:
+            RawAmount.from_nano(tokens[starting_point])
+        except Exception:
+            continue
+        mentions = []
+        first_user_flag = False
+        for t_index in range(starting_point + 1, len(tokens)):
+            if first_user_flag and len(tokens[t_index]) > 0 and str(tokens[t_index][0]) != "@":
+                break
+            if len(tokens[t_index]) > 0 and (
+                    str(tokens[t_index][0]) == "@" and str(tokens[t_index]).lower() != ("@" + SENDER.lower())):
+                first_user_flag = True
+                mentions.append(tokens[t_index][1:])
+
+
+def single_pass_tip():
+    for text in TIP_TEXTS:
+        command = parse_tip(tokenize(text), SENDER)
+        if command.action is None or command.amount is None:
+            continue
+
+
+def command_list_dm():
+    for text in DM_TEXTS:
+        dm_action = text.split(" ")[0].lower()
+        for command_list in COMMAND_LISTS:
+            if dm_action in command_list:
+                break
+
+
+def alias_dm():
+    for text in DM_TEXTS:
+        ALIASES.get(text.split(" ")[0].lower())
+
+
+def parsed_dm():
+    for text in DM_TEXTS:
+        parse_dm(text)
+
+
+def run(name, func):
+    seconds = timeit.timeit(func, number=NUMBER)
+    print("{:<24} {:>8.3f} us/call".format(name, seconds / NUMBER * 1000000))
+
+
+if __name__ == "__main__":
+    run('multi pass tip', multi_pass_tip)
+    run('single pass tip', single_pass_tip)
+    run('command list dm', command_list_dm)
+    run('alias table dm', alias_dm)
+    run('parse dm', parsed_dm)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Import time and memory of each entry point, measured in a fresh interpreter so nothing is already imported.
+
+Run from the repository root, with webhookconfig.ini in place: python3 -m benchmarks.startup
+"""
+import json
+import subprocess
+import sys
+
+ENTRY_MODULES = ['webhooks', 'worker', 'settle', 'asgi', 'modules.social', 'modules.currency']
+RUNS = 5
+# Seconds an import may take before the entry point is reported as not returning, e.g. one that runs at import
+IMPORT_TIMEOUT = 60
+
+# Run in the child: import the module, then report wall time, peak RSS and which client libraries got imported
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    'seconds': elapsed,
+    'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'clients': [name for name in ('tweepy', 'TwitterAPI', 'telegram') if name in sys.modules]
+}}))
+"""
+
+
+def measure(module):
+    results = []
+    for _ in range(RUNS):
+        output = subprocess.run([sys.executable, '-c', PROBE.format(module=module)], stdout=subprocess.PIPE,
+                                check=True, timeout=IMPORT_TIMEOUT).stdout
+        results.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+
+    return results
+
+
+if __name__ == "__main__":
+    for module in ENTRY_MODULES:
+        try:
+            results = measure(module)
+        except subprocess.CalledProcessError as e:
+            print("{:<20} failed to import: {}".format(module, e))
+            continue
+        except subprocess.TimeoutExpired:
+            print("{:<20} import didn't return within {} s".format(module, IMPORT_TIMEOUT))
+            continue
+        seconds = sorted(result['seconds'] for result in results)[RUNS // 2]
+        maxrss = sorted(result['maxrss_kb'] for result in results)[RUNS // 2]
+        print("{:<20} {:>8.1f} ms {:>8} KB  clients imported: {}".format(
+            module, seconds * 1000, maxrss, ', '.join(results[0]['clients']) or 'none'))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# DEPENDENCIES =========================================
+import gzip
+import hashlib
+import io
+import json
+import os
+
+from PIL import Image
+
+from modules.assets import BUILD_DIR, COMPRESSED_EXTENSIONS, FINGERPRINTED_FILES, IMAGE_WIDTHS, MANIFEST_PATH, \
+    STATIC_DIR
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+FINGERPRINT_LENGTH = 12
+
+
+def fingerprinted_name(name, content, suffix=''):
+    """
+    css/ntbstyle.css -> css/ntbstyle.<hash of content>.css, with suffix added to the name's stem
+    """
+    stem, extension = os.path.splitext(name)
+    return '{}{}.{}{}'.format(stem, suffix, hashlib.sha256(content).hexdigest()[:FINGERPRINT_LENGTH], extension)
+
+
+def write_file(name, content):
+    """
+    Write a built file and its precompressed copies.  Files already written by an earlier build are left alone, so
+    pages rendered before a deploy keep finding the files they link to.
+    """
+    path = '{}/{}'.format(BUILD_DIR, name)
+    if os.path.isfile(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    copies = {'': content}
+    if name.endswith(COMPRESSED_EXTENSIONS):
+        # mtime=0 keeps the gzip copy the same from build to build
+        copies['.gz'] = gzip.compress(content, compresslevel=9, mtime=0)
+        if brotli is not None:
+            copies['.br'] = brotli.compress(content, quality=11)
+    # The file itself goes last, so it's only there once its copies are
+    for suffix, copy in sorted(copies.items(), reverse=True):
+        # A compressed copy that isn't smaller than the file isn't worth serving
+        if suffix and len(copy) >= len(content):
+            continue
+        # Write then rename, so the server never sends half a file
+        temp_path = '{}{}.{}'.format(path, suffix, os.getpid())
+        with open(temp_path, 'wb') as file:
+            file.write(copy)
+        os.replace(temp_path, path + suffix)
+
+
+def encode_image(image, image_format):
+    output = io.BytesIO()
+    if image_format == 'JPEG':
+        image.convert('RGB').save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    elif image_format == 'WEBP':
+        image.save(output, 'WEBP', quality=WEBP_QUALITY, method=6)
+    else:
+        image.save(output, image_format, optimize=True)
+
+    return output.getvalue()
+
+
+def build_image(name, widths):
+    """
+    Resize the image to each width it isn't already narrower than, and encode each size in the image's format and as
+    WebP.  Returns the variants, narrowest first.
+    """
+    image = Image.open('{}/{}'.format(STATIC_DIR, name))
+    image.load()
+    stem = os.path.splitext(name)[0]
+    variants = []
+    for width in sorted(set([min(width, image.width) for width in widths])):
+        if width < image.width:
+            resized = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        else:
+            resized = image
+        src = encode_image(resized, image.format)
+        webp = encode_image(resized, 'WEBP')
+        variant = {'width': width, 'src': fingerprinted_name(name, src, '-{}'.format(width)),
+                   'webp': fingerprinted_name(stem + '.webp', webp, '-{}'.format(width))}
+        write_file(variant['src'], src)
+        write_file(variant['webp'], webp)
+        variants.append(variant)
+
+    return variants
+
+
+def main():
+    # Build the fingerprinted, resized and precompressed static assets the templates link to through /assets.  Run on
+    # deploy, before the web server is restarted.
+    built = {'files': {}, 'images': {}}
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    for name in FINGERPRINTED_FILES:
+        with open('{}/{}'.format(STATIC_DIR, name), 'rb') as file:
+            content = file.read()
+        built['files'][name] = fingerprinted_name(name, content)
+        write_file(built['files'][name], content)
+
+    for name, widths in IMAGE_WIDTHS.items():
+        built['images'][name] = build_image(name, widths)
+
+    temp_path = '{}.{}'.format(MANIFEST_PATH, os.getpid())
+    with open(temp_path, 'w') as file:
+        json.dump(built, file, indent=2, sort_keys=True)
+    os.replace(temp_path, MANIFEST_PATH)
+
+    print("Built {} files and {} images into {}".format(len(built['files']), len(built['images']), BUILD_DIR))
+    if brotli is None:
+        print("brotli isn't installed, only gzip copies were written")
+
+
+main()
@@ -0,0 +1,241 @@
+import asyncio
+import bisect
+import logging
+import os
+import threading
+import time
+
+import aiohttp
+import nano
+
+import modules.balances
+import modules.currency
+import modules.db
+import modules.node
+import modules.registry
+
+# Read config and parse constants
+config = modules.registry.config
+
+WALLET = config.get('webhooks', 'wallet')
+MAX_IN_FLIGHT = config.getint('webhooks', 'node_async_max_in_flight', fallback=64)
+CONNECTIONS_PER_NODE = config.getint('webhooks', 'node_async_connections', fallback=32)
+CALL_TIMEOUT = config.getfloat('webhooks', 'node_async_timeout', fallback=10)
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class AsyncNodeClient(object):
+    """
+    asyncio client for the node RPC actions the bot uses.  Each event loop gets one aiohttp session, so connections to
+    the nodes are kept open and reused, and a semaphore caps the calls in flight.  Nodes are picked the same way as the
+    blocking NodeRouter: reads go to the healthy nodes and fail over on connection errors, wallet calls go to the
+    wallet node.
+    """
+
+    def __init__(self, router):
+        self.router = router
+        self.session_lock = threading.Lock()
+        self.sessions = {}
+        self.histogram_lock = threading.Lock()
+        self.histograms = {}
+
+    def open_session(self):
+        """
+        Return the (session, semaphore) pair for the running event loop.  Both belong to the loop they were made on, so
+        each loop, e.g. one per thread, gets its own.
+        """
+        loop = asyncio.get_event_loop()
+        with self.session_lock:
+            session = self.sessions.get(loop)
+            if session is None or session[0].closed:
+                session = (aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=CONNECTIONS_PER_NODE)),
+                           asyncio.Semaphore(MAX_IN_FLIGHT))
+                self.sessions[loop] = session
+
+        return session
+
+    async def close(self):
+        """
+        Close the running loop's session, before the loop itself is closed
+        """
+        with self.session_lock:
+            session = self.sessions.pop(asyncio.get_event_loop(), None)
+        if session is not None:
+            await session[0].close()
+
+    async def call(self, action, params=None, timeout=CALL_TIMEOUT):
+        """
+        Make an RPC call and return the node's response.  Raises nano.rpc.RPCException if the node refused it.
+        """
+        session, semaphore = self.open_session()
+        payload = dict(params or {})
+        payload['action'] = action
+        last_error = None
+        async with semaphore:
+            for node in self.router.candidates(action):
+                with self.router.lock:
+                    node['in_flight'] += 1
+                start = time.time()
+                # True once the node answered, False if it failed, None if the call was cancelled
+                answered = None
+                try:
+                    async with session.post(node['ip'], json=payload,
+                                            timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                        result = await response.json(content_type=None)
+                    answered = True
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    # A body that isn't JSON is as much a node failure as no body, so the next node is tried
+                    answered = False
+                    logging.info("RPC %s failed on node %s: %s", action, node['ip'], e)
+                    last_error = e
+                finally:
+                    latency = time.time() - start
+                    if answered is None:
+                        # A cancelled call says nothing about the node, it's just no longer in flight
+                        with self.router.lock:
+                            node['in_flight'] -= 1
+                    else:
+                        self.router.record(node, latency, error=not answered)
+                        self.record(action, latency)
+                if not answered:
+                    continue
+
+                if 'error' in result:
+                    raise nano.rpc.RPCException(result['error'])
+                return result
+
+        raise last_error
+
+    def reset_after_fork(self):
+        """
+        Sessions belong to the parent's event loops, so a forked child starts without any
+        """
+        self.session_lock = threading.Lock()
+        self.sessions = {}
+        self.histogram_lock = threading.Lock()
+
+    def record(self, action, latency):
+        with self.histogram_lock:
+            histogram = self.histograms.setdefault(action, {'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+                                                            'count': 0, 'sum': 0.0})
+            histogram['buckets'][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            histogram['count'] += 1
+            histogram['sum'] += latency
+
+    def latency_histograms(self):
+        """
+        Per action call counts by latency bucket.  The bucket keys are the upper bounds in seconds, with '+Inf' for the
+        calls slower than the last one.
+        """
+        with self.histogram_lock:
+            return {action: {
+                'buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], histogram['buckets'])),
+                'count': histogram['count'],
+                'sum': round(histogram['sum'], 6)
+            } for action, histogram in self.histograms.items()}
+
+    async def send(self, wallet, source, destination, amount, id=None, work=None):
+        params = {'wallet': wallet, 'source': source, 'destination': destination, 'amount': str(int(amount))}
+        if id is not None:
+            params['id'] = id
+        if work:
+            params['work'] = work
+
+        return (await self.call('send', params))['block']
+
+    async def receive(self, wallet, account, block, work=None):
+        params = {'wallet': wallet, 'account': account, 'block': block}
+        if work:
+            params['work'] = work
+
+        return (await self.call('receive', params))['block']
+
+    async def pending(self, account, count=None):
+        params = {'account': account}
+        if count is not None:
+            params['count'] = str(count)
+
+        return (await self.call('pending', params))['blocks'] or []
+
+    async def accounts_pending(self, accounts, count=None):
+        params = {'accounts': accounts}
+        if count is not None:
+            params['count'] = str(count)
+        blocks = (await self.call('accounts_pending', params))['blocks'] or {}
+
+        return {account: account_blocks or [] for account, account_blocks in blocks.items()}
+
+    async def account_balance(self, account):
+        result = await self.call('account_balance', {'account': account})
+
+        return {'balance': int(result['balance']), 'pending': int(result['pending'])}
+
+    async def accounts_balances(self, accounts):
+        balances = (await self.call('accounts_balances', {'accounts': accounts}))['balances']
+
+        return {account: {'balance': int(balance['balance']), 'pending': int(balance['pending'])}
+                for account, balance in balances.items()}
+
+    async def accounts_frontiers(self, accounts):
+        return (await self.call('accounts_frontiers', {'accounts': accounts}))['frontiers'] or {}
+
+    async def account_create(self, wallet, work=True):
+        params = {'wallet': wallet}
+        if not work:
+            params['work'] = 'false'
+
+        return (await self.call('account_create', params))['account']
+
+    async def validate_account_number(self, account):
+        return (await self.call('validate_account_number', {'account': account}))['valid'] == '1'
+
+    async def block_count(self):
+        result = await self.call('block_count')
+
+        return {'count': int(result['count']), 'unchecked': int(result['unchecked'])}
+
+
+# Shared client for all modules
+aiorpc = AsyncNodeClient(modules.node.rpc)
+os.register_at_fork(after_in_child=aiorpc.reset_after_fork)
+
+
+async def receive_block(account, block):
+    """
+    Receive a single pending block into the account, building on its current frontier.  With local signing, the
+    account's chain lock is held so the receive can't fork a send being signed for it.
+    """
+    loop = asyncio.get_event_loop()
+    # The DB and work server clients are blocking, so they run off the loop
+    lock = None
+    if modules.currency.LOCAL_SIGNING:
+        lock = await loop.run_in_executor(None, modules.db.get_lock, modules.currency.chain_lock_name(account))
+    try:
+        frontiers = await aiorpc.accounts_frontiers([account])
+        work = ''
+        if account in frontiers:
+            work = await loop.run_in_executor(None, modules.currency.generate_work, frontiers[account])
+        try:
+            await aiorpc.receive(WALLET, account, block, work=work)
+            logging.info("block %s received", block)
+        except nano.rpc.RPCException as e:
+            logging.info("block %s not received: %s", block, e)
+    finally:
+        if lock is not None:
+            await loop.run_in_executor(None, modules.db.release_lock, lock)
+    modules.balances.invalidate_balance(account)
+
+
+async def pending_blocks(accounts, batch_size=1000):
+    """
+    The blocks pending for each of the accounts that has any, using a single accounts_pending call per batch_size
+    accounts
+    """
+    pending = {}
+    for result in await asyncio.gather(*[aiorpc.accounts_pending(accounts[index:index + batch_size])
+                                         for index in range(0, len(accounts), batch_size)]):
+        pending.update({account: blocks for account, blocks in result.items() if blocks})
+
+    return pending
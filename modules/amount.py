@@ -0,0 +1,72 @@
+RAW_DIGITS = 30
+RAW_PER_NANO = 10 ** RAW_DIGITS
+# Multiplier for a fractional part with the given number of digits
+FRACTION_SCALE = [10 ** (RAW_DIGITS - digits) for digits in range(RAW_DIGITS + 1)]
+
+
+class RawAmount(int):
+    """
+    An amount of Nano held exactly as an integer number of raw.  Comparison is plain integer comparison, and
+    arithmetic between amounts stays a RawAmount so totals never pass through float or Decimal.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_nano(cls, text):
+        """
+        Parse a user supplied NANO amount such as '1', '1.01' or '.001' into raw.  Raises ValueError if the text is not
+        a plain unsigned decimal number, or has more decimal places than a raw can represent.
+        """
+        if not isinstance(text, str):
+            text = str(text)
+        whole, _, fraction = text.partition('.')
+        if (not (whole or fraction) or len(fraction) > RAW_DIGITS or not text.isascii()
+                or (whole and not whole.isdigit()) or (fraction and not fraction.isdigit())):
+            raise ValueError("Invalid NANO amount: {}".format(text))
+
+        raw = int(whole) * RAW_PER_NANO if whole else 0
+        if fraction:
+            raw += int(fraction) * FRACTION_SCALE[len(fraction)]
+
+        return cls(raw)
+
+    def to_nano(self):
+        """
+        Format as a NANO string with no exponent and no trailing zeros, e.g. '0.001'.
+        """
+        if self < 0:
+            return '-' + RawAmount(-self).to_nano()
+
+        digits = '%031d' % self
+        fraction = digits[-RAW_DIGITS:].rstrip('0')
+        if not fraction:
+            return digits[:-RAW_DIGITS]
+
+        return '{}.{}'.format(digits[:-RAW_DIGITS], fraction)
+
+    def __repr__(self):
+        return 'RawAmount({})'.format(int(self))
+
+    def __add__(self, other):
+        if not isinstance(other, int):
+            return NotImplemented
+        return RawAmount(int(self) + int(other))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if not isinstance(other, int):
+            return NotImplemented
+        return RawAmount(int(self) - int(other))
+
+    def __rsub__(self, other):
+        if not isinstance(other, int):
+            return NotImplemented
+        return RawAmount(int(other) - int(self))
+
+    def __mul__(self, other):
+        if not isinstance(other, int):
+            return NotImplemented
+        return RawAmount(int(self) * int(other))
+
+    __rmul__ = __mul__
@@ -0,0 +1,115 @@
+import json
+import logging
+import mimetypes
+import os
+
+from flask import abort, send_from_directory
+
+STATIC_DIR = '{}/static'.format(os.getcwd())
+# build_assets.py writes the fingerprinted assets and their manifest here
+BUILD_DIR = '{}/build'.format(STATIC_DIR)
+MANIFEST_PATH = '{}/manifest.json'.format(BUILD_DIR)
+BUILD_URL = '/assets'
+
+# Widths each image is resized to, for the sizes it's shown at and twice that for high density screens
+IMAGE_WIDTHS = {
+    # The banner at the top of most pages, 65% of the container
+    'nano_tip_bot_logo.jpg': [480, 960, 1440],
+    # The nav bar logo, 200px wide
+    'ntb_logo_no_bg.png': [200, 400],
+    'ntb_logo_no_bg2.png': [200, 400]
+}
+# Assets copied with a fingerprint as they are
+FINGERPRINTED_FILES = ['css/bootstrap-social.css', 'css/ntbstyle.css', 'favicon.ico', 'nanomark.svg',
+                       'nanodollar.svg']
+# Extensions build_assets.py stores precompressed copies of, and the Content-Encoding of each copy in order of
+# preference
+COMPRESSED_EXTENSIONS = ('.css', '.svg', '.ico', '.js')
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+# Fingerprinted names change with their contents, so they're cached for a year
+ASSET_MAX_AGE = 31536000
+
+# {'files': {name: built name}, 'images': {name: [{'width', 'src', 'webp'}, ...] narrowest first}}
+manifest = None
+# Every file name in the manifest, the only names /assets serves
+built_names = set()
+
+
+def load_manifest():
+    """
+    Read the manifest build_assets.py wrote, once.  Without one the assets are linked from /static as they are.
+    """
+    global manifest
+    if manifest is None:
+        try:
+            with open(MANIFEST_PATH) as file:
+                loaded = json.load(file)
+        except (OSError, ValueError) as e:
+            logging.info("No asset manifest, serving unbuilt assets: %s", e)
+            loaded = {'files': {}, 'images': {}}
+        built_names.update(loaded['files'].values())
+        for variants in loaded['images'].values():
+            built_names.update([variant[key] for variant in variants for key in ('src', 'webp') if variant.get(key)])
+        manifest = loaded
+
+    return manifest
+
+
+def asset_url(name):
+    built_name = load_manifest()['files'].get(name)
+    if built_name is None:
+        return '/static/{}'.format(name)
+    return '{}/{}'.format(BUILD_URL, built_name)
+
+
+def image_url(name, width):
+    """
+    URL of the narrowest variant of the image at least width pixels wide, or the widest there is
+    """
+    variants = load_manifest()['images'].get(name)
+    if not variants:
+        return '/static/{}'.format(name)
+    for variant in variants:
+        if variant['width'] >= width:
+            break
+
+    return '{}/{}'.format(BUILD_URL, variant['src'])
+
+
+def image_srcset(name, image_format='src'):
+    """
+    The srcset of the image's variants in image_format, 'src' for the source's format or 'webp'.  Empty if the image
+    hasn't been built.
+    """
+    variants = load_manifest()['images'].get(name, [])
+    return ', '.join(['{}/{} {}w'.format(BUILD_URL, variant[image_format], variant['width']) for variant in variants
+                      if variant.get(image_format)])
+
+
+def send_asset(filename, accept_encodings):
+    """
+    Respond with a built asset, with its brotli or gzip copy if the client accepts one.  Only names in the manifest are
+    served, so a name is never resolved to anything but a file build_assets.py wrote.
+    """
+    load_manifest()
+    if filename not in built_names:
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = None
+    if filename.endswith(COMPRESSED_EXTENSIONS):
+        for encoding, suffix in ENCODINGS:
+            if accept_encodings[encoding] and os.path.isfile('{}/{}{}'.format(BUILD_DIR, filename, suffix)):
+                response = send_from_directory(BUILD_DIR, filename + suffix, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        if response is None:
+            response = send_from_directory(BUILD_DIR, filename, mimetype=mimetype)
+        response.vary.add('Accept-Encoding')
+    else:
+        response = send_from_directory(BUILD_DIR, filename, mimetype=mimetype)
+
+    response.cache_control.public = True
+    response.cache_control.max_age = ASSET_MAX_AGE
+    response.headers['Cache-Control'] += ', immutable'
+    return response
@@ -0,0 +1,135 @@
+import logging
+import os
+import threading
+import time
+
+import modules.ledger
+import modules.node
+import modules.registry
+from modules.amount import RawAmount
+
+# Read config and parse constants
+config = modules.registry.config
+
+# Cached balances are dropped when we publish or receive a block for the account, this TTL only bounds how long a
+# change we didn't see (e.g. a deposit without the confirmation subscription) can go unnoticed.
+BALANCE_CACHE_TTL = config.getint('webhooks', 'balance_cache_ttl', fallback=30)
+LOOKUP_TIMEOUT = 30
+
+# Connect to Nano node
+rpc = modules.node.rpc
+
+# Account key -> (expiry time, {'balance': RawAmount, 'pending': RawAmount})
+balance_cache = {}
+# Account key -> Event set when the RPC filling that account completes
+balance_lookups = {}
+# Account key -> number of invalidations, so a lookup that raced an invalidation isn't cached
+balance_versions = {}
+balance_lock = threading.Lock()
+
+
+def account_key(account):
+    return account.split('_', 1)[-1]
+
+
+def invalidate_balance(account):
+    """
+    Drop the cached balance for an account after we publish or receive a block for it
+    """
+    key = account_key(account)
+    with balance_lock:
+        balance_cache.pop(key, None)
+        balance_versions[key] = balance_versions.get(key, 0) + 1
+
+
+def get_balance(account, fresh=False):
+    """
+    Return the balance and pending amounts of an account as RawAmounts.  Pass fresh when money is about to move on the
+    answer, to read it from the node rather than the cache.
+    """
+    return get_balances([account], fresh)[account]
+
+
+def get_balances(accounts, fresh=False):
+    """
+    Return {account: {'balance': RawAmount, 'pending': RawAmount}} for the provided accounts.  In ledger mode the
+    balance includes the account's unsettled ledger amount.
+    """
+    balances = fetch_chain_balances(accounts) if fresh else get_chain_balances(accounts)
+    if modules.ledger.LEDGER_MODE:
+        balances = modules.ledger.add_unsettled(balances)
+
+    return balances
+
+
+def fetch_chain_balances(accounts):
+    """
+    Request the balances from the node with one accounts_balances call, and cache them unless the account was
+    invalidated while the call was in flight
+    """
+    with balance_lock:
+        versions = {account: balance_versions.get(account_key(account), 0) for account in set(accounts)}
+    fetched = rpc.accounts_balances(accounts=list(versions))
+    fetched = {account_key(account): balance for account, balance in fetched.items()}
+    balances = {}
+    expiry = time.time() + BALANCE_CACHE_TTL
+    with balance_lock:
+        for account, version in versions.items():
+            balance = fetched[account_key(account)]
+            balances[account] = {'balance': RawAmount(balance['balance']), 'pending': RawAmount(balance['pending'])}
+            if balance_versions.get(account_key(account), 0) == version:
+                balance_cache[account_key(account)] = (expiry, balances[account])
+
+    return balances
+
+
+def get_chain_balances(accounts):
+    """
+    Return the balances of the provided accounts as the node sees them.  Cache misses are filled
+    with a single accounts_balances call, and accounts already being looked up by another thread are waited on rather
+    than requested again.
+    """
+    balances = {}
+    to_fetch = []
+    to_wait = []
+    now = time.time()
+    with balance_lock:
+        for account in set(accounts):
+            key = account_key(account)
+            cached = balance_cache.get(key)
+            if cached is not None and cached[0] > now:
+                balances[account] = cached[1]
+            elif key in balance_lookups:
+                to_wait.append((account, balance_lookups[key]))
+            else:
+                balance_lookups[key] = threading.Event()
+                to_fetch.append(account)
+
+    if to_fetch:
+        try:
+            balances.update(fetch_chain_balances(to_fetch))
+        finally:
+            with balance_lock:
+                for account in to_fetch:
+                    balance_lookups.pop(account_key(account)).set()
+
+    if to_wait:
+        for account, lookup in to_wait:
+            if not lookup.wait(LOOKUP_TIMEOUT):
+                logging.info("Timed out waiting on balance lookup for %s", account)
+        # Anything the other lookup couldn't fill is requested again
+        balances.update(get_chain_balances([account for account, lookup in to_wait]))
+
+    return balances
+
+
+def reset_after_fork():
+    """
+    A forked child can't wait on a lock or a lookup a thread of its parent had going at the fork
+    """
+    global balance_lock
+    balance_lock = threading.Lock()
+    balance_lookups.clear()
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
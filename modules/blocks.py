@@ -0,0 +1,97 @@
+import hashlib
+
+import ed25519_blake2b
+
+ACCOUNT_ALPHABET = '13456789abcdefghijkmnopqrstuwxyz'
+ACCOUNT_LOOKUP = {char: index for index, char in enumerate(ACCOUNT_ALPHABET)}
+STATE_BLOCK_PREAMBLE = (6).to_bytes(32, 'big')
+
+
+def encode_base32(value, length):
+    chars = []
+    for _ in range(length):
+        chars.append(ACCOUNT_ALPHABET[value & 0x1f])
+        value >>= 5
+
+    return ''.join(reversed(chars))
+
+
+def account_from_public_key(public_key, prefix='xrb_'):
+    """
+    Encode a 32 byte public key as an account, with the 5 byte blake2b checksum appended
+    """
+    checksum = hashlib.blake2b(public_key, digest_size=5).digest()[::-1]
+
+    return '{}{}{}'.format(prefix, encode_base32(int.from_bytes(public_key, 'big'), 52),
+                           encode_base32(int.from_bytes(checksum, 'big'), 8))
+
+
+def public_key_from_account(account):
+    """
+    Decode an xrb_ or nano_ account into its 32 byte public key.  Raises ValueError on a bad checksum.
+    """
+    encoded = account.split('_', 1)[-1]
+    if len(encoded) != 60 or any(char not in ACCOUNT_LOOKUP for char in encoded):
+        raise ValueError("Invalid account: {}".format(account))
+
+    value = 0
+    for char in encoded[:52]:
+        value = (value << 5) | ACCOUNT_LOOKUP[char]
+    public_key = value.to_bytes(33, 'big')[1:]
+
+    if account_from_public_key(public_key).split('_', 1)[-1] != encoded:
+        raise ValueError("Invalid account checksum: {}".format(account))
+
+    return public_key
+
+
+def private_key_from_seed(seed, index):
+    """
+    Derive the private key at index from a wallet seed, the same way the node derives deterministic wallet accounts
+    """
+    return hashlib.blake2b(bytes.fromhex(seed) + index.to_bytes(4, 'big'), digest_size=32).digest()
+
+
+def signing_key(private_key):
+    return ed25519_blake2b.SigningKey(private_key)
+
+
+def public_key(key):
+    return key.get_verifying_key().to_bytes()
+
+
+def state_block_hash(account, previous, representative, balance, link):
+    """
+    Hash the fields of a state block.  previous and link are 64 character hex strings, balance is in raw.
+    """
+    block_hash = hashlib.blake2b(digest_size=32)
+    block_hash.update(STATE_BLOCK_PREAMBLE)
+    block_hash.update(public_key_from_account(account))
+    block_hash.update(bytes.fromhex(previous))
+    block_hash.update(public_key_from_account(representative))
+    block_hash.update(int(balance).to_bytes(16, 'big'))
+    block_hash.update(bytes.fromhex(link))
+
+    return block_hash.hexdigest().upper()
+
+
+def build_send_block(key, account, previous, representative, balance, destination):
+    """
+    Build and sign a state send block leaving the account with the provided balance.  Work is attached separately once
+    it's been generated for previous.
+    """
+    link = public_key_from_account(destination).hex().upper()
+    block_hash = state_block_hash(account, previous, representative, balance, link)
+
+    block = {
+        'type': 'state',
+        'account': account,
+        'previous': previous,
+        'representative': representative,
+        'balance': str(int(balance)),
+        'link': link,
+        'link_as_account': destination,
+        'signature': key.sign(bytes.fromhex(block_hash)).hex().upper()
+    }
+
+    return block_hash, block
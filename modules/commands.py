@@ -0,0 +1,110 @@
+from collections import namedtuple
+
+from modules.amount import RawAmount
+
+# Command -> the names it can be sent as, each with a ! or / in front
+COMMANDS = {
+    'balance': ['balance', 'bal', 'b'],
+    'account': ['account', 'acc', 'a', 'deposit'],
+    'help': ['help', 'h'],
+    'register': ['register', 'reg', 'r'],
+    'withdraw': ['withdraw', 'w'],
+    'donate': ['donate', 'd'],
+    'tip': ['tip', 't'],
+    'privatetip': ['privatetip', 'private', 'pt']
+}
+
+# Alias as sent, e.g. '!bal' -> command
+ALIASES = {prefix + name: command for command, names in COMMANDS.items() for name in names for prefix in '!/'}
+# Telegram sends /start when a user first opens a chat with the bot
+ALIASES['/start'] = 'help'
+
+ACCOUNT_PREFIXES = ('xrb_', 'nano_')
+BOT_MENTION = '@nanotipbot'
+AMOUNT_START = frozenset('0123456789.')
+
+# action:        Command name from ALIASES, or None if the message had no command
+# amount_text:   The token given as the amount, or None if there wasn't one
+# amount:        amount_text as a RawAmount, or None if it isn't a valid amount
+# mentions:      Screen names mentioned as receivers, without the @
+# address:       First Nano account in the message, or None
+# mentions_bot:  Whether the bot was mentioned
+Command = namedtuple('Command', ['action', 'amount_text', 'amount', 'mentions', 'address', 'mentions_bot'])
+
+
+def tokenize(text):
+    """
+    Split a public message into the lower case tokens the tip parser works on
+    """
+    return text.replace('\n', ' ').lower().split(' ')
+
+
+def parse_amount(text):
+    # Most tokens aren't numbers at all, so skip the exception for those
+    if not text or text[0] not in AMOUNT_START:
+        return None
+    try:
+        return RawAmount.from_nano(text)
+    except ValueError:
+        return None
+
+
+def parse_tip(tokens, sender_screen_name=None):
+    """
+    Parse a tweet or group message from its tokens.  The command is the first !tip, its amount is the token right
+    after it, and the receivers are the run of @mentions that follows, leaving out the sender.  The tokens after the
+    amount are read once, stopping where the mentions end.
+    """
+    mentions_bot = BOT_MENTION in tokens
+    try:
+        amount_index = tokens.index('!tip') + 1
+    except ValueError:
+        return Command(None, None, None, [], None, mentions_bot)
+
+    amount_text = tokens[amount_index] if amount_index < len(tokens) else None
+    mentions = []
+    address = None
+    sender_mention = '@' + sender_screen_name.lower() if sender_screen_name else None
+    for index in range(amount_index + 1, len(tokens)):
+        token = tokens[index]
+        if not token:
+            continue
+        if token[0] == '@':
+            if token != sender_mention:
+                mentions.append(token[1:])
+        elif mentions:
+            break
+        elif address is None and token.startswith(ACCOUNT_PREFIXES):
+            address = token
+
+    return Command('tip', amount_text, parse_amount(amount_text), mentions, address, mentions_bot)
+
+
+def parse_dm(text):
+    """
+    Parse a DM in one pass.  The command is the first word, the address the first Nano account, and the amount the
+    first other word after the command, whether or not it's a valid number, so a mistyped amount is never mistaken
+    for no amount at all.
+    """
+    tokens = text.split(' ')
+    amount_text = None
+    amount = None
+    mentions = []
+    address = None
+    mentions_bot = False
+    for token in tokens[1:]:
+        if not token:
+            continue
+        lower_token = token.lower()
+        if lower_token[0] == '@':
+            if lower_token == BOT_MENTION:
+                mentions_bot = True
+            else:
+                mentions.append(token[1:])
+        elif address is None and lower_token.startswith(ACCOUNT_PREFIXES):
+            address = lower_token
+        elif amount_text is None:
+            amount_text = token
+            amount = parse_amount(token)
+
+    return Command(ALIASES.get(tokens[0].lower()), amount_text, amount, mentions, address, mentions_bot)
@@ -0,0 +1,284 @@
+import json
+import logging
+import asyncio
+import collections
+import os
+import queue
+import threading
+import time
+
+import websocket
+
+import modules.aionode
+import modules.balances
+import modules.db
+import modules.registry
+
+# Read config and parse constants
+config = modules.registry.config
+
+# Constants
+CONFIRMATION_WS = config.get('webhooks', 'node_websocket', fallback='')
+ACCOUNT_REFRESH = config.getint('webhooks', 'node_websocket_account_refresh', fallback=60)
+RECONNECT_DELAY = 5
+RECV_TIMEOUT = 5
+PENDING_BATCH = 1000
+# Named lock the subscribed process holds while it's connected, so other processes know blocks are being received
+SUBSCRIPTION_LOCK = 'confirmation_subscription'
+ALIVE_CHECK_INTERVAL = 5
+
+# Incoming (account, block hash) pairs waiting to be received
+receive_queue = queue.Queue()
+
+# Accounts from the users table, keyed without their xrb_/nano_ prefix so either form from the node matches
+watched_accounts = {}
+watched_accounts_lock = threading.Lock()
+subscription_thread = None
+receive_thread = None
+# Event loop the blocks are received on.  The backlog lookups run on it too, so everything shares one node session.
+receive_event_loop = None
+# Account -> its blocks waiting to be received, the first being received now.  Only used on the receive loop.
+account_blocks = {}
+receive_tasks = set()
+# Set while this process's subscription is connected
+subscribed = threading.Event()
+# Last answer from the subscription lock, for processes that aren't subscribed themselves
+alive_check = {'checked': 0, 'alive': False}
+alive_check_lock = threading.Lock()
+
+
+def account_key(account):
+    """
+    Strip the xrb_ / nano_ prefix from an account so the two address forms compare equal
+    """
+    return account.split('_', 1)[-1]
+
+
+def refresh_watched_accounts():
+    """
+    Load the accounts in the users table into the watch list.  Returns the accounts that were not watched before.
+    """
+    users_accounts = modules.db.get_db_data("SELECT account FROM users")
+    new_accounts = []
+    with watched_accounts_lock:
+        for row in users_accounts:
+            if account_key(row[0]) not in watched_accounts:
+                watched_accounts[account_key(row[0])] = row[0]
+                new_accounts.append(row[0])
+
+    return new_accounts
+
+
+def subscribe_message(accounts):
+    return json.dumps({'action': 'subscribe', 'topic': 'confirmation', 'ack': True,
+                       'options': {'accounts': accounts}})
+
+
+def update_message(accounts):
+    return json.dumps({'action': 'update', 'topic': 'confirmation', 'options': {'accounts_add': accounts}})
+
+
+def handle_confirmation(message):
+    """
+    Drop the cached balances of our accounts touched by a confirmed block, and queue a receive when it's a send
+    destined for one of our accounts.  Returns the queued (account, hash) pair, or None if no receive was needed.
+    """
+    if message.get('topic') != 'confirmation':
+        return None
+
+    confirmation = message.get('message', {})
+    block = confirmation.get('block', {})
+    with watched_accounts_lock:
+        account = watched_accounts.get(account_key(confirmation.get('account', '')))
+        destination = watched_accounts.get(account_key(block.get('link_as_account', '')))
+    if account is not None:
+        modules.balances.invalidate_balance(account)
+
+    if block.get('subtype') != 'send' or destination is None:
+        return None
+
+    modules.balances.invalidate_balance(destination)
+
+    logging.info("confirmed send %s to %s, queueing receive", confirmation.get('hash'), destination)
+    incoming = (destination, confirmation.get('hash'))
+    receive_queue.put(incoming)
+
+    return incoming
+
+
+def receive_backlog(accounts):
+    """
+    Queue any blocks that were already pending for the accounts, e.g. sends confirmed while we were disconnected,
+    behind the blocks already queued for each account.  The lookup takes one accounts_pending call per PENDING_BATCH
+    accounts, made on the receive loop.
+    """
+    pending = asyncio.run_coroutine_threadsafe(modules.aionode.pending_blocks(accounts, PENDING_BATCH),
+                                               receive_event_loop).result()
+    for account, blocks in pending.items():
+        for block in blocks:
+            receive_queue.put((account, block))
+    logging.info("queued %s blocks that were pending for %s accounts",
+                 sum(len(blocks) for blocks in pending.values()), len(accounts))
+
+
+def subscription_alive():
+    """
+    Whether a confirmation subscription is connected in this or any other process, so incoming blocks are received as
+    they confirm.  Other processes are checked through SUBSCRIPTION_LOCK at most every ALIVE_CHECK_INTERVAL seconds.
+    """
+    if not CONFIRMATION_WS:
+        return False
+    if subscribed.is_set():
+        return True
+
+    with alive_check_lock:
+        if time.time() - alive_check['checked'] > ALIVE_CHECK_INTERVAL:
+            try:
+                holder = modules.db.get_db_data("SELECT IS_USED_LOCK(%s)", [SUBSCRIPTION_LOCK])[0][0]
+                alive_check['alive'] = holder is not None
+            except Exception as e:
+                logging.info("Error checking the confirmation subscription: %s", e)
+                alive_check['alive'] = False
+            alive_check['checked'] = time.time()
+
+        return alive_check['alive']
+
+
+def subscription_loop(url):
+    """
+    Hold a websocket subscription to the node's confirmation feed, reconnecting on errors.  New accounts in the users
+    table are added to the subscription every ACCOUNT_REFRESH seconds.  Only one process subscribes at a time; the
+    others wait on SUBSCRIPTION_LOCK to take over.
+    """
+    while True:
+        lock_db = None
+        ws = None
+        try:
+            lock_db = modules.db.get_lock(SUBSCRIPTION_LOCK, ACCOUNT_REFRESH)
+            ws = websocket.create_connection(url, timeout=RECV_TIMEOUT)
+            refresh_watched_accounts()
+            with watched_accounts_lock:
+                accounts = list(watched_accounts.values())
+            ws.send(subscribe_message(accounts))
+            subscribed.set()
+            logging.info("subscribed to confirmations for %s accounts", len(accounts))
+            receive_backlog(accounts)
+            last_refresh = time.time()
+
+            while True:
+                try:
+                    raw_message = ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    raw_message = None
+
+                if time.time() - last_refresh > ACCOUNT_REFRESH:
+                    # The lock goes with its connection, so make sure the connection is still there
+                    lock_db.ping()
+                    new_accounts = refresh_watched_accounts()
+                    if new_accounts:
+                        ws.send(update_message(new_accounts))
+                        receive_backlog(new_accounts)
+                    last_refresh = time.time()
+
+                if raw_message:
+                    handle_confirmation(json.loads(raw_message))
+        except TimeoutError:
+            # Another process is subscribed
+            continue
+        except Exception as e:
+            subscribed.clear()
+            logging.info("Confirmation subscription error, reconnecting: %s", e)
+            try:
+                if ws is not None:
+                    ws.close()
+                if lock_db is not None:
+                    modules.db.release_lock(lock_db)
+            except Exception:
+                pass
+            time.sleep(RECONNECT_DELAY)
+
+
+async def receive_account_blocks(account, blocks):
+    """
+    Receive the account's queued blocks one after the other, each building on the last, until none are left
+    """
+    while blocks:
+        try:
+            await modules.aionode.receive_block(account, blocks[0])
+        except Exception as e:
+            logging.info("Error receiving block %s for %s: %s", blocks[0], account, e)
+        finally:
+            blocks.popleft()
+            receive_queue.task_done()
+    del account_blocks[account]
+
+
+def queue_block(account, block):
+    """
+    Line the block up behind the account's other blocks on the receive loop.  Each account's blocks are received in
+    order, while different accounts are received concurrently.  A block already waiting for its account isn't queued
+    twice.
+    """
+    blocks = account_blocks.get(account)
+    if blocks is not None and block in blocks:
+        receive_queue.task_done()
+        return
+
+    if blocks is None:
+        blocks = account_blocks[account] = collections.deque([block])
+        task = receive_event_loop.create_task(receive_account_blocks(account, blocks))
+        receive_tasks.add(task)
+        task.add_done_callback(receive_tasks.discard)
+    else:
+        blocks.append(block)
+
+
+def receive_loop():
+    """
+    Hand blocks from receive_queue to the receive loop, which runs on a thread of its own
+    """
+    threading.Thread(target=receive_event_loop.run_forever, name='confirmation-receive-loop', daemon=True).start()
+    while True:
+        account, block = receive_queue.get()
+        receive_event_loop.call_soon_threadsafe(queue_block, account, block)
+
+
+def start_subscription(url=None):
+    """
+    Start the confirmation subscription and receive worker threads.  The url defaults to node_websocket from the
+    config, and can point at a stand-in server for testing.  Called once from the process that supervises the job
+    workers, not from every web process.
+    """
+    global subscription_thread, receive_thread, receive_event_loop
+    url = url or CONFIRMATION_WS
+    if not url:
+        return
+
+    # The subscription looks up backlogs on the receive loop, so that starts first
+    if receive_thread is None or not receive_thread.is_alive():
+        receive_event_loop = asyncio.new_event_loop()
+        receive_thread = threading.Thread(target=receive_loop, name='confirmation-receive', daemon=True)
+        receive_thread.start()
+    if subscription_thread is None or not subscription_thread.is_alive():
+        subscription_thread = threading.Thread(target=subscription_loop, args=(url,), name='confirmations',
+                                               daemon=True)
+        subscription_thread.start()
+
+
+def reset_after_fork():
+    """
+    The threads don't survive a fork, so a forked child is never subscribed itself
+    """
+    global subscription_thread, receive_thread, receive_event_loop, alive_check_lock, watched_accounts_lock
+    subscription_thread = None
+    receive_thread = None
+    receive_event_loop = None
+    account_blocks.clear()
+    receive_tasks.clear()
+    subscribed.clear()
+    alive_check_lock = threading.Lock()
+    alive_check['checked'] = 0
+    watched_accounts_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
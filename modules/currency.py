@@ -1,104 +1,155 @@
-import configparser
 import json
 import logging
 import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from decimal import Decimal
 
 import nano
 import requests
-import telegram
-import tweepy
-from TwitterAPI import TwitterAPI
 
+import modules.balances
+import modules.blocks
+import modules.confirmations
 import modules.db
+import modules.ledger
+import modules.node
+import modules.registry
 import modules.social
-
-# Set Log File
-logging.basicConfig(handlers=[logging.FileHandler('{}/webhooks.log'.format(os.getcwd()), 'a', 'utf-8')],
-                    level=logging.INFO)
+from modules.amount import RawAmount
 
 # Read config and parse constants
-config = configparser.ConfigParser()
-config.read('{}/webhookconfig.ini'.format(os.getcwd()))
+config = modules.registry.config
 
 # Constants
 WALLET = config.get('webhooks', 'wallet')
-NODE_IP = config.get('webhooks', 'node_ip')
 WORK_SERVER = config.get('webhooks', 'work_server')
 WORK_KEY = config.get('webhooks', 'work_key')
 RE_EMOJI = re.compile('[\U00010000-\U0010ffff\U000026A1]', flags=re.UNICODE)
-TELEGRAM_KEY = config.get('webhooks', 'telegram_key')
+STATS_REFRESH = config.getint('webhooks', 'stats_refresh', fallback=60)
 
-# Twitter API connection settings
-CONSUMER_KEY = config.get('webhooks', 'consumer_key')
-CONSUMER_SECRET = config.get('webhooks', 'consumer_secret')
-ACCESS_TOKEN = config.get('webhooks', 'access_token')
-ACCESS_TOKEN_SECRET = config.get('webhooks', 'access_token_secret')
+# Local block signing settings
+LOCAL_SIGNING = config.get('webhooks', 'signing_mode', fallback='node') == 'local'
+SIGNING_SEED = config.get('webhooks', 'signing_seed', fallback='')
+SIGNING_KEY_SCAN = config.getint('webhooks', 'signing_key_scan', fallback=10000)
+SIGNING_REPRESENTATIVE = config.get('webhooks', 'signing_representative', fallback='')
 
 # Connect to Nano node
-rpc = nano.rpc.Client(NODE_IP)
+rpc = modules.node.rpc
 
 # Connect to Telegram
-telegram_bot = telegram.Bot(token=TELEGRAM_KEY)
+telegram_bot = modules.registry.telegram_bot
 
 # Connect to Twitter
-auth = tweepy.OAuthHandler(CONSUMER_KEY, CONSUMER_SECRET)
-auth.set_access_token(ACCESS_TOKEN, ACCESS_TOKEN_SECRET)
-api = tweepy.API(auth)
+api = modules.registry.twitter_api
 
 # Secondary API for non-tweepy supported requests
-twitterAPI = TwitterAPI(CONSUMER_KEY, CONSUMER_SECRET, ACCESS_TOKEN, ACCESS_TOKEN_SECRET)
+twitterAPI = modules.registry.twitter_request_api
+
+# Node derived figures for the public pages, kept in memory by the stats refresh task
+network_stats = {'checked_blocks': None, 'updated': None}
+network_stats_lock = threading.Lock()
+network_stats_thread = None
+
+# Signing keys for our accounts, keyed by account without its prefix, and how many seed indexes have been derived.
+# The lock lets one thread at a time extend the scan.
+signing_keys = {}
+signing_keys_scanned = 0
+signing_keys_lock = threading.Lock()
+
+# Work generated ahead of time, keyed by the hash it was generated for
+work_cache = {}
+work_cache_lock = threading.Lock()
 
 
 def receive_pending(sender_account):
     """
-    Check to see if the account has any pending blocks and process them
+    Check to see if the account has any pending blocks and process them.  When the node confirmation subscription is
+    connected, incoming blocks are already received as they confirm, so no polling is done.
     """
+    if modules.confirmations.subscription_alive():
+        return
+
     try:
-        logging.info("{}: in receive pending".format(datetime.now()))
+        logging.info("in receive pending")
         pending_blocks = rpc.pending(account='{}'.format(sender_account))
-        logging.info("pending blocks: {}".format(pending_blocks))
+        logging.info("pending blocks: %s", pending_blocks)
         if len(pending_blocks) > 0:
             try:
                 for block in pending_blocks:
-                    work = get_pow(sender_account)
-                    if work == '':
-                        logging.info("{}: processing without pow".format(datetime.now()))
-                        receive_data = {'action': "receive", 'wallet': WALLET, 'account': sender_account,
-                                        'block': block}
-                    else:
-                        logging.info("{}: processing with pow".format(datetime.now()))
-                        receive_data = {'action': "receive", 'wallet': WALLET, 'account': sender_account,
-                                        'block': block, 'work': work}
-                    receive_json = json.dumps(receive_data)
-                    requests.post('{}'.format(NODE_IP), data=receive_json)
-                    logging.info("{}: block {} received".format(datetime.now(), block))
+                    receive_block(sender_account, block)
             except Exception as e:
-                logging.info("Exception: {}".format(e))
+                logging.info("Exception: %s", e)
                 raise e
     except Exception as e:
-        logging.info("Receive Pending Error: {}".format(e))
+        logging.info("Receive Pending Error: %s", e)
         raise e
 
     return
 
 
+def chain_lock_name(account):
+    """
+    Name of the lock held while a block is added to the account's chain, so locally signed sends and wallet receives
+    never build on the same frontier
+    """
+    return 'tx:{}'.format(account.split('_', 1)[-1])
+
+
+def receive_block(account, block):
+    """
+    Receive a single pending block into the provided account
+    """
+    lock = modules.db.get_lock(chain_lock_name(account)) if LOCAL_SIGNING else None
+    try:
+        work = get_pow(account)
+        if work == '':
+            logging.info("processing without pow")
+            receive_data = {'wallet': WALLET, 'account': account, 'block': block}
+        else:
+            logging.info("processing with pow")
+            receive_data = {'wallet': WALLET, 'account': account, 'block': block, 'work': work}
+        try:
+            rpc.call('receive', receive_data)
+            modules.balances.invalidate_balance(account)
+            logging.info("block %s received", block)
+        except nano.rpc.RPCException as e:
+            logging.info("block %s not received: %s", block, e)
+    finally:
+        if lock is not None:
+            modules.db.release_lock(lock)
+
+
 def get_pow(sender_account):
     """
     Retrieves the frontier (hash of previous transaction) of the provided account and generates work for the next block.
     """
-    logging.info("{}: in get_pow".format(datetime.now()))
+    logging.info("in get_pow")
     try:
         account_frontiers = rpc.accounts_frontiers(accounts=["{}".format(sender_account)])
         hash = account_frontiers[sender_account]
-        logging.info("{}: account: {} - frontier: {}".format(datetime.now(), sender_account, hash))
+        logging.info("account: %s - frontier: %s", sender_account, hash)
     except Exception as e:
-        logging.info("{}: Error checking frontier: {}".format(datetime.now(), e))
+        logging.info("Error checking frontier: %s", e)
         return ''
 
-    work = ''
+    return generate_work(hash)
+
+
+def generate_work(hash):
+    """
+    Return work for the provided block hash, from the work cache if it was generated ahead of time, otherwise from the
+    work server.
+    """
+    with work_cache_lock:
+        work = work_cache.pop(hash, '')
+    if work:
+        logging.info("Using cached work for %s", hash)
+        return work
+
     while work == '':
         try:
             work_data = {'hash': hash, 'key': WORK_KEY}
@@ -106,117 +157,490 @@ def get_pow(sender_account):
             r = requests.post('{}'.format(WORK_SERVER), data=json_request)
             rx = r.json()
             work = rx['work']
-            logging.info("{}: Work generated: {}".format(datetime.now(), work))
+            logging.info("Work generated: %s", work)
         except Exception as e:
-            logging.info("{}: ERROR GENERATING WORK: {}".format(datetime.now(), e))
+            logging.info("ERROR GENERATING WORK: %s", e)
             pass
 
     return work
 
 
+def precache_work(hash):
+    """
+    Generate work for the next block after hash in the background, so the account's next send doesn't wait on it.
+    """
+    def cache_work():
+        work = generate_work(hash)
+        with work_cache_lock:
+            work_cache[hash] = work
+
+    threading.Thread(target=cache_work, daemon=True).start()
+
+
+def get_signing_key(account):
+    """
+    Return the signing key for one of our accounts, deriving keys from the wallet seed until the account is found.
+    Derived keys are kept for the life of the process.
+    """
+    global signing_keys_scanned
+    account_key = account.split('_', 1)[-1]
+    key = signing_keys.get(account_key)
+    if key is None:
+        with signing_keys_lock:
+            # Another thread may have derived it while this one waited
+            key = signing_keys.get(account_key)
+            while key is None and signing_keys_scanned < SIGNING_KEY_SCAN:
+                new_key = modules.blocks.signing_key(modules.blocks.private_key_from_seed(SIGNING_SEED,
+                                                                                          signing_keys_scanned))
+                new_account = modules.blocks.account_from_public_key(modules.blocks.public_key(new_key))
+                signing_keys[new_account.split('_', 1)[-1]] = new_key
+                signing_keys_scanned += 1
+                key = signing_keys.get(account_key)
+
+    if key is None:
+        raise ValueError("No signing key found for account {}".format(account))
+
+    return key
+
+
+def reset_locks():
+    """
+    A forked child can't wait on a lock a thread of its parent held at the fork.  The stats thread didn't survive the
+    fork either, so it's started again by the next start_network_stats.
+    """
+    global signing_keys_lock, work_cache_lock, network_stats_lock, network_stats_thread
+    signing_keys_lock = threading.Lock()
+    work_cache_lock = threading.Lock()
+    network_stats_lock = threading.Lock()
+    network_stats_thread = None
+
+
+os.register_at_fork(after_in_child=reset_locks)
+
+
+def load_signing_keys():
+    """
+    Derive the signing keys for every account in the users table up front, so tips don't wait on the key scan.
+    """
+    if not LOCAL_SIGNING:
+        return
+
+    for row in modules.db.get_db_data("SELECT account FROM users"):
+        try:
+            get_signing_key(row[0])
+        except ValueError as e:
+            logging.info("%s", e)
+
+
+def load_signed_sends(send_ids):
+    """
+    Return {send_id: (block hash, block)} for the sends that were already signed, in the order they were signed
+    """
+    if not send_ids:
+        return {}
+    signed_call = ("SELECT send_id, block_hash, block FROM signed_sends WHERE send_id IN ({}) ORDER BY id"
+                   .format(', '.join(['%s'] * len(send_ids))))
+
+    return {row[0]: (row[1], json.loads(row[2])) for row in modules.db.get_db_data(signed_call, send_ids)}
+
+
+def store_signed_sends(source, signed):
+    """
+    Store signed blocks, with their work, under their send IDs in one transaction.  signed is a list of
+    (send_id, block hash, block).  Sends without an ID aren't stored.
+    """
+    rows = [(send_id, source, block_hash, json.dumps(block)) for send_id, block_hash, block in signed
+            if send_id is not None]
+    if not rows:
+        return
+    db = modules.db.get_connection()
+    db_cursor = db.cursor()
+    try:
+        db_cursor.executemany("INSERT INTO signed_sends (send_id, source_account, block_hash, block) "
+                              "VALUES (%s, %s, %s, %s)", rows)
+        db.commit()
+    finally:
+        db_cursor.close()
+        db.close()
+
+
+def delete_signed_sends(send_ids):
+    delete_call = "DELETE FROM signed_sends WHERE send_id IN ({})".format(', '.join(['%s'] * len(send_ids)))
+    modules.db.set_db_data(delete_call, send_ids)
+
+
+def process_signed_block(source, block_hash, block):
+    """
+    Submit a send signed by an earlier attempt again.  Returns False if the node refused it because the account's chain
+    moved on without it, e.g. a receive was added on the frontier it was built on, so it can never be published.
+    """
+    try:
+        process_block(block_hash, block)
+        return True
+    except nano.rpc.RPCException as e:
+        try:
+            rpc.call('block_info', {'hash': block_hash, 'json_block': 'true'})
+            logging.info("send %s was already published", block_hash)
+            return True
+        except nano.rpc.RPCException:
+            pass
+        frontier = rpc.call('account_info', {'account': source})['frontier']
+        if block['previous'] == frontier:
+            raise e
+
+        logging.info("signed send %s no longer fits the chain of %s: %s", block_hash, source, e)
+        return False
+
+
+def process_block(block_hash, block):
+    """
+    Publish a signed send block.  A block the node already has was published by an earlier attempt, which is as good.
+    """
+    try:
+        rpc.call('process', {'subtype': 'send', 'block': json.dumps(block)})
+    except nano.rpc.RPCException as e:
+        if 'Old block' not in '{}'.format(e):
+            raise e
+        logging.info("send %s was already published", block_hash)
+
+
+def send_blocks(source, sends):
+    """
+    Build, sign and publish a chain of send blocks from the source account without using the node wallet.  sends is a
+    list of (send_id, destination, RawAmount).  Work for every block is generated in parallel, and the signed blocks
+    are stored under their send IDs before any is submitted with process.  A send that was signed by an earlier
+    attempt is submitted again as it was signed, never built anew, so a retry can't send twice.  Returns the hashes
+    of the published blocks, in order.
+    """
+    key = get_signing_key(source)
+    lock = modules.db.get_lock(chain_lock_name(source))
+    try:
+        signed = load_signed_sends([send_id for send_id, destination, amount in sends if send_id is not None])
+        # Blocks signed earlier go first, in the order they were chained, as the new blocks are built on top of them.
+        # Ones the chain moved on from were never published, so they're signed again on the current frontier.
+        stale = [send_id for send_id, (block_hash, block) in signed.items()
+                 if not process_signed_block(source, block_hash, block)]
+        if stale:
+            delete_signed_sends(stale)
+            for send_id in stale:
+                del signed[send_id]
+        published = {index: signed[send[0]][0] for index, send in enumerate(sends) if send[0] in signed}
+        new_indexes = [index for index in range(len(sends)) if index not in published]
+
+        if new_indexes:
+            account_info = rpc.call('account_info', {'account': source, 'representative': 'true'})
+            balance = RawAmount(int(account_info['balance']))
+            total = RawAmount(sum(sends[index][2] for index in new_indexes))
+            if total > balance:
+                raise ValueError("Balance of {} is less than {}".format(balance.to_nano(), total.to_nano()))
+
+            representative = SIGNING_REPRESENTATIVE or account_info['representative']
+            previous = account_info['frontier']
+            blocks = []
+            for index in new_indexes:
+                send_id, destination, amount = sends[index]
+                balance -= amount
+                block_hash, block = modules.blocks.build_send_block(key, source, previous, representative, balance,
+                                                                    destination)
+                blocks.append((index, previous, block_hash, block))
+                previous = block_hash
+
+            with ThreadPoolExecutor(max_workers=len(blocks)) as executor:
+                works = list(executor.map(generate_work, [block[1] for block in blocks]))
+            for block, work in zip(blocks, works):
+                block[3]['work'] = work
+            store_signed_sends(source, [(sends[index][0], block_hash, block)
+                                        for index, previous, block_hash, block in blocks])
+
+            for index, previous, block_hash, block in blocks:
+                try:
+                    process_block(block_hash, block)
+                except Exception as e:
+                    logging.info("Error publishing send %s, stopping the batch: %s", block_hash, e)
+                    if not published:
+                        raise e
+                    break
+                logging.info("published send %s from %s to %s", block_hash, source, block['link_as_account'])
+                published[index] = block_hash
+    finally:
+        modules.db.release_lock(lock)
+
+    send_hashes = []
+    for index in range(len(sends)):
+        if index not in published:
+            break
+        send_hashes.append(published[index])
+
+    modules.balances.invalidate_balance(source)
+    precache_work(send_hashes[-1])
+
+    return send_hashes
+
+
+def check_self_tip(message, users_to_tip, tip_index):
+    """
+    Reply to the sender and return True if they tried to tip themself
+    """
+    if str(users_to_tip[tip_index]['receiver_id']) == str(message['sender_id']):
+        self_tip_text = "Self tipping is not allowed.  Please use this bot to spread the $NANO to other Twitter users!"
+        modules.social.send_reply(message, self_tip_text)
+
+        logging.info("User tried to tip themself")
+        return True
+
+    return False
+
+
+def set_receiver_account(message, users_to_tip, tip_index):
+    """
+    Look up the receiver's account, creating one for them if they don't have one yet
+    """
+    # Check if the receiver has an account
+    receiver_account_get = ("SELECT account, register FROM users where user_id = {} and users.system = '{}'"
+                            .format(int(users_to_tip[tip_index]['receiver_id']), message['system']))
+    receiver_account_data = modules.db.get_db_data(receiver_account_get)
+
+    # If they don't, create an account for them
+    if not receiver_account_data:
+        users_to_tip[tip_index]['receiver_account'] = rpc.account_create(wallet="{}".format(WALLET), work=True)
+        users_to_tip[tip_index]['receiver_register'] = 0
+        create_receiver_account = ("INSERT INTO users (user_id, system, user_name, account, register) "
+                                   "VALUES(%s, %s, %s, %s, 0)")
+        create_receiver_account_values = [users_to_tip[tip_index]['receiver_id'], message['system'],
+                                           users_to_tip[tip_index]['receiver_screen_name'],
+                                           users_to_tip[tip_index]['receiver_account']]
+        modules.db.set_db_data(create_receiver_account, create_receiver_account_values)
+        logging.info("Sender sent to a new receiving account.  Created  account %s",
+                     users_to_tip[tip_index]['receiver_account'])
+
+    else:
+        users_to_tip[tip_index]['receiver_account'] = receiver_account_data[0][0]
+        users_to_tip[tip_index]['receiver_register'] = receiver_account_data[0][1]
+
+
 def send_tip(message, users_to_tip, tip_index):
     """
-    Process tip for specified user
+    Send the tip for the specified user through the node wallet
+    """
+    work = get_pow(message['sender_account'])
+    logging.info("Sending Tip:")
+    logging.info("From: %s", message['sender_account'])
+    logging.info("To: %s", users_to_tip[tip_index]['receiver_account'])
+    logging.info("amount: %s", int(message['tip_amount']))
+    logging.info("id: %s", message['tip_id'])
+    logging.info("work: %s", work)
+    if work == '':
+        logging.info("processed without work")
+        message['send_hash'] = rpc.send(wallet="{}".format(WALLET), source="{}".format(message['sender_account']),
+                                        destination="{}".format(users_to_tip[tip_index]['receiver_account']),
+                                        amount="{}".format(int(message['tip_amount'])),
+                                        id="tip-{}".format(message['tip_id']))
+    else:
+        logging.info("processed with work: %s", work)
+        message['send_hash'] = rpc.send(wallet="{}".format(WALLET), source="{}".format(message['sender_account']),
+                                        destination="{}".format(users_to_tip[tip_index]['receiver_account']),
+                                        amount="{}".format(int(message['tip_amount'])),
+                                        work=work,
+                                        id="tip-{}".format(message['tip_id']))
+    modules.balances.invalidate_balance(message['sender_account'])
+
+
+def find_unsent_tips(message, users_to_tip):
+    """
+    Mark the tips a retried job already recorded in the tip list with tip_recorded, so only the rest are sent, and
+    total up the amount still to send.  Returns the number of tips still to send.
+    """
+    recorded_call = "SELECT tx_id FROM tip_list WHERE dm_id = %s AND tip_list.system = %s"
+    recorded = set(row[0] for row in modules.db.get_db_data(recorded_call, [int(message['id']), message['system']]))
+    unsent = 0
+    for t_index in range(0, len(users_to_tip)):
+        users_to_tip[t_index]['tip_recorded'] = "{}{}".format(message['id'], t_index) in recorded
+        if not users_to_tip[t_index]['tip_recorded']:
+            unsent += 1
+    if recorded:
+        logging.info("%s of %s tips for %s were already sent", len(users_to_tip) - unsent, len(users_to_tip),
+                     message['id'])
+        message['total_tip_amount'] = message['tip_amount'] * unsent
+
+    return unsent
+
+
+def send_tips(message, users_to_tip):
+    """
+    Send the tip to every user in users_to_tip, then let the receivers know.  With local signing, the blocks for a
+    multi tip are built as one chain and submitted as a single batch.  In ledger mode, tips to registered users are
+    moved in the ledger instead.
     """
     bot_status = config.get('webhooks', 'bot_status')
     if bot_status == 'maintenance':
         modules.social.send_dm(message['sender_id'],
                 "The tip bot is in maintenance.  Check @NanoTipBot on Twitter for more information.", message['system'])
         return
-    else:
-        logging.info("{}: sending tip to {}".format(datetime.now(), users_to_tip[tip_index]['receiver_screen_name']))
-        if str(users_to_tip[tip_index]['receiver_id']) == str(message['sender_id']):
-            self_tip_text = "Self tipping is not allowed.  Please use this bot to spread the $NANO to other Twitter users!"
-            modules.social.send_reply(message, self_tip_text)
-
-            logging.info("{}: User tried to tip themself").format(datetime.now())
-            return
-
-        # Check if the receiver has an account
-        receiver_account_get = ("SELECT account FROM users where user_id = {} and users.system = '{}'"
-                                .format(int(users_to_tip[tip_index]['receiver_id']), message['system']))
-        receiver_account_data = modules.db.get_db_data(receiver_account_get)
-
-        # If they don't, create an account for them
-        if not receiver_account_data:
-            users_to_tip[tip_index]['receiver_account'] = rpc.account_create(wallet="{}".format(WALLET), work=True)
-            create_receiver_account = ("INSERT INTO users (user_id, system, user_name, account, register) "
-                                       "VALUES(%s, %s, %s, %s, 0)")
-            create_receiver_account_values = [users_to_tip[tip_index]['receiver_id'], message['system'],
-                                               users_to_tip[tip_index]['receiver_screen_name'],
-                                               users_to_tip[tip_index]['receiver_account']]
-            modules.db.set_db_data(create_receiver_account, create_receiver_account_values)
-            logging.info("{}: Sender sent to a new receiving account.  Created  account {}"
-                         .format(datetime.now(), users_to_tip[tip_index]['receiver_account']))
 
+    tip_indexes = []
+    for t_index in range(0, len(users_to_tip)):
+        if users_to_tip[t_index].get('tip_recorded'):
+            continue
+        logging.info("sending tip to %s", users_to_tip[t_index]['receiver_screen_name'])
+        if check_self_tip(message, users_to_tip, t_index):
+            continue
+        set_receiver_account(message, users_to_tip, t_index)
+        tip_indexes.append(t_index)
+
+    sent_indexes = []
+    try:
+        if modules.ledger.LEDGER_MODE:
+            send_ledger_tips(message, users_to_tip, tip_indexes, sent_indexes)
+        elif LOCAL_SIGNING and tip_indexes:
+            send_hashes = send_blocks(message['sender_account'],
+                                      [("tip-{}{}".format(message['id'], t_index),
+                                        users_to_tip[t_index]['receiver_account'], message['tip_amount'])
+                                       for t_index in tip_indexes])
+            for t_index, send_hash in zip(tip_indexes, send_hashes):
+                message['tip_id'] = "{}{}".format(message['id'], t_index)
+                message['send_hash'] = send_hash
+                record_tip(message, users_to_tip, t_index)
+                sent_indexes.append(t_index)
+            if len(send_hashes) < len(tip_indexes):
+                # The job is retried, and the retry publishes only the tips that weren't recorded
+                raise RuntimeError("Only {} of {} tips were published".format(len(send_hashes), len(tip_indexes)))
         else:
-            users_to_tip[tip_index]['receiver_account'] = receiver_account_data[0][0]
-
-        # Send the tip
-        message['tip_id'] = "{}{}".format(message['id'], tip_index)
-
-        work = get_pow(message['sender_account'])
-        logging.info("Sending Tip:")
-        logging.info("From: {}".format(message['sender_account']))
-        logging.info("To: {}".format(users_to_tip[tip_index]['receiver_account']))
-        logging.info("amount: {:f}".format(message['tip_amount_raw']))
-        logging.info("id: {}".format(message['tip_id']))
-        logging.info("work: {}".format(work))
-        if work == '':
-            logging.info("{}: processed without work".format(datetime.now()))
-            message['send_hash'] = rpc.send(wallet="{}".format(WALLET), source="{}".format(message['sender_account']),
-                                            destination="{}".format(users_to_tip[tip_index]['receiver_account']),
-                                            amount="{}".format(int(message['tip_amount_raw'])),
-                                            id="tip-{}".format(message['tip_id']))
-        else:
-            logging.info("{}: processed with work: {}".format(datetime.now(), work))
-            message['send_hash'] = rpc.send(wallet="{}".format(WALLET), source="{}".format(message['sender_account']),
-                                            destination="{}".format(users_to_tip[tip_index]['receiver_account']),
-                                            amount="{}".format(int(message['tip_amount_raw'])),
-                                            work=work,
-                                            id="tip-{}".format(message['tip_id']))
-        # Update the DB
-        message['text'] = strip_emoji(message['text'])
-        modules.db.set_db_data_tip(message, users_to_tip, tip_index)
-
-        # Get receiver's new balance
-        try:
-            logging.info("{}: Checking to receive new tip")
-
-            receive_pending(users_to_tip[tip_index]['receiver_account'])
-            balance_return = rpc.account_balance(account="{}".format(users_to_tip[tip_index]['receiver_account']))
-            users_to_tip[tip_index]['balance'] = balance_return['balance'] / 1000000000000000000000000000000
-
-            # create a string to remove scientific notation from small decimal tips
-            if str(users_to_tip[tip_index]['balance'])[0] == ".":
-                users_to_tip[tip_index]['balance'] = "0{}".format(str(users_to_tip[tip_index]['balance']))
-            else:
-                users_to_tip[tip_index]['balance'] = str(users_to_tip[tip_index]['balance'])
-
-            # Send a DM to the receiver
-            receiver_tip_text = (
-                "@{} just sent you a {} NANO tip! Reply to this DM with !balance to see your new balance.  If you have not "
-                "registered an account, send a reply with !register to get started, or !help to see a list of "
-                "commands!  Learn more about NANO at https://nano.org/".format(message['sender_screen_name'],
-                                                                               message['tip_amount_text'],
-                                                                               users_to_tip[tip_index]['balance']))
-            modules.social.send_dm(users_to_tip[tip_index]['receiver_id'], receiver_tip_text, message['system'])
+            for t_index in tip_indexes:
+                message['tip_id'] = "{}{}".format(message['id'], t_index)
+                send_tip(message, users_to_tip, t_index)
+                record_tip(message, users_to_tip, t_index)
+                sent_indexes.append(t_index)
+    finally:
+        notify_receivers(message, users_to_tip, sent_indexes)
 
-        except Exception as e:
-            logging.info("{}: ERROR IN RECEIVING NEW TIP - POSSIBLE NEW ACCOUNT NOT REGISTERED WITH DPOW: {}"
-                         .format(datetime.now(), e))
 
-        logging.info(
-            "{}: tip sent to {} via hash {}".format(datetime.now(), users_to_tip[tip_index]['receiver_screen_name'],
-                                                    message['send_hash']))
+def send_ledger_tips(message, users_to_tip, tip_indexes, sent_indexes):
+    """
+    Move the tips to registered users in one ledger transaction and send the rest on chain, so unregistered users'
+    tips can still be returned by tipcheck.  Sent indexes are added to sent_indexes as they complete.
+    """
+    ledger_indexes = [t_index for t_index in tip_indexes if users_to_tip[t_index]['receiver_register'] == 1]
+    if ledger_indexes:
+        transfers = [("tip-{}{}".format(message['id'], t_index), users_to_tip[t_index]['receiver_account'],
+                      message['tip_amount']) for t_index in ledger_indexes]
+        # A retried job may have made the transfers without recording all of the tips
+        transferred = modules.ledger.transferred([transfer[0] for transfer in transfers])
+        transfers = [transfer for transfer in transfers if transfer[0] not in transferred]
+        if transfers:
+            modules.ledger.transfer(message['sender_account'], transfers)
+        for t_index in ledger_indexes:
+            message['tip_id'] = "{}{}".format(message['id'], t_index)
+            message['send_hash'] = None
+            record_tip(message, users_to_tip, t_index)
+            sent_indexes.append(t_index)
+
+    for t_index in tip_indexes:
+        if t_index in ledger_indexes:
+            continue
+        message['tip_id'] = "{}{}".format(message['id'], t_index)
+        message['send_hash'] = modules.ledger.send(message['sender_account'], users_to_tip[t_index]['receiver_account'],
+                                                   message['tip_amount'], "tip-{}".format(message['tip_id']))
+        record_tip(message, users_to_tip, t_index)
+        sent_indexes.append(t_index)
+
+
+def record_tip(message, users_to_tip, tip_index):
+    """
+    Record a sent tip in the DB and receive it into the receiver's account
+    """
+    users_to_tip[tip_index]['send_hash'] = message['send_hash']
+
+    # Update the DB
+    message['text'] = strip_emoji(message['text'])
+    modules.db.set_db_data_tip(message, users_to_tip, tip_index)
+    modules.balances.invalidate_balance(users_to_tip[tip_index]['receiver_account'])
+    if message['send_hash'] is None:
+        logging.info("tip moved to %s in the ledger", users_to_tip[tip_index]['receiver_screen_name'])
+        return
+
+    try:
+        logging.info("Checking to receive new tip")
+        receive_pending(users_to_tip[tip_index]['receiver_account'])
+    except Exception as e:
+        logging.info("ERROR IN RECEIVING NEW TIP - POSSIBLE NEW ACCOUNT NOT REGISTERED WITH DPOW: %s", e)
+
+    logging.info("tip sent to %s via hash %s", users_to_tip[tip_index]['receiver_screen_name'], message['send_hash'])
+
+
+def notify_receivers(message, users_to_tip, tip_indexes):
+    """
+    DM each receiver about their tip.  Their new balances are looked up together in one call.
+    """
+    if not tip_indexes:
+        return
+
+    try:
+        balances = modules.balances.get_balances([users_to_tip[t_index]['receiver_account']
+                                                  for t_index in tip_indexes])
+    except Exception as e:
+        logging.info("Error retrieving receiver balances: %s", e)
+        balances = {}
+
+    for t_index in tip_indexes:
+        receiver_balance = balances.get(users_to_tip[t_index]['receiver_account'])
+        if receiver_balance is not None:
+            users_to_tip[t_index]['balance'] = receiver_balance['balance'].to_nano()
+
+        # Send a DM to the receiver
+        receiver_tip_text = (
+            "@{} just sent you a {} NANO tip! Reply to this DM with !balance to see your new balance.  If you have not "
+            "registered an account, send a reply with !register to get started, or !help to see a list of "
+            "commands!  Learn more about NANO at https://nano.org/".format(message['sender_screen_name'],
+                                                                           message['tip_amount_text']))
+        modules.social.send_dm(users_to_tip[t_index]['receiver_id'], receiver_tip_text, message['system'])
+
+
+def refresh_network_stats():
+    """
+    Pull the current block count from the node into the stats cache.  If the node is busy or unreachable the last
+    value is kept.
+    """
+    try:
+        block_count_get = rpc.block_count()
+    except Exception as e:
+        logging.info("Error refreshing network stats, keeping last value: %s", e)
+        return False
+
+    with network_stats_lock:
+        network_stats['checked_blocks'] = int(block_count_get['count'])
+        network_stats['updated'] = datetime.now()
+
+    return True
+
+
+def network_stats_loop():
+    while True:
+        refresh_network_stats()
+        time.sleep(STATS_REFRESH)
+
+
+def start_network_stats():
+    """
+    Start the background task that refreshes the stats cache every STATS_REFRESH seconds.
+    """
+    global network_stats_thread
+    if network_stats_thread is None or not network_stats_thread.is_alive():
+        network_stats_thread = threading.Thread(target=network_stats_loop, name='network-stats', daemon=True)
+        network_stats_thread.start()
 
 
 def get_energy(nano_energy):
     """
-    Calculate the total energy used by Nano at time of loading the webpage.
+    Calculate the total energy used by Nano from the cached block count.
     """
-    block_count_get = rpc.block_count()
-    checked_blocks = block_count_get['count']
+    with network_stats_lock:
+        checked_blocks = network_stats['checked_blocks']
+
+    if checked_blocks is None:
+        # The refresh task hasn't completed a pass yet, so populate the cache inline once.
+        refresh_network_stats()
+        with network_stats_lock:
+            checked_blocks = network_stats['checked_blocks'] or 0
 
     total_energy = checked_blocks * nano_energy
 
@@ -227,7 +651,7 @@ def strip_emoji(text):
     """
     Remove Emojis from tweet text to prevent issues with logging
     """
-    logging.info('{}: removing emojis'.format(datetime.now()))
+    logging.info("removing emojis")
     text = str(text)
     return RE_EMOJI.sub(r'', text)
 
@@ -261,8 +685,8 @@ def get_fiat_conversion(fiat, crypto_currency, fiat_amount):
 
         return final_convert
     except Exception as e:
-        logging.info("{}: Exception converting fiat price to crypto price".format(datetime.now()))
-        logging.info("{}: {}".format(datetime.now(), e))
+        logging.info("Exception converting fiat price to crypto price")
+        logging.info("%s", e)
         raise e
 
 
@@ -278,6 +702,6 @@ def get_fiat_price(fiat, crypto_currency):
 
         return price
     except Exception as e:
-        logging.info("{}: Exception converting fiat price to crypto price".format(datetime.now()))
-        logging.info("{}: {}".format(datetime.now(), e))
+        logging.info("Exception converting fiat price to crypto price")
+        logging.info("%s", e)
         raise e
@@ -1,18 +1,11 @@
-import configparser
 import logging
-import os
-from datetime import datetime
-from decimal import *
 
 import MySQLdb
 
-# Set Log File
-logging.basicConfig(handlers=[logging.FileHandler('{}/webhooks.log'.format(os.getcwd()), 'a', 'utf-8')],
-                    level=logging.INFO)
+import modules.registry
 
 # Read config and parse constants
-config = configparser.ConfigParser()
-config.read('{}/webhookconfig.ini'.format(os.getcwd()))
+config = modules.registry.config
 
 # DB connection settings
 DB_HOST = config.get('webhooks', 'host')
@@ -20,6 +13,14 @@ DB_USER = config.get('webhooks', 'user')
 DB_PW = config.get('webhooks', 'password')
 DB_SCHEMA = config.get('webhooks', 'schema')
 
+# (table, index, columns) for secondary indexes.  InnoDB appends the primary key to each, so the tip_list indexes
+# also order tips with the same timestamp by (dm_id, sender_id, receiver_id) for the tip feed.
+TABLE_INDEXES = [
+    ('tip_list', 'processed_timestamp_idx', '`processed`, `timestamp`'),
+    ('tip_list', 'sender_timestamp_idx', '`sender_id`, `timestamp`'),
+    ('tip_list', 'receiver_timestamp_idx', '`receiver_id`, `timestamp`')
+]
+
 
 def db_init():
     if not check_db_exist():
@@ -61,6 +62,17 @@ def check_table_exists(table_name):
     return result
 
 
+def check_index_exists(table_name, index_name):
+    db = MySQLdb.connect(host=DB_HOST, port=3306, user=DB_USER, passwd=DB_PW, db=DB_SCHEMA, use_unicode=True,
+                         charset="utf8mb4")
+    db_cursor = db.cursor()
+    db_cursor.execute("SHOW INDEX FROM `{}` WHERE Key_name = %s".format(table_name), (index_name,))
+    result = db_cursor.fetchall()
+    db_cursor.close()
+    db.close()
+    return len(result) > 0
+
+
 def create_tables():
     db = MySQLdb.connect(host=DB_HOST, port=3306, user=DB_USER, passwd=DB_PW, db=DB_SCHEMA, use_unicode=True,
                          charset="utf8mb4")
@@ -84,8 +96,7 @@ def create_tables():
             """
 
             db_cursor.execute(sql)
-            logging.info("Checking if users table was created: {}".format(
-                check_table_exists('users')))
+            logging.info("Checking if users table was created: %s", check_table_exists('users'))
 
         check_exists = check_table_exists('telegram_chat_members')
         if not check_exists:
@@ -101,8 +112,8 @@ def create_tables():
             """
 
             db_cursor.execute(sql)
-            logging.info("Checking if telegram_chat_members table was created: {}".format(
-                check_table_exists('telegram_chat_members')))
+            logging.info("Checking if telegram_chat_members table was created: %s",
+                         check_table_exists('telegram_chat_members'))
 
         check_exists = check_table_exists('tip_list')
         if not check_exists:
@@ -123,8 +134,7 @@ def create_tables():
             """
 
             db_cursor.execute(sql)
-            logging.info("Checking if tip_list table was created: {}".format(
-                check_table_exists('tip_list')))
+            logging.info("Checking if tip_list table was created: %s", check_table_exists('tip_list'))
 
         check_exists = check_table_exists('dm_list')
         if not check_exists:
@@ -146,24 +156,217 @@ def create_tables():
             ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
             """
             db_cursor.execute(sql)
-            logging.info("Checking if tip_list table was created: {}".format(
-                check_table_exists('tip_list')))
+            logging.info("Checking if tip_list table was created: %s", check_table_exists('tip_list'))
+
+        check_exists = check_table_exists('ledger_balances')
+        if not check_exists:
+            # create ledger_balances table
+            sql = """
+            CREATE TABLE IF NOT EXISTS `ledger_balances` (
+              `account` varchar(100) NOT NULL,
+              `unsettled_raw` decimal(39,0) NOT NULL DEFAULT '0',
+              `updated_ts` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+              PRIMARY KEY (`account`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """
+            db_cursor.execute(sql)
+            logging.info("Checking if ledger_balances table was created: %s", check_table_exists('ledger_balances'))
+
+        check_exists = check_table_exists('ledger_transfers')
+        if not check_exists:
+            # create ledger_transfers table
+            sql = """
+            CREATE TABLE IF NOT EXISTS `ledger_transfers` (
+              `tip_id` varchar(100) NOT NULL,
+              `sender_account` varchar(100) NOT NULL,
+              `receiver_account` varchar(100) NOT NULL,
+              `amount_raw` decimal(39,0) NOT NULL,
+              `timestamp` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+              PRIMARY KEY (`tip_id`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """
+            db_cursor.execute(sql)
+            logging.info("Checking if ledger_transfers table was created: %s", check_table_exists('ledger_transfers'))
+
+        check_exists = check_table_exists('ledger_settlements')
+        if not check_exists:
+            # create ledger_settlements table
+            sql = """
+            CREATE TABLE IF NOT EXISTS `ledger_settlements` (
+              `id` bigint(255) NOT NULL AUTO_INCREMENT,
+              `source_account` varchar(100) NOT NULL,
+              `destination_account` varchar(100) NOT NULL,
+              `amount_raw` decimal(39,0) NOT NULL,
+              `send_hash` varchar(64) DEFAULT NULL,
+              `settled` tinyint(1) NOT NULL DEFAULT '0',
+              `timestamp` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+              PRIMARY KEY (`id`),
+              KEY `settled_idx` (`settled`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """
+            db_cursor.execute(sql)
+            logging.info("Checking if ledger_settlements table was created: %s",
+                         check_table_exists('ledger_settlements'))
+
+        check_exists = check_table_exists('jobs')
+        if not check_exists:
+            # create jobs table
+            sql = """
+            CREATE TABLE IF NOT EXISTS `jobs` (
+              `id` bigint(255) NOT NULL AUTO_INCREMENT,
+              `job_type` varchar(45) NOT NULL,
+              `lane` varchar(20) NOT NULL DEFAULT 'notification',
+              `payload` mediumtext NOT NULL,
+              `status` tinyint(1) NOT NULL DEFAULT '0',
+              `attempts` int(11) NOT NULL DEFAULT '0',
+              `max_attempts` int(11) NOT NULL DEFAULT '5',
+              `available_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+              `locked_until` timestamp NULL DEFAULT NULL,
+              `claimed_ts` timestamp NULL DEFAULT NULL,
+              `claim_id` varchar(32) DEFAULT NULL,
+              `last_error` text DEFAULT NULL,
+              `created_ts` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+              `updated_ts` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+              PRIMARY KEY (`id`),
+              KEY `lane_status_available_idx` (`lane`, `status`, `available_at`),
+              KEY `claim_id_idx` (`claim_id`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """
+            db_cursor.execute(sql)
+            logging.info("Checking if jobs table was created: %s", check_table_exists('jobs'))
+
+        check_exists = check_table_exists('webhook_deliveries')
+        if not check_exists:
+            # create webhook_deliveries table
+            sql = """
+            CREATE TABLE IF NOT EXISTS `webhook_deliveries` (
+              `delivery_key` varchar(64) NOT NULL,
+              `created_ts` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+              PRIMARY KEY (`delivery_key`),
+              KEY `created_ts_idx` (`created_ts`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """
+            db_cursor.execute(sql)
+            logging.info("Checking if webhook_deliveries table was created: %s",
+                         check_table_exists('webhook_deliveries'))
+
+        check_exists = check_table_exists('media_cache')
+        if not check_exists:
+            # create media_cache table
+            sql = """
+            CREATE TABLE IF NOT EXISTS `media_cache` (
+              `media_key` varchar(64) NOT NULL,
+              `media_id` varchar(32) NOT NULL,
+              `expires_ts` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+              PRIMARY KEY (`media_key`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """
+            db_cursor.execute(sql)
+            logging.info("Checking if media_cache table was created: %s", check_table_exists('media_cache'))
+
+        check_exists = check_table_exists('paper_tip_sheets')
+        if not check_exists:
+            # create paper_tip_sheets table
+            sql = """
+            CREATE TABLE IF NOT EXISTS `paper_tip_sheets` (
+              `sheet_id` varchar(32) NOT NULL,
+              `source_account` varchar(100) NOT NULL,
+              `fiat` varchar(3) NOT NULL,
+              `fiat_amount` decimal(10,2) NOT NULL,
+              `nano_amount` decimal(20,6) NOT NULL,
+              `nano_price` decimal(20,8) NOT NULL,
+              `tip_count` int NOT NULL,
+              `created_ts` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+              `expires_ts` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+              PRIMARY KEY (`sheet_id`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """
+            db_cursor.execute(sql)
+            logging.info("Checking if paper_tip_sheets table was created: %s", check_table_exists('paper_tip_sheets'))
+
+        check_exists = check_table_exists('paper_tips')
+        if not check_exists:
+            # create paper_tips table
+            sql = """
+            CREATE TABLE IF NOT EXISTS `paper_tips` (
+              `claim_code` varchar(32) NOT NULL,
+              `sheet_id` varchar(32) NOT NULL,
+              `position` int NOT NULL,
+              `account` varchar(100) NOT NULL,
+              `amount_raw` decimal(39,0) NOT NULL,
+              `send_hash` varchar(64) DEFAULT NULL,
+              `claimed` tinyint(1) NOT NULL DEFAULT '0',
+              PRIMARY KEY (`claim_code`),
+              UNIQUE KEY `sheet_position_UNIQUE` (`sheet_id`, `position`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """
+            db_cursor.execute(sql)
+            logging.info("Checking if paper_tips table was created: %s", check_table_exists('paper_tips'))
+
+        check_exists = check_table_exists('signed_sends')
+        if not check_exists:
+            # create signed_sends table
+            sql = """
+            CREATE TABLE IF NOT EXISTS `signed_sends` (
+              `id` bigint(255) NOT NULL AUTO_INCREMENT,
+              `send_id` varchar(100) NOT NULL,
+              `source_account` varchar(100) NOT NULL,
+              `block_hash` varchar(64) NOT NULL,
+              `block` text NOT NULL,
+              `timestamp` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+              PRIMARY KEY (`id`),
+              UNIQUE KEY `send_id_UNIQUE` (`send_id`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """
+            db_cursor.execute(sql)
+            logging.info("Checking if signed_sends table was created: %s", check_table_exists('signed_sends'))
+
+        check_exists = check_table_exists('command_sends')
+        if not check_exists:
+            # create command_sends table
+            sql = """
+            CREATE TABLE IF NOT EXISTS `command_sends` (
+              `send_id` varchar(100) NOT NULL,
+              `source_account` varchar(100) NOT NULL,
+              `destination_account` varchar(100) NOT NULL,
+              `amount_raw` decimal(39,0) NOT NULL,
+              `send_hash` varchar(64) DEFAULT NULL,
+              `timestamp` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+              PRIMARY KEY (`send_id`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """
+            db_cursor.execute(sql)
+            logging.info("Checking if command_sends table was created: %s", check_table_exists('command_sends'))
+
+        # Indexes added after the tables were first created, so they're checked for on existing databases too
+        for table_name, index_name, columns in TABLE_INDEXES:
+            if not check_index_exists(table_name, index_name):
+                db_cursor.execute("ALTER TABLE `{}` ADD INDEX `{}` ({})".format(table_name, index_name, columns))
+                logging.info("Added index %s to %s", index_name, table_name)
 
         db.commit()
         db_cursor.close()
         db.close()
     except Exception as e:
-            logging.info("Error creating tables for DB: {}".format(e))
+            logging.info("Error creating tables for DB: %s", e)
 
 
-def get_db_data(db_call):
+def get_connection():
+    """
+    Open a connection for callers that run several statements in one transaction
+    """
+    return MySQLdb.connect(host=DB_HOST, port=3306, user=DB_USER, passwd=DB_PW, db=DB_SCHEMA, use_unicode=True,
+                           charset="utf8mb4")
+
+
+def get_db_data(db_call, values=None):
     """
     Retrieve data from DB
     """
     db = MySQLdb.connect(host=DB_HOST, port=3306, user=DB_USER, passwd=DB_PW, db=DB_SCHEMA, use_unicode=True,
                          charset="utf8mb4")
     db_cursor = db.cursor()
-    db_cursor.execute(db_call)
+    db_cursor.execute(db_call, values)
     db_data = db_cursor.fetchall()
     db_cursor.close()
     db.close()
@@ -176,27 +379,55 @@ def set_db_data(db_call, values):
     """
     db = MySQLdb.connect(host=DB_HOST, port=3306, user=DB_USER, passwd=DB_PW, db=DB_SCHEMA, use_unicode=True,
                          charset="utf8mb4")
-    logging.info("db call: {}".format(db_call))
-    logging.info("values: {}".format(values))
+    logging.debug("db call: %s values: %s", db_call, values)
     try:
         db_cursor = db.cursor()
         db_cursor.execute(db_call, values)
         db.commit()
         db_cursor.close()
         db.close()
-        logging.info("{}: record inserted into DB".format(datetime.now()))
+        logging.debug("record inserted into DB")
         return None
     except MySQLdb.ProgrammingError as e:
-        logging.info("{}: Exception entering data into database".format(datetime.now()))
-        logging.info("{}: {}".format(datetime.now(), e))
+        logging.info("Exception entering data into database")
+        logging.info("%s", e)
         return e
 
 
+def get_lock(name, timeout=30):
+    """
+    Take a named MySQL lock to serialize work across processes.  The returned connection holds the lock until it's
+    passed to release_lock.
+    """
+    db = MySQLdb.connect(host=DB_HOST, port=3306, user=DB_USER, passwd=DB_PW, db=DB_SCHEMA, use_unicode=True,
+                         charset="utf8mb4")
+    db_cursor = db.cursor()
+    db_cursor.execute("SELECT GET_LOCK(%s, %s)", (name, timeout))
+    acquired = db_cursor.fetchone()[0]
+    db_cursor.close()
+    if acquired != 1:
+        db.close()
+        logging.info("Timed out waiting for lock %s", name)
+        raise TimeoutError("Timed out waiting for lock {}".format(name))
+
+    return db
+
+
+def release_lock(db):
+    """
+    Release all named locks held by a connection from get_lock
+    """
+    db_cursor = db.cursor()
+    db_cursor.execute("SELECT RELEASE_ALL_LOCKS()")
+    db_cursor.close()
+    db.close()
+
+
 def set_db_data_tip(message, users_to_tip, t_index):
     """
     Special case to update DB information to include tip data
     """
-    logging.info("{}: inserting tip into DB.".format(datetime.now()))
+    logging.debug("inserting tip %s into DB", message['tip_id'])
     db = MySQLdb.connect(host=DB_HOST, port=3306, user=DB_USER, passwd=DB_PW, db=DB_SCHEMA, use_unicode=True,
                          charset="utf8mb4")
     try:
@@ -206,11 +437,11 @@ def set_db_data_tip(message, users_to_tip, t_index):
             " VALUES (%s, %s, 2, %s, %s, %s, %s, %s)",
             (message['id'], message['tip_id'], message['sender_id'],
              users_to_tip[t_index]['receiver_id'], message['system'], message['text'],
-             Decimal(message['tip_amount'])))
+             message['tip_amount'].to_nano()))
         db.commit()
         db_cursor.close()
         db.close()
     except Exception as e:
-        logging.info("{}: Exception in set_db_data_tip".format(datetime.now()))
-        logging.info("{}: {}".format(datetime.now(), e))
+        logging.info("Exception in set_db_data_tip")
+        logging.info("%s", e)
         raise e
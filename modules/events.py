@@ -0,0 +1,260 @@
+import logging
+
+import modules.commands
+import modules.db
+import modules.identity
+import modules.orchestration
+import modules.registry
+import modules.social
+
+# Read config and parse constants
+config = modules.registry.config
+
+# IDs
+BOT_ID_TWITTER = config.get('webhooks', 'bot_id_twitter')
+BOT_ID_TELEGRAM = config.get('webhooks', 'bot_id_telegram')
+
+# Connect to Twitter
+api = modules.registry.twitter_api
+
+
+def check_maintenance(message):
+    """
+    DM the sender and return True if the bot is in maintenance
+    """
+    bot_status = config.get('webhooks', 'bot_status')
+    if bot_status == 'maintenance':
+        modules.social.send_dm(message['sender_id'],
+                               "The tip bot is in maintenance.  Check @NanoTipBot on Twitter for more information.",
+                               message['system'])
+        return True
+
+    return False
+
+
+def process_twitter_dm(dm_object):
+    """
+    User sent a DM to the bot.  Parse the DM, see if there is an action provided and perform it.
+    If no action is provided, reply with an error.
+    """
+    message = {'system': 'twitter'}
+    message_object = dm_object.get('message_create', {})
+
+    message['sender_id'] = message_object.get('sender_id')
+
+    if message['sender_id'] == BOT_ID_TWITTER:
+        logging.info("Message from bot ignored.")
+        return
+
+    # The webhook adds the sender's profile when the delivery included it
+    if dm_object.get('sender'):
+        message['sender_screen_name'] = dm_object['sender'].get('screen_name')
+        modules.identity.remember_users([dm_object['sender']])
+    else:
+        message['sender_screen_name'] = api.get_user(message['sender_id']).screen_name
+    message['dm_id'] = dm_object.get('id')
+    message['text'] = message_object.get('message_data', {}).get('text')
+    message['command'] = modules.commands.parse_dm(message['text'])
+
+    logging.info("Processing direct message.")
+
+    # Update DB with new DM.  A retried job finds its DM already in the list and runs the command again: commands that
+    # move funds pick up the send their earlier attempt recorded, see modules.orchestration.make_command_send.
+    dm_insert_call = ("INSERT IGNORE INTO dm_list (dm_id, processed, sender_id, dm_text) "
+                      "VALUES (%s, 0, %s, %s)")
+    dm_insert_values = [message['dm_id'], message['sender_id'], message['text']]
+    modules.db.set_db_data(dm_insert_call, dm_insert_values)
+
+    logging.info("action identified: %s", message['command'].action)
+    # Check for action on DM
+    modules.orchestration.parse_action(message)
+
+
+def process_twitter_tweet(tweet_object):
+    """
+    A tweet was received.  The bot will parse the tweet, see if there are any tips and process them.
+    Error handling will cover if the sender doesn't have an account, doesn't have enough to cover the tips,
+    sent to an invalid username, didn't send an amount to tip or didn't send a !tip command.
+    """
+    message = {'system': 'twitter'}
+    users_to_tip = []
+
+    message = modules.social.set_message_info(tweet_object, message)
+    if message['id'] is None:
+        return
+
+    message = modules.social.check_message_action(message)
+    if message['action'] is None:
+        logging.info("Mention of nano tip bot without a !tip command.")
+        return
+
+    message = modules.social.validate_tip_amount(message)
+    if message['tip_amount'] <= 0:
+        return
+
+    if message['action'] != -1 and str(message['sender_id']) != str(BOT_ID_TWITTER):
+        if check_maintenance(message):
+            return
+        api.create_favorite(message['id'])
+        modules.orchestration.tip_process(message, users_to_tip, {})
+
+    elif str(message['sender_id']) == str(BOT_ID_TWITTER):
+        logging.info("TipBot sent a message.")
+
+
+def process_twitter_follows(follow_objects):
+    """
+    New users followed the bot.  Send each of them a welcome message once, however many times they show up in the
+    delivery.
+    """
+    follower_ids = []
+    for follow_object in follow_objects:
+        follower_id = follow_object.get('source', {}).get('id')
+        if (follow_object.get('type', 'follow') == 'follow' and follower_id != BOT_ID_TWITTER
+                and follower_id not in follower_ids):
+            follower_ids.append(follower_id)
+
+    logging.info("%s new users followed, sending help messages.", len(follower_ids))
+    for follower_id in follower_ids:
+        modules.orchestration.help_process({'system': 'twitter', 'sender_id': follower_id})
+
+
+def process_telegram_update(request_json):
+    """
+    Handle an update from the Telegram webhook: DM commands, tips in groups, and group membership changes
+    """
+    message = {
+        # id:                     ID of the received tweet - Error logged through None value
+        # text:                   A list containing the text of the received tweet, split by ' '
+        # sender_id:              Twitter ID of the user sending the tip
+        # sender_screen_name:     Twitter Handle of the user sending the tip
+        # sender_account:         Nano account of sender - Error logged through None value
+        # sender_register:        Registration status with Tip Bot of sender account
+        # sender_balance_raw:     Amount of Nano in sender's account, stored as a RawAmount
+        # sender_balance:         Amount of Nano in sender's account, formatted as a Nano string
+
+        # command:                modules.commands.Command parsed from the text
+        # action:                 Action found in the received tweet - Error logged through None value
+
+        # tip_amount:             RawAmount of the tip to be sent to receiver(s) - Error logged through -1
+        # tip_amount_text:        Value of the tip formatted as a Nano string
+        # total_tip_amount:       RawAmount equal to the tip amount * number of users to tip
+        # tip_id:                 ID of the tip, used to prevent double sending of tips.  Comprised of
+        #                         message['id'] + index of user in users_to_tip
+        # send_hash:              Hash of the send RPC transaction
+        # system:                 System that the command was sent from
+    }
+
+    users_to_tip = [
+        # List including dictionaries for each user to send a tip.  Each index will include
+        # the below parameters
+        #    receiver_id:            Twitter ID of the user receiving a tip
+        #    receiver_screen_name:   Twitter Handle of the user receiving a tip
+        #    receiver_account:       Nano account of receiver
+        #    receiver_register:      Registration status with Tip Bot of reciever account
+    ]
+    message['system'] = 'telegram'
+    if 'message' in request_json.keys():
+        if request_json['message']['chat']['type'] == 'private':
+            logging.info("Direct message received in Telegram.  Processing.")
+            message['sender_id'] = request_json['message']['from']['id']
+            try:
+                message['sender_screen_name'] = request_json['message']['from']['username']
+            except KeyError:
+                if 'first_name' in request_json['message']['from'].keys():
+                    message['sender_screen_name'] = request_json['message']['from']['first_name']
+                if 'last_name' in request_json['message']['from'].keys():
+                    message['sender_screen_name'] = \
+                        message['sender_screen_name'] + ' ' + request_json['message']['from']['last_name']
+            message['dm_id'] = request_json['update_id']
+            message['text'] = request_json['message']['text']
+            message['command'] = modules.commands.parse_dm(message['text'])
+
+            logging.info("action identified: %s", message['command'].action)
+
+            # Sends are recorded under the update_id, so a retried withdraw or donate finishes its send, as for DMs
+            modules.orchestration.parse_action(message)
+
+        elif (request_json['message']['chat']['type'] == 'supergroup' or
+              request_json['message']['chat']['type'] == 'group'):
+
+            if 'forward_from' in request_json['message']:
+                return
+
+            if 'text' in request_json['message']:
+                message['sender_id'] = request_json['message']['from']['id']
+                if 'username' in request_json['message']['from']:
+                    message['sender_screen_name'] = request_json['message']['from']['username']
+                else:
+                    if 'first_name' in request_json['message']['from'].keys():
+                        message['sender_screen_name'] = request_json['message']['from']['first_name']
+                    if 'last_name' in request_json['message']['from'].keys():
+                        message['sender_screen_name'] = \
+                            message['sender_screen_name'] + ' ' + request_json['message']['from']['last_name']
+                message['id'] = request_json['message']['message_id']
+                message['chat_id'] = request_json['message']['chat']['id']
+                message['chat_name'] = request_json['message']['chat']['title']
+
+                modules.social.check_telegram_member(message['chat_id'], message['chat_name'], message['sender_id'],
+                                                     message['sender_screen_name'])
+
+                message['text'] = modules.commands.tokenize(request_json['message']['text'])
+
+                message = modules.social.check_message_action(message)
+                if message['action'] is None:
+                    return
+
+                message = modules.social.validate_tip_amount(message)
+                if message['tip_amount'] <= 0:
+                    return
+
+                if message['action'] != -1 and str(message['sender_id']) != str(BOT_ID_TELEGRAM):
+                    if check_maintenance(message):
+                        return
+                    modules.orchestration.tip_process(message, users_to_tip, request_json)
+
+            elif 'new_chat_member' in request_json['message']:
+                logging.info("new member joined chat, adding to DB")
+                chat_id = request_json['message']['chat']['id']
+                chat_name = request_json['message']['chat']['title']
+                member_id = request_json['message']['new_chat_member']['id']
+                if 'username' in request_json['message']['new_chat_member']:
+                    member_name = request_json['message']['new_chat_member']['username']
+                else:
+                    member_name = None
+
+                new_chat_member_call = (
+                    "INSERT IGNORE INTO telegram_chat_members (chat_id, chat_name, member_id, member_name) "
+                    "VALUES (%s, %s, %s, %s)")
+                new_member_values = [chat_id, chat_name, member_id, member_name]
+                modules.db.set_db_data(new_chat_member_call, new_member_values)
+
+            elif 'left_chat_member' in request_json['message']:
+                chat_id = request_json['message']['chat']['id']
+                chat_name = request_json['message']['chat']['title']
+                member_id = request_json['message']['left_chat_member']['id']
+                if 'username' in request_json['message']['left_chat_member']:
+                    member_name = request_json['message']['left_chat_member']['username']
+                else:
+                    member_name = None
+                logging.info("member %s-%s left chat %s-%s, removing from DB.", member_id, member_name, chat_id,
+                             chat_name)
+
+                remove_member_call = ("DELETE FROM telegram_chat_members "
+                                      "WHERE chat_id = %s AND member_id = %s")
+                remove_member_values = [chat_id, member_id]
+                modules.db.set_db_data(remove_member_call, remove_member_values)
+
+            elif 'group_chat_created' in request_json['message']:
+                chat_id = request_json['message']['chat']['id']
+                chat_name = request_json['message']['chat']['title']
+                member_id = request_json['message']['from']['id']
+                member_name = request_json['message']['from']['username']
+                logging.info("member %s created chat %s, inserting creator into DB.", member_name, chat_name)
+                new_chat_call = ("INSERT IGNORE INTO telegram_chat_members (chat_id, chat_name, member_id, member_name) "
+                                 "VALUES (%s, %s, %s, %s)")
+                new_chat_values = [chat_id, chat_name, member_id, member_name]
+                modules.db.set_db_data(new_chat_call, new_chat_values)
+
+        else:
+            logging.info("request: %s", request_json)
@@ -0,0 +1,129 @@
+import base64
+from datetime import datetime
+
+import modules.db
+import modules.registry
+
+# Read config and parse constants
+config = modules.registry.config
+
+FEED_PAGE_SIZE = config.getint('webhooks', 'feed_page_size', fallback=50)
+FEED_MAX_PAGE_SIZE = config.getint('webhooks', 'feed_max_page_size', fallback=200)
+# Senders left out of the public feed, as on the tippers page
+FEED_EXCLUDED_SENDERS = ['mitche50']
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Processed tips between users with a screen name, i.e. not returned tips.  A tip to several users has a row per
+# receiver, so the feed's order is the table's whole primary key after the timestamp.
+FEED_SELECT = ("SELECT t.dm_id, t.sender_id, t.receiver_id, t.timestamp, t.amount, t.system, "
+               "s.user_name AS sender_name, s.account AS sender_account, "
+               "r.user_name AS receiver_name, r.account AS receiver_account "
+               "FROM tip_list AS t "
+               "JOIN users AS s ON s.user_id = t.sender_id "
+               "JOIN users AS r ON r.user_id = t.receiver_id "
+               "WHERE t.processed = 2 AND t.timestamp IS NOT NULL "
+               "AND s.user_name IS NOT NULL AND r.user_name IS NOT NULL "
+               "AND s.user_name NOT IN ({})".format(', '.join(["'{}'".format(name) for name in FEED_EXCLUDED_SENDERS])))
+FEED_AFTER = " AND (t.timestamp, t.dm_id, t.sender_id, t.receiver_id) < (%s, %s, %s, %s)"
+FEED_ORDER = " ORDER BY timestamp DESC, dm_id DESC, sender_id DESC, receiver_id DESC LIMIT %s"
+
+
+def encode_cursor(tip):
+    key = '{}|{}|{}|{}'.format(tip['timestamp'].strftime(CURSOR_TIME_FORMAT), tip['dm_id'], tip['sender_id'],
+                               tip['receiver_id'])
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Return the (timestamp, dm_id, sender_id, receiver_id) key of the last tip on the previous page.  Raises ValueError
+    for a cursor that wasn't made by encode_cursor.
+    """
+    try:
+        key = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        timestamp, dm_id, sender_id, receiver_id = key.split('|')
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+    return datetime.strptime(timestamp, CURSOR_TIME_FORMAT), int(dm_id), int(sender_id), int(receiver_id)
+
+
+def user_ids(screen_name, system=None):
+    user_call = "SELECT user_id FROM users WHERE user_name = %s"
+    user_values = [screen_name.lstrip('@')]
+    if system is not None:
+        user_call += " AND users.system = %s"
+        user_values.append(system)
+
+    return [row[0] for row in modules.db.get_db_data(user_call, user_values)]
+
+
+def feed_query(filters, filter_values, after, limit):
+    feed_call = FEED_SELECT + filters
+    feed_values = list(filter_values)
+    if after is not None:
+        feed_call += FEED_AFTER
+        feed_values.extend(after)
+
+    return feed_call + FEED_ORDER, feed_values + [limit]
+
+
+def get_tips(system=None, screen_name=None, cursor=None, limit=FEED_PAGE_SIZE):
+    """
+    Return a page of the tip feed, newest first, and the cursor for the next page or None on the last page.  Pages are
+    read from the tip_list indexes after the previous page's last tip, so a page costs the same however far back it
+    is.  screen_name limits the feed to tips the user sent or received.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    limit = max(1, min(limit, FEED_MAX_PAGE_SIZE))
+    system_filter = " AND t.system = %s" if system is not None else ""
+    system_values = [system] if system is not None else []
+
+    if screen_name is None:
+        feed_call, feed_values = feed_query(system_filter, system_values, after, limit + 1)
+    else:
+        ids = user_ids(screen_name, system)
+        if not ids:
+            return [], None
+        id_list = ', '.join(['%s'] * len(ids))
+        # One branch per index, so each reads no more than a page
+        sent_call, sent_values = feed_query(" AND t.sender_id IN ({})".format(id_list) + system_filter,
+                                            ids + system_values, after, limit + 1)
+        received_call, received_values = feed_query(
+            " AND t.receiver_id IN ({0}) AND t.sender_id NOT IN ({0})".format(id_list) + system_filter,
+            ids + ids + system_values, after, limit + 1)
+        feed_call = "({}) UNION ALL ({})".format(sent_call, received_call) + FEED_ORDER
+        feed_values = sent_values + received_values + [limit + 1]
+
+    tips = [{
+        'dm_id': row[0],
+        'sender_id': row[1],
+        'receiver_id': row[2],
+        'timestamp': row[3],
+        'amount': row[4],
+        'system': row[5],
+        'sender': row[6],
+        'sender_account': row[7],
+        'receiver': row[8],
+        'receiver_account': row[9]
+    } for row in modules.db.get_db_data(feed_call, feed_values)]
+
+    next_cursor = None
+    if len(tips) > limit:
+        tips = tips[:limit]
+        next_cursor = encode_cursor(tips[-1])
+
+    return tips, next_cursor
+
+
+def tip_json(tip):
+    return {
+        'id': str(tip['dm_id']),
+        'sender': tip['sender'],
+        'sender_account': tip['sender_account'],
+        'receiver': tip['receiver'],
+        'receiver_account': tip['receiver_account'],
+        'amount': str(tip['amount']),
+        'system': tip['system'],
+        'timestamp': tip['timestamp'].strftime(CURSOR_TIME_FORMAT)
+    }
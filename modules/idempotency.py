@@ -0,0 +1,177 @@
+import hashlib
+import logging
+import os
+import threading
+
+import modules.db
+import modules.registry
+
+# Read config and parse constants
+config = modules.registry.config
+
+# The filter's defaults hold about 800,000 deliveries at a 1% false positive rate in 1MB.  A false positive only costs
+# a primary key lookup, as the webhook_deliveries table has the final say.
+FILTER_BITS = config.getint('webhooks', 'idempotency_filter_bits', fallback=2 ** 23)
+FILTER_HASHES = config.getint('webhooks', 'idempotency_filter_hashes', fallback=7)
+IDEMPOTENCY_RETENTION_DAYS = config.getint('webhooks', 'idempotency_retention_days', fallback=7)
+
+# Statements shared with the asyncio entry point
+SEEN_CALL = "SELECT delivery_key FROM webhook_deliveries WHERE delivery_key IN ({})"
+RECORD_CALL = "INSERT IGNORE INTO webhook_deliveries (delivery_key) VALUES (%s)"
+WARM_CALL = "SELECT delivery_key FROM webhook_deliveries WHERE created_ts > NOW() - INTERVAL %s DAY"
+
+
+class BloomFilter(object):
+    """
+    Set membership in a fixed bit array.  might_contain is never wrong about a key that was added, and only rarely
+    says yes to one that wasn't.
+    """
+
+    def __init__(self, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        self.array = bytearray((bits + 7) // 8)
+        self.lock = threading.Lock()
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + index * second) % self.bits for index in range(self.hashes)]
+
+    def add(self, key):
+        with self.lock:
+            for position in self.positions(key):
+                self.array[position // 8] |= 1 << (position % 8)
+
+    def might_contain(self, key):
+        return all(self.array[position // 8] & (1 << (position % 8)) for position in self.positions(key))
+
+
+delivery_filter = BloomFilter(FILTER_BITS, FILTER_HASHES)
+filter_warm = False
+warm_lock = threading.Lock()
+
+
+def delivery_key(job_type, payload):
+    """
+    The key a redelivered event has in common with the first delivery: the tweet ID, DM ID or Telegram update_id.
+    Jobs that aren't webhook events have no key.
+    """
+    if job_type == 'twitter_tweet':
+        return 'twitter-tweet-{}'.format(payload.get('id_str') or payload.get('id'))
+    if job_type == 'twitter_dm':
+        return 'twitter-dm-{}'.format(payload.get('id'))
+    if job_type == 'telegram_update':
+        return 'telegram-{}'.format(payload.get('update_id'))
+
+    return None
+
+
+def warm_filter():
+    """
+    Load the deliveries recorded by other processes into this process' filter, the first time it's needed
+    """
+    global filter_warm
+    with warm_lock:
+        if filter_warm:
+            return
+        db = modules.db.get_connection()
+        db_cursor = db.cursor()
+        try:
+            db_cursor.execute(WARM_CALL, (IDEMPOTENCY_RETENTION_DAYS,))
+            for row in db_cursor.fetchall():
+                delivery_filter.add(row[0])
+        finally:
+            db_cursor.close()
+            db.close()
+        filter_warm = True
+
+
+def possible_duplicates(keys, warm=True):
+    """
+    Return the keys the filter may have seen.  Any key not in the list is certainly new to this process.  Without warm,
+    a filter that isn't loaded yet isn't loaded here either, as the load blocks; only the keys this process remembered
+    are found then, and RECORD_CALL still turns away the rest.
+    """
+    if warm and not filter_warm:
+        try:
+            warm_filter()
+        except Exception as e:
+            logging.info("Error loading recent deliveries: %s", e)
+
+    return [key for key in keys if key is not None and delivery_filter.might_contain(key)]
+
+
+def remember(keys):
+    for key in keys:
+        delivery_filter.add(key)
+
+
+def keys_to_record(keys, seen):
+    """
+    The distinct keys of a batch that weren't found in webhook_deliveries, in order
+    """
+    unseen = []
+    for key in keys:
+        if key is not None and key not in seen and key not in unseen:
+            unseen.append(key)
+
+    return unseen
+
+
+def split_redeliveries(jobs, keys, recorded):
+    """
+    Sort a batch of jobs into new events and redeliveries, given the keys the batch recorded in webhook_deliveries.  A
+    key the batch didn't record was already there, or another process recorded it first.  Returns the new jobs and the
+    keys to remember once the transaction commits.
+    """
+    new = []
+    first = set(recorded)
+    for job, key in zip(jobs, keys):
+        if key is None:
+            new.append(job)
+        elif key in first:
+            new.append(job)
+            first.discard(key)
+        else:
+            logging.info("Ignoring redelivered event %s", key)
+
+    return new, list(set(key for key in keys if key is not None))
+
+
+def new_jobs(db_cursor, jobs):
+    """
+    Drop redelivered events from a batch of (job_type, payload) jobs and record the rest as delivered, on the caller's
+    transaction.  Only keys the filter may have seen are looked up, and the INSERT IGNORE settles races between
+    processes taking the same redelivery.  Returns the new jobs and the keys to remember once the transaction commits.
+    """
+    keys = [delivery_key(job_type, payload) for job_type, payload in jobs]
+    seen = set()
+    possible = possible_duplicates(keys)
+    if possible:
+        db_cursor.execute(SEEN_CALL.format(', '.join(['%s'] * len(possible))), possible)
+        seen = set(row[0] for row in db_cursor.fetchall())
+    recorded = [key for key in keys_to_record(keys, seen) if db_cursor.execute(RECORD_CALL, (key,)) == 1]
+
+    return split_redeliveries(jobs, keys, recorded)
+
+
+def sweep_deliveries():
+    """
+    Forget deliveries past the retention period.  Twitter and Telegram stop redelivering long before then.
+    """
+    cleanup_call = "DELETE FROM webhook_deliveries WHERE created_ts < NOW() - INTERVAL %s DAY"
+    modules.db.set_db_data(cleanup_call, [IDEMPOTENCY_RETENTION_DAYS])
+
+
+def reset_locks():
+    """
+    A forked child can't wait on a lock a thread of its parent held at the fork
+    """
+    global warm_lock
+    warm_lock = threading.Lock()
+    delivery_filter.lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_locks)
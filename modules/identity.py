@@ -0,0 +1,87 @@
+import logging
+import os
+import threading
+import time
+from http import HTTPStatus
+
+import modules.registry
+
+# Read config and parse constants
+config = modules.registry.config
+
+# Screen names can change hands, so a resolved id is only trusted for this long
+TWITTER_USER_CACHE_TTL = config.getint('webhooks', 'twitter_user_cache_ttl', fallback=3600)
+# Most screen names users/lookup takes in one call
+LOOKUP_BATCH = 100
+
+# Connect to Twitter
+api = modules.registry.twitter_api
+
+# Lower case screen name -> (expiry time, {'id': user ID, 'screen_name': screen name})
+user_cache = {}
+user_lock = threading.Lock()
+
+
+def remember_users(users):
+    """
+    Cache the users seen in a webhook payload, e.g. a DM delivery's users map or a tweet's user_mentions.  Each user
+    is a dict with an id and a screen_name.
+    """
+    expiry = time.time() + TWITTER_USER_CACHE_TTL
+    with user_lock:
+        for user in users:
+            if user.get('id') is None or not user.get('screen_name'):
+                continue
+            user_cache[user['screen_name'].lower()] = (expiry, {'id': int(user['id']),
+                                                                'screen_name': user['screen_name']})
+
+
+def resolve_screen_names(screen_names, payload_users=None):
+    """
+    Return {lower case screen name: {'id': user ID, 'screen_name': screen name}} for the screen names, without the @.
+    Users in the payload are used first, then the cache, and whatever is left is looked up in one users/lookup call
+    per hundred names.  Names that don't belong to a user are left out.  Raises tweepy.TweepError if a lookup fails.
+    """
+    if payload_users:
+        remember_users(payload_users)
+
+    resolved = {}
+    to_lookup = []
+    now = time.time()
+    with user_lock:
+        for screen_name in screen_names:
+            name_key = screen_name.lower()
+            cached = user_cache.get(name_key)
+            if cached is not None and cached[0] > now:
+                resolved[name_key] = cached[1]
+            elif name_key not in to_lookup:
+                to_lookup.append(name_key)
+
+    # Imported only once there's something to look up, like the client itself in modules.registry
+    import tweepy
+    for index in range(0, len(to_lookup), LOOKUP_BATCH):
+        try:
+            users = api.lookup_users(screen_names=to_lookup[index:index + LOOKUP_BATCH])
+        except tweepy.TweepError as e:
+            # users/lookup answers 404 when none of the names exist.  Any other error, e.g. a rate limit, isn't an
+            # answer, so it's raised rather than reported as names without users.
+            if e.response is None or e.response.status_code != HTTPStatus.NOT_FOUND:
+                raise e
+            logging.info("users/lookup found no users for %s: %s", to_lookup[index:index + LOOKUP_BATCH], e)
+            continue
+        remember_users([{'id': user.id, 'screen_name': user.screen_name} for user in users])
+        for user in users:
+            resolved[user.screen_name.lower()] = {'id': user.id, 'screen_name': user.screen_name}
+
+    return resolved
+
+
+def reset_user_lock():
+    """
+    A forked child can't wait on a lock a thread of its parent held at the fork
+    """
+    global user_lock
+    user_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_user_lock)
@@ -0,0 +1,516 @@
+import json
+import logging
+import fcntl
+import math
+import os
+import threading
+import time
+import uuid
+
+import modules.commands
+import modules.db
+import modules.events
+import modules.idempotency
+import modules.ledger
+import modules.logs
+import modules.outbound
+import modules.registry
+
+# Read config and parse constants
+config = modules.registry.config
+
+# Job queue settings
+JOB_VISIBILITY_TIMEOUT = config.getint('webhooks', 'job_visibility_timeout', fallback=300)
+JOB_MAX_ATTEMPTS = config.getint('webhooks', 'job_max_attempts', fallback=5)
+JOB_RETRY_DELAY = config.getint('webhooks', 'job_retry_delay', fallback=5)
+JOB_POLL_INTERVAL = config.getfloat('webhooks', 'job_poll_interval', fallback=1)
+JOB_RETENTION_DAYS = config.getint('webhooks', 'job_retention_days', fallback=7)
+# A running job's visibility timeout is pushed back this often for as long as its worker is alive, so a slow job isn't
+# claimed again by a second worker while the first is still running it
+JOB_HEARTBEAT_INTERVAL = max(1, JOB_VISIBILITY_TIMEOUT // 3)
+
+# Jobs run in separate lanes, each with its own workers and queue depth limit, so cheap replies aren't stuck behind
+# PoW bound sends during a tip storm
+LANES = {
+    'money': {
+        'workers': config.getint('webhooks', 'job_workers_money', fallback=4),
+        'queue_limit': config.getint('webhooks', 'job_queue_limit_money', fallback=1000)
+    },
+    'read': {
+        'workers': config.getint('webhooks', 'job_workers_read', fallback=2),
+        'queue_limit': config.getint('webhooks', 'job_queue_limit_read', fallback=500)
+    },
+    # Help, unknown command and other canned DM replies, the first jobs dropped under load
+    'reply': {
+        'workers': config.getint('webhooks', 'job_workers_reply', fallback=1),
+        'queue_limit': config.getint('webhooks', 'job_queue_limit_reply', fallback=500)
+    },
+    # Follows, chat membership updates and group messages without a tip, which record members and can't be dropped
+    'notification': {
+        'workers': config.getint('webhooks', 'job_workers_notification', fallback=1),
+        'queue_limit': config.getint('webhooks', 'job_queue_limit_notification', fallback=500)
+    },
+    # DMs and replies from the other lanes.  The rate limits are kept per process, so one worker runs several sender
+    # threads.  Messages are often queued after a tip or withdrawal has already moved funds, so the lane has no depth
+    # limit and is never shed.
+    'outbound': {
+        'workers': 1,
+        'threads': config.getint('webhooks', 'job_threads_outbound', fallback=8),
+        'queue_limit': None
+    }
+}
+
+# Admission control across all lanes.  Once job_max_in_flight jobs are running or due, new reply jobs, i.e. help and
+# unknown command replies, are shed, and jobs in the other lanes are still acknowledged but held back for
+# job_defer_delay seconds per multiple of the cap.
+JOB_MAX_IN_FLIGHT = config.getint('webhooks', 'job_max_in_flight', fallback=200)
+JOB_DEFER_DELAY = config.getint('webhooks', 'job_defer_delay', fallback=30)
+SHED_LANES = ['reply']
+# Lanes left out of the jobs in flight and never refused, deferred or shed, as their jobs come from admitted jobs
+ADMISSION_EXEMPT_LANES = ['outbound']
+# Outbound messages that couldn't be queued, e.g. while the DB was down, one JSON payload per line.  They're queued
+# again on the next sweep.
+OUTBOUND_SPOOL = config.get('webhooks', 'outbound_spool', fallback='outbound_spool.jsonl')
+
+# jobs.status values
+JOB_QUEUED = 0
+JOB_RUNNING = 1
+JOB_DONE = 2
+JOB_DEAD = 3
+
+
+def settle_ledger_account(payload):
+    """
+    Job handler for the account settlements modules.ledger.send queues when an account's chain funds fall short
+    """
+    modules.ledger.settle_account(payload['account'])
+
+
+# Functions that run each type of job, called with the job's payload
+JOB_HANDLERS = {
+    'twitter_dm': modules.events.process_twitter_dm,
+    'twitter_tweet': modules.events.process_twitter_tweet,
+    'twitter_follows': modules.events.process_twitter_follows,
+    'telegram_update': modules.events.process_telegram_update,
+    'ledger_settle': settle_ledger_account,
+    'outbound': modules.outbound.deliver
+}
+
+# Queue statements, shared with the asyncio entry point
+ENQUEUE_CALL = ("INSERT INTO jobs (job_type, lane, payload, max_attempts, available_at) "
+                "VALUES (%s, %s, %s, %s, NOW() + INTERVAL %s SECOND)")
+ADMISSION_CALL = ("SELECT lane, SUM(status = {queued}), SUM(status = {running} OR available_at <= NOW()) "
+                  "FROM jobs WHERE status IN ({queued}, {running}) GROUP BY lane").format(queued=JOB_QUEUED,
+                                                                                           running=JOB_RUNNING)
+CLAIM_CALL = ("UPDATE jobs SET status = {running}, claim_id = %s, attempts = attempts + 1, claimed_ts = NOW(), "
+              "locked_until = NOW() + INTERVAL {timeout} SECOND "
+              "WHERE lane = %s AND ((status = {queued} AND available_at <= NOW()) "
+              "OR (status = {running} AND locked_until < NOW() AND attempts < max_attempts)) "
+              "ORDER BY id LIMIT 1").format(running=JOB_RUNNING, queued=JOB_QUEUED, timeout=JOB_VISIBILITY_TIMEOUT)
+CLAIMED_CALL = "SELECT id, job_type, payload, attempts, max_attempts FROM jobs WHERE claim_id = %s"
+HEARTBEAT_CALL = ("UPDATE jobs SET locked_until = NOW() + INTERVAL {timeout} SECOND "
+                  "WHERE status = {running} AND claim_id IN ({{}})").format(timeout=JOB_VISIBILITY_TIMEOUT,
+                                                                           running=JOB_RUNNING)
+
+# Jobs turned away because their lane was full, held back or dropped by admission control, since this process started
+lane_rejections = {lane: 0 for lane in LANES}
+lane_deferrals = {lane: 0 for lane in LANES}
+lane_shed = {lane: 0 for lane in LANES}
+# Jobs are queued from every job thread of a process, e.g. the replies of asgi.py's thread pools
+lane_counts_lock = threading.Lock()
+# Claim IDs of the jobs this process is running, kept claimed by the heartbeat thread
+running_claims = set()
+running_claims_lock = threading.Lock()
+heartbeat_thread = None
+
+
+class QueueFull(Exception):
+    pass
+
+
+def command_lane(dm_action):
+    """
+    Lane for a DM command: sends for withdrawals and donations, node and DB lookups for balance, account and register,
+    and canned replies for everything else
+    """
+    action = modules.commands.ALIASES.get(dm_action)
+    if action in ('withdraw', 'donate'):
+        return 'money'
+    if action in ('balance', 'account', 'register'):
+        return 'read'
+
+    return 'reply'
+
+
+def job_lane(job_type, payload):
+    """
+    Work out which lane a job runs in from a quick look at its payload.  Follows, membership updates and group messages
+    without a tip fall through to the notification lane, which is deferred but never shed.
+    """
+    if job_type == 'outbound':
+        return 'outbound'
+    if job_type in ('twitter_tweet', 'ledger_settle'):
+        return 'money'
+    if job_type == 'twitter_dm':
+        text = payload.get('message_create', {}).get('message_data', {}).get('text') or ''
+        return command_lane(text.split(" ")[0].lower())
+    if job_type == 'telegram_update':
+        telegram_message = payload.get('message', {})
+        text = (telegram_message.get('text') or '').lower()
+        if telegram_message.get('chat', {}).get('type') == 'private':
+            return command_lane(text.split(" ")[0])
+        if any(modules.commands.ALIASES.get(word) == 'tip' for word in modules.commands.tokenize(text)):
+            return 'money'
+
+    return 'notification'
+
+
+def enqueue(job_type, payload, max_attempts=JOB_MAX_ATTEMPTS):
+    """
+    Store a job for the workers in its lane.  payload is passed to the job type's handler once it's claimed.  Raises
+    QueueFull if the lane already has its limit of jobs waiting.  Returns False if the job was shed instead of queued.
+    """
+    return enqueue_batch([(job_type, payload)], max_attempts) == 1
+
+
+def spool_outbound(payload):
+    """
+    Keep an outbound message that couldn't be queued in OUTBOUND_SPOOL until the next sweep queues it
+    """
+    with open(OUTBOUND_SPOOL, 'a') as spool:
+        fcntl.flock(spool, fcntl.LOCK_EX)
+        spool.write(json.dumps(payload) + '\n')
+
+
+def replay_outbound_spool():
+    """
+    Queue the messages kept in OUTBOUND_SPOOL.  The spool stays locked until they're queued, and any that still can't
+    be are written back to it.
+    """
+    if not os.path.isfile(OUTBOUND_SPOOL):
+        return
+
+    with open(OUTBOUND_SPOOL, 'r+') as spool:
+        fcntl.flock(spool, fcntl.LOCK_EX)
+        payloads = [json.loads(line) for line in spool if line.strip()]
+        queued = 0
+        try:
+            for payload in payloads:
+                enqueue('outbound', payload)
+                queued += 1
+        except Exception as e:
+            logging.info("Error queuing spooled outbound messages, %s left: %s", len(payloads) - queued, e)
+        spool.seek(0)
+        spool.truncate()
+        spool.writelines(json.dumps(payload) + '\n' for payload in payloads[queued:])
+    if queued:
+        logging.info("Queued %s spooled outbound messages", queued)
+
+
+def enqueue_batch(jobs, max_attempts=JOB_MAX_ATTEMPTS):
+    """
+    Store a list of (job_type, payload) jobs, e.g. all the events of one webhook delivery, in a single transaction.
+    Events that were already delivered are skipped.  Raises QueueFull, queuing none of them, if any job's lane is full.
+    Returns the number of jobs queued.
+    """
+    db = modules.db.get_connection()
+    db_cursor = db.cursor()
+    try:
+        jobs, delivery_keys = modules.idempotency.new_jobs(db_cursor, jobs)
+        job_rows = []
+        if jobs:
+            db_cursor.execute(ADMISSION_CALL)
+            job_rows = admit_batch(jobs, db_cursor.fetchall(), max_attempts)
+        if job_rows:
+            db_cursor.executemany(ENQUEUE_CALL, job_rows)
+        db.commit()
+    finally:
+        db_cursor.close()
+        db.close()
+    modules.idempotency.remember(delivery_keys)
+
+    return len(job_rows)
+
+
+def admit_batch(jobs, admission_rows, max_attempts):
+    """
+    Run each job of a batch through admission control, given the ADMISSION_CALL rows, and return the rows for
+    ENQUEUE_CALL.  Jobs earlier in the batch count towards the queue depth and jobs in flight seen by the later ones.
+    """
+    depths = {lane: 0 for lane in LANES}
+    in_flight = 0
+    for lane, depth, lane_in_flight in admission_rows:
+        depths[lane] = int(depth)
+        if lane not in ADMISSION_EXEMPT_LANES:
+            in_flight += int(lane_in_flight)
+
+    job_rows = []
+    for job_type, payload in jobs:
+        lane = job_lane(job_type, payload)
+        delay = admit(lane, job_type, depths[lane], in_flight)
+        if delay is None:
+            continue
+        depths[lane] += 1
+        if delay == 0 and lane not in ADMISSION_EXEMPT_LANES:
+            in_flight += 1
+        job_rows.append((job_type, lane, json.dumps(payload), max_attempts, delay))
+
+    return job_rows
+
+
+def admit(lane, job_type, depth, in_flight):
+    """
+    Decide how a new job is taken in.  Raises QueueFull if its lane already has its limit of jobs waiting.  Otherwise
+    returns the seconds to hold the job back before it's due, or None if the jobs in flight are over the cap and the
+    job's lane is shed first.  Jobs in ADMISSION_EXEMPT_LANES are always queued at once.
+    """
+    if lane in ADMISSION_EXEMPT_LANES:
+        return 0
+    check_lane_depth(lane, job_type, depth)
+    if in_flight < JOB_MAX_IN_FLIGHT:
+        return 0
+
+    if lane in SHED_LANES:
+        with lane_counts_lock:
+            lane_shed[lane] += 1
+        logging.info("%s jobs in flight, shedding %s job", in_flight, job_type)
+        return None
+
+    # The further over the cap, the longer the wait, so deferred jobs don't all come due together
+    delay = JOB_DEFER_DELAY * (in_flight // JOB_MAX_IN_FLIGHT)
+    with lane_counts_lock:
+        lane_deferrals[lane] += 1
+    logging.info("%s jobs in flight, deferring %s job by %ss", in_flight, job_type, delay)
+    return delay
+
+
+def check_lane_depth(lane, job_type, depth):
+    """
+    Raise QueueFull if the lane already has its limit of jobs waiting
+    """
+    if depth >= LANES[lane]['queue_limit']:
+        with lane_counts_lock:
+            lane_rejections[lane] += 1
+        logging.info("%s lane is full, rejecting %s job", lane, job_type)
+        raise QueueFull("The {} lane is full".format(lane))
+
+
+def claim_job(lane):
+    """
+    Claim the oldest job in the lane that's due, or one whose worker let its visibility timeout lapse.  The claim is a
+    single UPDATE, so two workers can never hold the same job.  Returns the job as a dict, or None if there's nothing
+    to do.
+    """
+    claim_id = uuid.uuid4().hex
+    db = modules.db.get_connection()
+    db_cursor = db.cursor()
+    try:
+        claimed = db_cursor.execute(CLAIM_CALL, (claim_id, lane))
+        db.commit()
+        if claimed == 0:
+            return None
+
+        db_cursor.execute(CLAIMED_CALL, (claim_id,))
+        row = db_cursor.fetchone()
+    finally:
+        db_cursor.close()
+        db.close()
+
+    return job_from_row(row, claim_id)
+
+
+def job_from_row(row, claim_id):
+    return {
+        'id': row[0],
+        'job_type': row[1],
+        'payload': json.loads(row[2]),
+        'attempts': row[3],
+        'max_attempts': row[4],
+        'claim_id': claim_id
+    }
+
+
+def complete_job(job):
+    complete_call = "UPDATE jobs SET status = %s, claim_id = NULL WHERE id = %s AND claim_id = %s"
+    modules.db.set_db_data(complete_call, [JOB_DONE, job['id'], job['claim_id']])
+
+
+def fail_job(job, error):
+    """
+    Put a failed job back on the queue after an exponential backoff, or dead-letter it once it's out of attempts
+    """
+    if job['attempts'] >= job['max_attempts']:
+        logging.info("Job %s (%s) is out of attempts, moving to dead letter: %s", job['id'], job['job_type'], error)
+        fail_call = "UPDATE jobs SET status = %s, claim_id = NULL, last_error = %s WHERE id = %s AND claim_id = %s"
+        fail_values = [JOB_DEAD, str(error), job['id'], job['claim_id']]
+    else:
+        retry_delay = JOB_RETRY_DELAY * 2 ** (job['attempts'] - 1)
+        logging.info("Job %s (%s) failed, retrying in %ss: %s", job['id'], job['job_type'], retry_delay, error)
+        fail_call = ("UPDATE jobs SET status = %s, claim_id = NULL, last_error = %s, "
+                     "available_at = NOW() + INTERVAL %s SECOND WHERE id = %s AND claim_id = %s")
+        fail_values = [JOB_QUEUED, str(error), retry_delay, job['id'], job['claim_id']]
+    modules.db.set_db_data(fail_call, fail_values)
+
+
+def retry_job(job, delay, error):
+    """
+    Put a job back on the queue after delay seconds without using up an attempt, e.g. when a rate limit was hit
+    """
+    logging.info("Job %s (%s) retrying in %ss: %s", job['id'], job['job_type'], delay, error)
+    retry_call = ("UPDATE jobs SET status = %s, claim_id = NULL, last_error = %s, attempts = attempts - 1, "
+                  "available_at = NOW() + INTERVAL %s SECOND WHERE id = %s AND claim_id = %s")
+    modules.db.set_db_data(retry_call, [JOB_QUEUED, str(error), delay, job['id'], job['claim_id']])
+
+
+def job_event_id(job):
+    """
+    The correlation ID a job's log lines are tagged with: the event that led to the job where there is one, e.g. the
+    tweet a reply answers, otherwise the job itself
+    """
+    payload = job['payload']
+    if isinstance(payload, dict):
+        event_id = payload.get('event_id') or modules.idempotency.delivery_key(job['job_type'], payload)
+        if event_id is not None:
+            return event_id
+
+    return 'job-{}'.format(job['id'])
+
+
+def heartbeat_loop():
+    """
+    Push back the visibility timeout of every job this process is running, every JOB_HEARTBEAT_INTERVAL seconds
+    """
+    while True:
+        time.sleep(JOB_HEARTBEAT_INTERVAL)
+        with running_claims_lock:
+            claim_ids = list(running_claims)
+        if not claim_ids:
+            continue
+        try:
+            modules.db.set_db_data(HEARTBEAT_CALL.format(', '.join(['%s'] * len(claim_ids))), claim_ids)
+        except Exception as e:
+            logging.info("Error extending running jobs: %s", e)
+
+
+def start_heartbeat():
+    global heartbeat_thread
+    with running_claims_lock:
+        if heartbeat_thread is None or not heartbeat_thread.is_alive():
+            heartbeat_thread = threading.Thread(target=heartbeat_loop, name='job-heartbeat', daemon=True)
+            heartbeat_thread.start()
+
+
+def run_job(job):
+    """
+    Run a claimed job with its handler and record the outcome.  The job stays claimed for as long as it runs.
+    """
+    start_heartbeat()
+    with running_claims_lock:
+        running_claims.add(job['claim_id'])
+    try:
+        with modules.logs.correlation(job_event_id(job)):
+            try:
+                JOB_HANDLERS[job['job_type']](job['payload'])
+            except modules.outbound.RateLimited as e:
+                retry_job(job, int(math.ceil(e.retry_after)), e)
+                return False
+            except Exception as e:
+                logging.info("Exception in job %s: %s", job['id'], e)
+                fail_job(job, e)
+                return False
+
+            complete_job(job)
+            return True
+    finally:
+        with running_claims_lock:
+            running_claims.discard(job['claim_id'])
+
+
+def sweep_jobs():
+    """
+    Dead-letter jobs whose last attempt timed out without finishing, and delete finished jobs and recorded webhook
+    deliveries past their retention periods.  Also queues any spooled outbound messages.
+    """
+    expired_call = ("UPDATE jobs SET status = %s, claim_id = NULL, last_error = 'Visibility timeout expired' "
+                    "WHERE status = %s AND locked_until < NOW() AND attempts >= max_attempts")
+    modules.db.set_db_data(expired_call, [JOB_DEAD, JOB_RUNNING])
+    cleanup_call = "DELETE FROM jobs WHERE status = %s AND updated_ts < NOW() - INTERVAL %s DAY"
+    modules.db.set_db_data(cleanup_call, [JOB_DONE, JOB_RETENTION_DAYS])
+    modules.idempotency.sweep_deliveries()
+    replay_outbound_spool()
+
+
+def lane_stats():
+    """
+    Per lane queue depth, running and dead-lettered jobs, the age of the oldest waiting job, admission control counts,
+    and the average wait and run time of jobs finished in the last five minutes, in seconds
+    """
+    stats = {lane: {
+        'workers': LANES[lane]['workers'],
+        'queue_limit': LANES[lane]['queue_limit'],
+        'queued': 0,
+        'running': 0,
+        'dead': 0,
+        'oldest_queued': 0,
+        'rejected': lane_rejections[lane],
+        'deferred': lane_deferrals[lane],
+        'shed': lane_shed[lane],
+        'avg_wait': None,
+        'avg_run': None
+    } for lane in LANES}
+
+    counts_call = ("SELECT lane, status, COUNT(*), TIMESTAMPDIFF(SECOND, MIN(created_ts), NOW()) FROM jobs "
+                   "WHERE status IN ({}, {}, {}) GROUP BY lane, status".format(JOB_QUEUED, JOB_RUNNING, JOB_DEAD))
+    for lane, status, count, oldest in modules.db.get_db_data(counts_call):
+        if lane not in stats:
+            continue
+        if status == JOB_QUEUED:
+            stats[lane]['queued'] = count
+            stats[lane]['oldest_queued'] = oldest
+        elif status == JOB_RUNNING:
+            stats[lane]['running'] = count
+        else:
+            stats[lane]['dead'] = count
+
+    timing_call = ("SELECT lane, AVG(TIMESTAMPDIFF(SECOND, created_ts, claimed_ts)), "
+                   "AVG(TIMESTAMPDIFF(SECOND, claimed_ts, updated_ts)) FROM jobs "
+                   "WHERE status = {} AND updated_ts > NOW() - INTERVAL 5 MINUTE GROUP BY lane".format(JOB_DONE))
+    for lane, avg_wait, avg_run in modules.db.get_db_data(timing_call):
+        if lane in stats:
+            stats[lane]['avg_wait'] = float(avg_wait)
+            stats[lane]['avg_run'] = float(avg_run)
+
+    return stats
+
+
+def work_loop(lane):
+    """
+    Claim and run jobs from the lane one at a time until the process is stopped
+    """
+    while True:
+        try:
+            job = claim_job(lane)
+        except Exception as e:
+            logging.info("Error claiming job: %s", e)
+            job = None
+
+        if job is None:
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+
+        run_job(job)
+
+
+def reset_after_fork():
+    """
+    A forked child can't wait on a lock a thread of its parent held at the fork, and isn't running its parent's jobs.
+    The heartbeat thread didn't survive the fork, so it's started again by the next run_job.
+    """
+    global lane_counts_lock, running_claims_lock, heartbeat_thread
+    lane_counts_lock = threading.Lock()
+    running_claims_lock = threading.Lock()
+    running_claims.clear()
+    heartbeat_thread = None
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
@@ -0,0 +1,302 @@
+import logging
+
+import nano
+
+import modules.balances
+import modules.currency
+import modules.db
+import modules.jobs
+import modules.node
+import modules.registry
+from modules.amount import RawAmount
+
+# Read config and parse constants
+config = modules.registry.config
+
+# In ledger mode, tips between registered users only move unsettled_raw in ledger_balances.  An account's spendable
+# balance is its chain balance plus its unsettled amount, and the settlement job nets the unsettled amounts back onto
+# the chain.
+LEDGER_MODE = config.getboolean('webhooks', 'ledger_mode', fallback=False)
+WALLET = config.get('webhooks', 'wallet')
+SETTLEMENT_LOCK = 'ledger-settlement'
+SETTLEMENT_LOCK_TIMEOUT = 600
+# An account settlement waits this long for a full settlement to finish before its job is retried
+ACCOUNT_SETTLEMENT_LOCK_TIMEOUT = 30
+
+# ledger_settlements.settled values
+SETTLEMENT_PLANNED = 0
+SETTLEMENT_SENT = 1
+SETTLEMENT_FAILED = 2
+
+# Connect to Nano node
+rpc = modules.node.rpc
+
+
+def lock_accounts(db_cursor, accounts):
+    """
+    Lock the ledger rows for the accounts in the cursor's transaction, creating any that are missing.  Rows are locked
+    in account order so concurrent transactions can't deadlock on each other.  Returns {account: unsettled RawAmount}.
+    """
+    accounts = sorted(set(accounts))
+    db_cursor.executemany("INSERT IGNORE INTO ledger_balances (account) VALUES (%s)",
+                          [(account,) for account in accounts])
+    db_cursor.execute("SELECT account, unsettled_raw FROM ledger_balances WHERE account IN ({}) "
+                      "ORDER BY account FOR UPDATE".format(', '.join(['%s'] * len(accounts))), accounts)
+
+    return {row[0]: RawAmount(int(row[1])) for row in db_cursor.fetchall()}
+
+
+def chain_balance(account):
+    """
+    Read the account's balance straight from the node.  Checks made under the ledger lock don't use the balance cache,
+    which only sees the blocks published by this process.
+    """
+    return RawAmount(rpc.account_balance(account="{}".format(account))['balance'])
+
+
+def get_unsettled(accounts):
+    """
+    Return {account: unsettled RawAmount} for the provided accounts
+    """
+    unsettled = {account: RawAmount(0) for account in accounts}
+    if not accounts:
+        return unsettled
+
+    db = modules.db.get_connection()
+    db_cursor = db.cursor()
+    db_cursor.execute("SELECT account, unsettled_raw FROM ledger_balances WHERE account IN ({})"
+                      .format(', '.join(['%s'] * len(unsettled))), list(unsettled))
+    for row in db_cursor.fetchall():
+        unsettled[row[0]] = RawAmount(int(row[1]))
+    db_cursor.close()
+    db.close()
+
+    return unsettled
+
+
+def add_unsettled(balances):
+    """
+    Add each account's unsettled ledger amount to the balances from modules.balances, returning new dicts so the cached
+    chain balances are left alone
+    """
+    unsettled = get_unsettled(list(balances))
+
+    return {account: {'balance': balance['balance'] + unsettled[account], 'pending': balance['pending']}
+            for account, balance in balances.items()}
+
+
+def transfer(sender_account, transfers):
+    """
+    Move tips from the sender to other bot accounts in the ledger.  transfers is a list of
+    (tip_id, receiver_account, RawAmount).  They're applied in one transaction, or not at all if the sender can't cover
+    the total.
+    """
+    total = RawAmount(sum(amount for tip_id, receiver_account, amount in transfers))
+    db = modules.db.get_connection()
+    db_cursor = db.cursor()
+    try:
+        unsettled = lock_accounts(db_cursor, [sender_account] + [transfer[1] for transfer in transfers])
+        balance = chain_balance(sender_account) + unsettled[sender_account]
+        if total > balance:
+            raise ValueError("Balance of {} is less than {}".format(balance.to_nano(), total.to_nano()))
+
+        for tip_id, receiver_account, amount in transfers:
+            db_cursor.execute("INSERT INTO ledger_transfers (tip_id, sender_account, receiver_account, amount_raw) "
+                              "VALUES (%s, %s, %s, %s)", (tip_id, sender_account, receiver_account, str(int(amount))))
+            db_cursor.execute("UPDATE ledger_balances SET unsettled_raw = unsettled_raw - %s WHERE account = %s",
+                              (str(int(amount)), sender_account))
+            db_cursor.execute("UPDATE ledger_balances SET unsettled_raw = unsettled_raw + %s WHERE account = %s",
+                              (str(int(amount)), receiver_account))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logging.info("Ledger transfer from %s failed: %s", sender_account, e)
+        raise e
+    finally:
+        db_cursor.close()
+        db.close()
+
+    logging.info("Ledger transferred %s NANO from %s in %s tips", total.to_nano(), sender_account, len(transfers))
+
+
+def transferred(tip_ids):
+    """
+    Return the tip_ids among the given ones that were already moved in the ledger
+    """
+    if not tip_ids:
+        return set()
+    transferred_call = "SELECT tip_id FROM ledger_transfers WHERE tip_id IN ({})".format(
+        ', '.join(['%s'] * len(tip_ids)))
+
+    return set(row[0] for row in modules.db.get_db_data(transferred_call, tip_ids))
+
+
+def publish_send(source, destination, amount, send_id=None):
+    """
+    Send amount on chain.  A send_id is published at most once, by the node wallet or, with local signing, by
+    send_blocks.
+    """
+    if modules.currency.LOCAL_SIGNING:
+        return modules.currency.send_blocks(source, [(send_id, destination, amount)])[0]
+
+    params = {
+        'wallet': WALLET,
+        'source': source,
+        'destination': destination,
+        'amount': str(int(amount))
+    }
+    work = modules.currency.get_pow(source)
+    if work != '':
+        params['work'] = work
+    if send_id is not None:
+        params['id'] = send_id
+    send_hash = rpc.call('send', params)['block']
+    modules.balances.invalidate_balance(source)
+
+    return send_hash
+
+
+def send(source, destination, amount, send_id):
+    """
+    Send amount on chain from an account that may have unsettled ledger amounts, for withdrawals, donations and tips to
+    unregistered users.  send_id makes the send idempotent.  The chain only holds the funds the account isn't owed by
+    the ledger, so if that doesn't cover the send, a settlement of just this account is queued and the caller is asked
+    to try again shortly.  Raises ValueError if the account can't cover the send now.
+    """
+    db = modules.db.get_connection()
+    db_cursor = db.cursor()
+    try:
+        unsettled = lock_accounts(db_cursor, [source])[source]
+        balance = chain_balance(source)
+        if amount > balance + unsettled:
+            raise ValueError("Balance of {} is less than {}".format((balance + unsettled).to_nano(), amount.to_nano()))
+        if amount <= balance + min(unsettled, 0):
+            return publish_send(source, destination, amount, send_id)
+    finally:
+        db.commit()
+        db_cursor.close()
+        db.close()
+
+    logging.info("%s is owed %s NANO by the ledger, queueing its settlement", source, unsettled.to_nano())
+    modules.jobs.enqueue('ledger_settle', {'account': source})
+    raise ValueError("{} NANO for {} is still waiting on settlement".format(amount.to_nano(), source))
+
+
+def plan_settlement(payee_account=None):
+    """
+    Net the unsettled amounts into sends from the accounts that owe the ledger to the accounts it owes.  The largest
+    debts are paired with the largest credits, so there's at most one send fewer than the accounts involved.  With a
+    payee_account, only the sends settling what the ledger owes that account are planned.
+    """
+    db_call = "SELECT account, unsettled_raw FROM ledger_balances WHERE unsettled_raw != 0"
+    rows = [(row[0], RawAmount(int(row[1]))) for row in modules.db.get_db_data(db_call)]
+    payers = sorted([[account, -amount] for account, amount in rows if amount < 0], key=lambda row: -row[1])
+    payees = sorted([[account, amount] for account, amount in rows if amount > 0 and
+                     payee_account in (None, account)], key=lambda row: -row[1])
+
+    settlement_call = ("INSERT INTO ledger_settlements (source_account, destination_account, amount_raw) "
+                       "VALUES (%s, %s, %s)")
+    payer_index = payee_index = 0
+    while payer_index < len(payers) and payee_index < len(payees):
+        payer, payee = payers[payer_index], payees[payee_index]
+        amount = min(payer[1], payee[1])
+        modules.db.set_db_data(settlement_call, [payer[0], payee[0], str(int(amount))])
+        payer[1] -= amount
+        payee[1] -= amount
+        if payer[1] == 0:
+            payer_index += 1
+        if payee[1] == 0:
+            payee_index += 1
+
+
+def apply_settlement(settlement_id, source, destination, amount):
+    """
+    Publish a planned settlement send and move the unsettled amounts by the same amount in one transaction, so the
+    spendable balances of both accounts don't change.  The send uses the settlement id as its wallet send id, so
+    rerunning a settlement that was interrupted after publishing doesn't send twice.
+    """
+    db = modules.db.get_connection()
+    db_cursor = db.cursor()
+    try:
+        lock_accounts(db_cursor, [source, destination])
+        try:
+            send_hash = publish_send(source, destination, amount, 'settle-{}'.format(settlement_id))
+        except (nano.rpc.RPCException, ValueError) as e:
+            # The source spent the funds on chain since the settlement was planned, the next plan picks up the rest.
+            # Locally signed sends raise ValueError for a short balance rather than going through the node.
+            logging.info("Settlement %s from %s failed: %s", settlement_id, source, e)
+            db_cursor.execute("UPDATE ledger_settlements SET settled = %s WHERE id = %s",
+                              (SETTLEMENT_FAILED, settlement_id))
+            db.commit()
+            return None
+
+        db_cursor.execute("UPDATE ledger_balances SET unsettled_raw = unsettled_raw + %s WHERE account = %s",
+                          (str(int(amount)), source))
+        db_cursor.execute("UPDATE ledger_balances SET unsettled_raw = unsettled_raw - %s WHERE account = %s",
+                          (str(int(amount)), destination))
+        db_cursor.execute("UPDATE ledger_settlements SET send_hash = %s, settled = %s WHERE id = %s",
+                          (send_hash, SETTLEMENT_SENT, settlement_id))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise e
+    finally:
+        db_cursor.close()
+        db.close()
+
+    modules.balances.invalidate_balance(destination)
+    logging.info("Settled %s NANO from %s to %s under hash %s", amount.to_nano(), source, destination, send_hash)
+    try:
+        modules.currency.receive_pending(destination)
+    except Exception as e:
+        logging.info("Error receiving settlement %s: %s", send_hash, e)
+
+    return send_hash
+
+
+def apply_planned_settlements():
+    """
+    Publish every settlement still planned, in order.  Returns how many there were.
+    """
+    settlements_call = ("SELECT id, source_account, destination_account, amount_raw FROM ledger_settlements "
+                        "WHERE settled = {} ORDER BY id".format(SETTLEMENT_PLANNED))
+    settlements = modules.db.get_db_data(settlements_call)
+    for settlement in settlements:
+        apply_settlement(settlement[0], settlement[1], settlement[2], RawAmount(int(settlement[3])))
+
+    return len(settlements)
+
+
+def settle():
+    """
+    Bring the ledger back on chain.  Settlements left planned by an interrupted run are finished before a new plan is
+    made.  Only one settlement runs at a time across processes.
+    """
+    lock = modules.db.get_lock(SETTLEMENT_LOCK, SETTLEMENT_LOCK_TIMEOUT)
+    try:
+        sends = apply_planned_settlements()
+        if not sends:
+            plan_settlement()
+            sends = apply_planned_settlements()
+    finally:
+        modules.db.release_lock(lock)
+
+    logging.info("Ledger settlement completed with %s sends", sends)
+
+
+def settle_account(account):
+    """
+    Job handler for sends that were short of on chain funds: settle only what the ledger owes the account, so the user
+    can try again without waiting for the next full settlement.  Takes the same lock as settle, so a settlement job
+    that can't get it in time fails and is retried.
+    """
+    lock = modules.db.get_lock(SETTLEMENT_LOCK, ACCOUNT_SETTLEMENT_LOCK_TIMEOUT)
+    try:
+        # Settlements an interrupted run left planned go first, as the unsettled amounts don't reflect them yet
+        sends = apply_planned_settlements()
+        plan_settlement(account)
+        sends += apply_planned_settlements()
+    finally:
+        modules.db.release_lock(lock)
+
+    logging.info("Settled %s with %s sends", account, sends)
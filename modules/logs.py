@@ -0,0 +1,198 @@
+import atexit
+import contextvars
+import fcntl
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import uuid
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+import modules.registry
+
+# Read config and parse constants
+config = modules.registry.config
+
+LOG_LEVEL = config.get('webhooks', 'log_level', fallback='INFO').upper()
+LOG_MAX_BYTES = config.getint('webhooks', 'log_max_bytes', fallback=50 * 1024 * 1024)
+LOG_BACKUPS = config.getint('webhooks', 'log_backups', fallback=5)
+# Share of events whose debug lines are written when log_level is DEBUG.  Info and above are always written.
+LOG_DEBUG_SAMPLE = config.getfloat('webhooks', 'log_debug_sample', fallback=0.1)
+
+# LogRecord attributes that aren't extra fields passed by the caller
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', logging.INFO, '', 0, '', (), None))) | {'message', 'event_id'}
+
+# Correlation ID of the event being handled, e.g. the tweet ID of a tip.  Kept per thread and per asyncio task.
+current_event = contextvars.ContextVar('event_id', default=None)
+
+
+def new_event_id():
+    return uuid.uuid4().hex[:16]
+
+
+def current_event_id():
+    return current_event.get()
+
+
+@contextmanager
+def correlation(event_id):
+    """
+    Tag every line logged in the block with the event ID
+    """
+    token = current_event.set(event_id)
+    try:
+        yield event_id
+    finally:
+        current_event.reset(token)
+
+
+class EventFilter(logging.Filter):
+    """
+    Stamps records with the caller's event ID, and passes only a sample of debug lines.  Sampling goes by event, so
+    an event that's sampled has all of its debug lines written.
+    """
+
+    def filter(self, record):
+        record.event_id = current_event.get()
+        if record.levelno >= logging.INFO or LOG_DEBUG_SAMPLE >= 1:
+            return True
+        if record.event_id is None:
+            return random.random() < LOG_DEBUG_SAMPLE
+        return zlib.crc32(record.event_id.encode('utf-8')) / 2 ** 32 < LOG_DEBUG_SAMPLE
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue as they are, so the message is only formatted on the listener thread.  The queue never
+    leaves the process, so nothing needs pickling, but arguments should not be changed after they are logged.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    One JSON object per line, with any extra= fields alongside the message
+    """
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'thread': record.threadName,
+            'event_id': getattr(record, 'event_id', None),
+            'message': record.getMessage()
+        }
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler several processes can write to.  Writes and rollovers hold an flock on a lock file next to
+    the log, and a process reopens the log once another process has rotated it.
+    """
+
+    def __init__(self, filename, max_bytes, backups):
+        super().__init__(filename, 'a', max_bytes, backups, 'utf-8', delay=True)
+        self.lock_path = '{}.lock'.format(self.baseFilename)
+        self.lock_file = None
+
+    def reopen_if_rotated(self):
+        if self.stream is None:
+            return
+        try:
+            current = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            current = None
+        opened = os.fstat(self.stream.fileno())
+        if current is None or (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino):
+            self.stream.close()
+            self.stream = None
+
+    def reset_after_fork(self):
+        # A forked child shares its parent's open lock file, and with it the flock, so it takes its own
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def emit(self, record):
+        try:
+            if self.lock_file is None:
+                self.lock_file = open(self.lock_path, 'a')
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                self.reopen_if_rotated()
+                if self.shouldRollover(record):
+                    self.doRollover()
+                logging.FileHandler.emit(self, record)
+            finally:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        except Exception:
+            self.handleError(record)
+
+
+# The process' pipeline, set up by the entry point
+queue_handler = None
+file_handler = None
+listener = None
+
+
+def setup(filename):
+    """
+    Send the process' logging through a queue to a listener thread writing to filename, so callers never wait on the
+    file.  Only the first call in a process takes effect.
+    """
+    global queue_handler, file_handler, listener
+    if listener is not None:
+        return
+
+    file_handler = SharedRotatingFileHandler(filename, LOG_MAX_BYTES, LOG_BACKUPS)
+    file_handler.setFormatter(StructuredFormatter())
+    queue_handler = DeferredQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(EventFilter())
+    logging.basicConfig(handlers=[queue_handler], level=LOG_LEVEL, force=True)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, file_handler)
+    listener.start()
+    atexit.register(stop)
+
+
+def stop():
+    """
+    Write out whatever is still queued
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def restart_after_fork():
+    """
+    The listener thread doesn't survive a fork, so the child starts its own on a new queue.  Lines the parent had
+    queued stay with the parent.
+    """
+    global listener
+    if listener is None:
+        return
+
+    file_handler.reset_after_fork()
+    queue_handler.queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(queue_handler.queue, file_handler)
+    listener.start()
+
+
+os.register_at_fork(after_in_child=restart_after_fork)
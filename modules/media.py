@@ -0,0 +1,76 @@
+import hashlib
+import io
+import logging
+import os
+import threading
+
+import pyqrcode
+
+import modules.db
+
+# QR codes are stored as 1-bit PNGs named after a hash of what they encode and how they were drawn, so any user with
+# the same account shares one file and changing the settings below never serves a stale image.
+QR_DIR = '{}/qr'.format(os.getcwd())
+QR_SCALE = 4
+QR_QUIET_ZONE = 2
+
+# Twitter media IDs are reused until shortly before Twitter expires them
+MEDIA_EXPIRY_MARGIN = 300
+
+
+def qr_key(account):
+    return hashlib.sha256('{}|{}|{}'.format(account, QR_SCALE, QR_QUIET_ZONE).encode('utf-8')).hexdigest()
+
+
+def qr_path(account):
+    """
+    Return the path of the account's QR code, rendering it into the store the first time it's asked for
+    """
+    path = '{}/{}.png'.format(QR_DIR, qr_key(account))
+    if os.path.isfile(path):
+        return path
+
+    logging.info("No QR exists, generating a QR for account %s", account)
+    png = io.BytesIO()
+    pyqrcode.create('{}'.format(account)).png(png, scale=QR_SCALE, quiet_zone=QR_QUIET_ZONE)
+    # Write then rename, so a sender never reads half a file
+    temp_path = '{}.{}-{}'.format(path, os.getpid(), threading.get_ident())
+    with open(temp_path, 'wb') as file:
+        file.write(png.getvalue())
+    os.replace(temp_path, path)
+
+    return path
+
+
+def media_key(path):
+    """
+    The key of a stored image in the media cache, the name it has in the store
+    """
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def get_media_id(key):
+    """
+    Return the Twitter media ID the image was last uploaded as, or None if there isn't one that's still usable
+    """
+    media_call = ("SELECT media_id FROM media_cache WHERE media_key = '{}' AND expires_ts > NOW()"
+                  .format(key.replace("'", "")))
+    media_data = modules.db.get_db_data(media_call)
+    if media_data:
+        return media_data[0][0]
+
+    return None
+
+
+def set_media_id(key, media_id, expires_after):
+    """
+    Remember the image's media ID for as long as Twitter allows it to be reused
+    """
+    media_call = ("INSERT INTO media_cache (media_key, media_id, expires_ts) "
+                  "VALUES (%s, %s, NOW() + INTERVAL %s SECOND) "
+                  "ON DUPLICATE KEY UPDATE media_id = VALUES(media_id), expires_ts = VALUES(expires_ts)")
+    modules.db.set_db_data(media_call, [key, media_id, max(0, int(expires_after) - MEDIA_EXPIRY_MARGIN)])
+
+
+def forget_media_id(key):
+    modules.db.set_db_data("DELETE FROM media_cache WHERE media_key = %s", [key])
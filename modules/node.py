@@ -0,0 +1,177 @@
+import logging
+import os
+import threading
+import time
+
+import nano
+
+import modules.registry
+
+# Read config and parse constants
+config = modules.registry.config
+
+# node_ip accepts a comma separated list of node endpoints.  Wallet calls go to wallet_node, which defaults to the
+# first one.
+NODE_IPS = [node_ip.strip() for node_ip in config.get('webhooks', 'node_ip').split(',') if node_ip.strip()]
+WALLET_NODE = config.get('webhooks', 'wallet_node', fallback=NODE_IPS[0])
+HEALTH_CHECK_INTERVAL = config.getint('webhooks', 'node_health_interval', fallback=10)
+MAX_BLOCK_LAG = config.getint('webhooks', 'node_max_block_lag', fallback=1000)
+LATENCY_WEIGHT = 0.2
+
+# Calls that don't touch the wallet and can be answered by any synced node
+READ_ACTIONS = {
+    'account_balance',
+    'accounts_balances',
+    'pending',
+    'accounts_pending',
+    'block_count',
+    'accounts_frontiers',
+    'validate_account_number'
+}
+
+
+class NodeRouter(object):
+    """
+    Drop in replacement for nano.rpc.Client that spreads calls over several nodes.  Read calls go to the healthy node
+    with the fewest calls in flight (then the lowest latency) and fail over to the next node on connection errors.
+    Everything else is pinned to the node holding the wallet.
+    """
+
+    def __init__(self, node_ips, wallet_node):
+        if wallet_node not in node_ips:
+            node_ips = [wallet_node] + node_ips
+        self.lock = threading.Lock()
+        self.nodes = [{
+            'ip': node_ip,
+            'client': nano.rpc.Client(node_ip),
+            'healthy': True,
+            'in_flight': 0,
+            'calls': 0,
+            'errors': 0,
+            'latency': 0.0,
+            'max_latency': 0.0,
+            'block_count': None
+        } for node_ip in node_ips]
+        self.wallet_node = [node for node in self.nodes if node['ip'] == wallet_node][0]
+        self.health_thread = None
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(nano.rpc.Client, name, None)):
+            raise AttributeError(name)
+
+        def routed_call(*args, **kwargs):
+            return self.request(name, name, args, kwargs)
+
+        return routed_call
+
+    def call(self, action, params=None):
+        return self.request(action, 'call', (action, params), {})
+
+    def candidates(self, action):
+        if action not in READ_ACTIONS:
+            return [self.wallet_node]
+
+        with self.lock:
+            healthy = [node for node in self.nodes if node['healthy']] or list(self.nodes)
+            return sorted(healthy, key=lambda node: (node['in_flight'], node['latency']))
+
+    def request(self, action, method, args, kwargs):
+        last_error = None
+        for node in self.candidates(action):
+            with self.lock:
+                node['in_flight'] += 1
+            start = time.time()
+            try:
+                result = getattr(node['client'], method)(*args, **kwargs)
+            except nano.rpc.RPCException:
+                # The node answered, the request itself was refused
+                self.record(node, time.time() - start, error=False)
+                raise
+            except Exception as e:
+                self.record(node, time.time() - start, error=True)
+                logging.info("RPC %s failed on node %s: %s", action, node['ip'], e)
+                last_error = e
+                continue
+
+            self.record(node, time.time() - start, error=False)
+            return result
+
+        raise last_error
+
+    def record(self, node, latency, error):
+        with self.lock:
+            node['in_flight'] -= 1
+            node['calls'] += 1
+            if error:
+                node['errors'] += 1
+                node['healthy'] = False
+            else:
+                node['latency'] = latency if node['calls'] == 1 else (
+                    (1 - LATENCY_WEIGHT) * node['latency'] + LATENCY_WEIGHT * latency)
+                node['max_latency'] = max(node['max_latency'], latency)
+
+    def check_health(self):
+        """
+        Ask every node for its block count.  Nodes that fail, or are more than MAX_BLOCK_LAG blocks behind the best
+        node, are taken out of the read rotation until a later check passes.
+        """
+        for node in self.nodes:
+            start = time.time()
+            try:
+                node['block_count'] = int(node['client'].block_count()['count'])
+                latency = time.time() - start
+                with self.lock:
+                    node['latency'] = (1 - LATENCY_WEIGHT) * node['latency'] + LATENCY_WEIGHT * latency
+                    node['max_latency'] = max(node['max_latency'], latency)
+            except Exception as e:
+                logging.info("Health check failed for node %s: %s", node['ip'], e)
+                node['block_count'] = None
+
+        best_count = max([node['block_count'] or 0 for node in self.nodes])
+        with self.lock:
+            for node in self.nodes:
+                node['healthy'] = (node['block_count'] is not None
+                                   and best_count - node['block_count'] <= MAX_BLOCK_LAG)
+
+    def health_loop(self):
+        while True:
+            self.check_health()
+            time.sleep(HEALTH_CHECK_INTERVAL)
+
+    def start_health_checks(self):
+        if len(self.nodes) > 1 and (self.health_thread is None or not self.health_thread.is_alive()):
+            self.health_thread = threading.Thread(target=self.health_loop, name='node-health', daemon=True)
+            self.health_thread.start()
+
+    def stats(self):
+        """
+        Per node call counts, errors and latency in milliseconds.  These are served publicly, so nodes are numbered in
+        config order rather than named by their address, and which one holds the wallet isn't said.
+        """
+        with self.lock:
+            return [{
+                'node': index,
+                'healthy': node['healthy'],
+                'in_flight': node['in_flight'],
+                'calls': node['calls'],
+                'errors': node['errors'],
+                'latency_ms': round(node['latency'] * 1000, 1),
+                'max_latency_ms': round(node['max_latency'] * 1000, 1),
+                'block_count': node['block_count']
+            } for index, node in enumerate(self.nodes)]
+
+    def reset_after_fork(self):
+        """
+        Give a forked child its own lock and node sessions.  The health thread didn't survive the fork, so it's started
+        again by the next start_health_checks.
+        """
+        self.lock = threading.Lock()
+        for node in self.nodes:
+            node['client'] = nano.rpc.Client(node['ip'])
+            node['in_flight'] = 0
+        self.health_thread = None
+
+
+# Shared router for all modules
+rpc = NodeRouter(NODE_IPS, WALLET_NODE)
+os.register_at_fork(after_in_child=rpc.reset_after_fork)
@@ -1,244 +1,139 @@
-import configparser
 import logging
-import os
-from datetime import datetime
-from decimal import Decimal
-from http import HTTPStatus
-
-import nano
 
+import modules.balances
+import modules.commands
 import modules.currency
 import modules.db
+import modules.events
+import modules.ledger
+import modules.node
+import modules.registry
 import modules.social
-
-# Set Log File
-logging.basicConfig(handlers=[logging.FileHandler('{}/webhooks.log'.format(os.getcwd()), 'a', 'utf-8')],
-                    level=logging.INFO)
+from modules.amount import RawAmount
 
 # Read config and parse constants
-config = configparser.ConfigParser()
-config.read('{}/webhookconfig.ini'.format(os.getcwd()))
+config = modules.registry.config
 
 # Set constants
 BULLET = u"\u2022"
-NODE_IP = config.get('webhooks', 'node_ip')
 WALLET = config.get('webhooks', 'wallet')
 BOT_ID_TWITTER = config.get('webhooks', 'bot_id_twitter')
 BOT_NAME = config.get('webhooks', 'bot_name')
 BOT_ACCOUNT = config.get('webhooks', 'bot_account')
 MIN_TIP = config.get('webhooks', 'min_tip')
-
-balance_commands = [
-    '!balance',
-    '!bal',
-    '!b',
-    '/balance',
-    '/bal',
-    '/b'
-]
-
-account_commands = [
-    '!account',
-    '!acc',
-    '!a',
-    '!deposit',
-    '/account',
-    '/acc',
-    '/a',
-    '/deposit'
-]
-
-help_commands = [
-    '!help',
-    '!h',
-    '/help',
-    '/h',
-    '/start'
-]
-
-register_commands = [
-    '!register',
-    '!reg',
-    '!r',
-    '/register',
-    '/reg',
-    '/r'
-]
-
-withdraw_commands = [
-    '!withdraw',
-    '!w',
-    '/withdraw',
-    '/w'
-]
-
-donate_commands = [
-    '!donate',
-    '!d',
-    '/donate',
-    '/d'
-]
-
-tip_commands = [
-    '!tip',
-    '!t',
-    '/tip',
-    '/t'
-]
-
-private_tip_commands = [
-    '!privatetip',
-    '!private',
-    '!pt',
-    '/privatetip',
-    '/private',
-    '/pt'
-]
+MIN_TIP_RAW = RawAmount.from_nano(MIN_TIP)
 
 # Connect to global functions
-rpc = nano.rpc.Client(NODE_IP)
+rpc = modules.node.rpc
 
 
-def parse_action(message):
-    if message['dm_action'] in help_commands:
-        new_pid = os.fork()
-        if new_pid == 0:
-            try:
-                help_process(message)
-            except Exception as e:
-                logging.info("Exception: {}".format(e))
-                raise e
-            os._exit(0)
-        else:
-            return '', HTTPStatus.OK
+def command_send_id(message):
+    """
+    Send ID for the send a DM command makes: its action, platform and DM ID.  Every attempt at the command sends under
+    the same ID, so the funds move at most once.
+    """
+    return '{}-{}-{}'.format(message['command'].action, message['system'], message['dm_id'])
 
-    elif message['dm_action'] in balance_commands:
-        new_pid = os.fork()
-        if new_pid == 0:
-            try:
-                bot_status = config.get('webhooks', 'bot_status')
-                if bot_status == 'maintenance':
-                    modules.social.send_dm(message['sender_id'],
-                                           "The tip bot is in maintenance.  Check @NanoTipBot on Twitter for more "
-                                           "information.", message['system'])
-                else:
-                    balance_process(message)
-            except Exception as e:
-                logging.info("Exception: {}".format(e))
-                raise e
-            os._exit(0)
-        else:
-            return '', HTTPStatus.OK
 
-    elif message['dm_action'] in register_commands:
-        new_pid = os.fork()
-        if new_pid == 0:
-            try:
-                bot_status = config.get('webhooks', 'bot_status')
-                if bot_status == 'maintenance':
-                    modules.social.send_dm(message['sender_id'],
-                                           "The tip bot is in maintenance.  Check @NanoTipBot on Twitter for more "
-                                           "information.", message['system'])
-                else:
-                    register_process(message)
-            except Exception as e:
-                logging.info("Exception: {}".format(e))
-                raise e
-            os._exit(0)
-        else:
-            return '', HTTPStatus.OK
+def get_command_send(message):
+    """
+    Return the send an earlier attempt at this DM command planned, as {'destination', 'amount', 'send_hash'} with
+    send_hash None if it may not have been made, or None if no attempt got that far
+    """
+    send_call = "SELECT destination_account, amount_raw, send_hash FROM command_sends WHERE send_id = %s"
+    send_data = modules.db.get_db_data(send_call, [command_send_id(message)])
+    if not send_data:
+        return None
 
-    elif message['dm_action'] in tip_commands:
-        new_pid = os.fork()
-        if new_pid == 0:
-            try:
-                redirect_tip_text = ("Tips are processed through public messages now.  Please send in the format "
-                                     "@NanoTipBot !tip .0001 @user1.")
-                modules.social.send_dm(message['sender_id'], redirect_tip_text, message['system'])
-            except Exception as e:
-                logging.info("Exception: {}".format(e))
-                raise e
-            os._exit(0)
-        else:
-            return '', HTTPStatus.OK
+    return {'destination': send_data[0][0], 'amount': RawAmount(int(send_data[0][1])), 'send_hash': send_data[0][2]}
 
-    elif message['dm_action'] in withdraw_commands:
-        new_pid = os.fork()
-        if new_pid == 0:
-            try:
-                bot_status = config.get('webhooks', 'bot_status')
-                if bot_status == 'maintenance':
-                    modules.social.send_dm(message['sender_id'],
-                                           "The tip bot is in maintenance.  Check @NanoTipBot on Twitter for more "
-                                           "information.", message['system'])
-                else:
-                    withdraw_process(message)
-            except Exception as e:
-                logging.info("Exception: {}".format(e))
-                raise e
-            os._exit(0)
-        else:
-            return '', HTTPStatus.OK
 
-    elif message['dm_action'] in donate_commands:
-        new_pid = os.fork()
-        if new_pid == 0:
-            try:
-                bot_status = config.get('webhooks', 'bot_status')
-                if bot_status == 'maintenance':
-                    modules.social.send_dm(message['sender_id'], "The tip bot is in maintenance.  Check @NanoTipBot on "
-                                                                 "Twitter for more information.", message['system'])
-                else:
-                    donate_process(message)
-            except Exception as e:
-                logging.info("Exception: {}".format(e))
-                raise e
-            os._exit(0)
+def make_command_send(message, source, destination, amount):
+    """
+    Send the funds for a DM command under its send ID.  The send is recorded before it's made and its hash right
+    after, so a retried job finishes this send instead of checking the balance it spent, or sending again.  Raises
+    ValueError if a ledger account's funds are still being settled, in which case no send was made.
+    """
+    send_id = command_send_id(message)
+    plan_call = ("INSERT IGNORE INTO command_sends (send_id, source_account, destination_account, amount_raw) "
+                 "VALUES (%s, %s, %s, %s)")
+    modules.db.set_db_data(plan_call, [send_id, source, destination, str(int(amount))])
+    try:
+        if modules.ledger.LEDGER_MODE:
+            send_hash = modules.ledger.send(source, destination, amount, send_id)
         else:
-            return '', HTTPStatus.OK
+            send_hash = modules.ledger.publish_send(source, destination, amount, send_id)
+    except ValueError as e:
+        modules.db.set_db_data("DELETE FROM command_sends WHERE send_id = %s AND send_hash IS NULL", [send_id])
+        raise e
+    modules.db.set_db_data("UPDATE command_sends SET send_hash = %s WHERE send_id = %s", [send_hash, send_id])
+    logging.info("send %s made under %s", send_hash, send_id)
 
-    elif message['dm_action'] in account_commands:
-        new_pid = os.fork()
-        if new_pid == 0:
-            try:
-                account_process(message)
-            except Exception as e:
-                logging.info("Exception: {}".format(e))
-                raise e
-            os._exit(0)
-        else:
-            return '', HTTPStatus.OK
+    return send_hash
 
-    elif message['dm_action'] in private_tip_commands:
-        new_pid = os.fork()
-        if new_pid == 0:
-            try:
-                private_tip_text = ("Private Tip is under maintenance.  To send your tip, use the !tip function in a "
-                                     "tweet or reply!")
-                modules.social.send_dm(message['sender_id'], private_tip_text, message['system'])
-            except Exception as e:
-                logging.info("Exception: {}".format(e))
-                raise e
-            os._exit(0)
-        else:
-            return '', HTTPStatus.OK
 
-    else:
-        new_pid = os.fork()
-        if new_pid == 0:
-            try:
-                wrong_format_text = ("The command or syntax you sent is not recognized.  Please send !help for a list "
-                                     "of commands and what they do.")
-                modules.social.send_dm(message['sender_id'], wrong_format_text, message['system'])
-                logging.info('unrecognized syntax')
-            except Exception as e:
-                logging.info("Exception: {}".format(e))
-                raise e
-            os._exit(0)
-        else:
-            return '', HTTPStatus.OK
+def resume_command_send(message, source):
+    """
+    Finish the send an earlier attempt at this DM command planned.  Returns (amount, send hash), or None if no attempt
+    got as far as planning one.
+    """
+    planned = get_command_send(message)
+    if planned is None:
+        return None
+    send_hash = planned['send_hash']
+    if send_hash is None:
+        logging.info("Resuming %s", command_send_id(message))
+        send_hash = make_command_send(message, source, planned['destination'], planned['amount'])
 
-    return '', HTTPStatus.OK
+    return planned['amount'], send_hash
+
+
+def parse_action(message):
+    """
+    Run the command sent in a DM.  This is called from a job worker, so the command runs in the worker's process.
+    """
+    try:
+        action = message['command'].action
+        if action == 'help':
+            help_process(message)
+
+        elif action == 'balance':
+            if not modules.events.check_maintenance(message):
+                balance_process(message)
+
+        elif action == 'register':
+            if not modules.events.check_maintenance(message):
+                register_process(message)
+
+        elif action == 'tip':
+            redirect_tip_text = ("Tips are processed through public messages now.  Please send in the format "
+                                 "@NanoTipBot !tip .0001 @user1.")
+            modules.social.send_dm(message['sender_id'], redirect_tip_text, message['system'])
+
+        elif action == 'withdraw':
+            if not modules.events.check_maintenance(message):
+                withdraw_process(message)
+
+        elif action == 'donate':
+            if not modules.events.check_maintenance(message):
+                donate_process(message)
+
+        elif action == 'account':
+            account_process(message)
+
+        elif action == 'privatetip':
+            private_tip_text = ("Private Tip is under maintenance.  To send your tip, use the !tip function in a "
+                                "tweet or reply!")
+            modules.social.send_dm(message['sender_id'], private_tip_text, message['system'])
+
+        else:
+            wrong_format_text = ("The command or syntax you sent is not recognized.  Please send !help for a list "
+                                 "of commands and what they do.")
+            modules.social.send_dm(message['sender_id'], wrong_format_text, message['system'])
+            logging.info('unrecognized syntax')
+    except Exception as e:
+        logging.info("Exception: %s", e)
+        raise e
 
 
 def help_process(message):
@@ -270,19 +165,19 @@ def help_process(message):
                        "Bot donation account to help fund development efforts."
     )
     modules.social.send_dm(message['sender_id'], help_message, message['system'])
-    logging.info("{}: Help message sent!".format(datetime.now()))
+    logging.info("Help message sent!")
 
 
 def balance_process(message):
     """
     When the user sends a DM containing !balance, reply with the balance of the account linked with their Twitter ID
     """
-    logging.info("{}: In balance process".format(datetime.now()))
+    logging.info("In balance process")
     balance_call = ("SELECT account, register FROM users WHERE user_id = {} "
                     "AND users.system = '{}'".format(message['sender_id'], message['system']))
     data = modules.db.get_db_data(balance_call)
     if not data:
-        logging.info("{}: User tried to check balance without an account".format(datetime.now()))
+        logging.info("User tried to check balance without an account")
         no_account_text = ("There is no account linked to your username.  Please respond with !register to "
                            "create an account.")
         modules.social.send_dm(message['sender_id'], no_account_text, message['system'])
@@ -294,29 +189,25 @@ def balance_process(message):
             set_register_call = "UPDATE users SET register = 1 WHERE user_id = %s AND users.system = %s AND register = 0"
             set_register_values = [message['sender_id'], message['system']]
             modules.db.set_db_data(set_register_call, set_register_values)
-        new_pid = os.fork()
-        if new_pid == 0:
-            modules.currency.receive_pending(message['sender_account'])
-            os._exit(0)
 
-        balance_return = rpc.account_balance(account="{}".format(message['sender_account']))
+        balance_return = modules.balances.get_balance(message['sender_account'])
         message['sender_balance_raw'] = balance_return['balance']
         message['sender_pending_raw'] = balance_return['pending']
-        message['sender_balance'] = balance_return['balance'] / 1000000000000000000000000000000
-        message['sender_pending'] = balance_return['pending'] / 1000000000000000000000000000000
-        if message['sender_balance'] == 0 and message['sender_pending'] == 0:
+        message['sender_balance'] = message['sender_balance_raw'].to_nano()
+        message['sender_pending'] = message['sender_pending_raw'].to_nano()
+        if message['sender_balance_raw'] == 0 and message['sender_pending_raw'] == 0:
             balance_text = "Your balance is 0 NANO."
-        elif message['sender_balance'] == 0 and message['sender_pending'] > 0:
+        elif message['sender_balance_raw'] == 0 and message['sender_pending_raw'] > 0:
             balance_text = "Available: 0 NANO\n" \
                            "Pending: {} NANO".format(message['sender_pending'])
-        elif message['sender_balance'] > 0 and message['sender_pending'] == 0:
+        elif message['sender_balance_raw'] > 0 and message['sender_pending_raw'] == 0:
             balance_text = "Available: {} NANO\n" \
                            "Pending: 0 NANO".format(message['sender_balance'])
         else:
             balance_text = "Available: {} NANO\n" \
                            "Pending: {} NANO".format(message['sender_balance'], message['sender_pending'])
         modules.social.send_dm(message['sender_id'], balance_text, message['system'])
-        logging.info("{}: Balance Message Sent!".format(datetime.now()))
+        logging.info("Balance Message Sent!")
         modules.currency.receive_pending(message['sender_account'])
 
 
@@ -325,7 +216,7 @@ def register_process(message):
     When the user sends !register, create an account for them and mark it registered.  If they already have an account
     reply with their account number.
     """
-    logging.info("{}: In register process.".format(datetime.now()))
+    logging.info("In register process.")
     register_call = ("SELECT account, register FROM users WHERE user_id = {} AND users.system = '{}'"
                      .format(message['sender_id'], message['system']))
     data = modules.db.get_db_data(register_call)
@@ -341,7 +232,7 @@ def register_process(message):
         account_register_text = "You have successfully registered for an account.  Your account number is:"
         modules.social.send_account_message(account_register_text, message, sender_account)
 
-        logging.info("{}: Register successful!".format(datetime.now()))
+        logging.info("Register successful!")
 
     elif data[0][1] == 0:
         # The user has an account, but needed to register, so send a message to the user with their account
@@ -353,7 +244,7 @@ def register_process(message):
         account_register_text = "You have successfully registered for an account.  Your account number is:"
         modules.social.send_account_message(account_register_text, message, sender_account)
 
-        logging.info("{}: User has an account, but needed to register.  Message sent".format(datetime.now()))
+        logging.info("User has an account, but needed to register.  Message sent")
 
     else:
         # The user had an account and already registered, so let them know their account.
@@ -361,7 +252,7 @@ def register_process(message):
         account_already_registered = "You already have registered your account.  Your account number is:"
         modules.social.send_account_message(account_already_registered, message, sender_account)
 
-        logging.info("{}: User has a registered account.  Message sent.".format(datetime.now()))
+        logging.info("User has a registered account.  Message sent.")
 
 
 def account_process(message):
@@ -369,13 +260,13 @@ def account_process(message):
     If the user sends !account command, reply with their account.  If there is no account, create one, register it
     and reply to the user.
     """
-    logging.info("{}: In account process.".format(datetime.now()))
+    logging.info("In account process.")
     sender_account_call = (
         "SELECT account, register FROM users WHERE user_id = {} AND users.system = '{}'".format(message['sender_id'],
                                                                                                 message['system']))
     account_data = modules.db.get_db_data(sender_account_call)
     if not account_data:
-        logging.info("Creating account using wallet: {}".format(WALLET))
+        logging.info("Creating account using wallet: %s", WALLET)
         sender_account = rpc.account_create(wallet="{}".format(WALLET), work=True)
         account_create_call = ("INSERT INTO users (user_id, system, user_name, account, register) "
                                "VALUES(%s, %s, %s, %s, 1)")
@@ -385,7 +276,7 @@ def account_process(message):
         account_create_text = "You didn't have an account set up, so I set one up for you.  Your account number is:"
         modules.social.send_account_message(account_create_text, message, sender_account)
 
-        logging.info("{}: Created an account for the user!".format(datetime.now()))
+        logging.info("Created an account for the user!")
 
     else:
         sender_account = account_data[0][0]
@@ -400,7 +291,7 @@ def account_process(message):
         account_text = "Your account number is:"
         modules.social.send_account_message(account_text, message, sender_account)
 
-        logging.info("{}: Sent the user their account number.".format(datetime.now()))
+        logging.info("Sent the user their account number.")
 
 
 def withdraw_process(message):
@@ -408,9 +299,10 @@ def withdraw_process(message):
     When the user sends !withdraw, send their entire balance to the provided account.  If there is no provided account
     reply with an error.
     """
-    logging.info('{}: in withdraw process.'.format(datetime.now()))
-    # check if there is a 2nd argument
-    if 3 >= len(message['dm_array']) >= 2:
+    logging.info("in withdraw process.")
+    command = message['command']
+    # check that an account to withdraw to was sent
+    if command.address is not None:
         # if there is, retrieve the sender's account and wallet
         withdraw_account_call = ("SELECT account, register FROM users WHERE user_id = {} AND users.system = '{}'"
                                  .format(message['sender_id'], message['system']))
@@ -419,7 +311,7 @@ def withdraw_process(message):
         if not withdraw_data:
             withdraw_no_account_text = "You do not have an account.  Respond with !register to set one up."
             modules.social.send_dm(message['sender_id'], withdraw_no_account_text, message['system'])
-            logging.info("{}: User tried to withdraw with no account".format(datetime.now()))
+            logging.info("User tried to withdraw with no account")
 
         else:
             sender_account = withdraw_data[0][0]
@@ -431,63 +323,57 @@ def withdraw_process(message):
                 set_register_values = [message['sender_id'], message['system']]
                 modules.db.set_db_data(set_register_call, set_register_values)
 
+            try:
+                sent = resume_command_send(message, sender_account)
+            except ValueError as e:
+                logging.info("Ledger withdraw failed: %s", e)
+                send_settlement_reply(message, 'withdraw')
+                return
+            if sent is not None:
+                send_withdraw_reply(message, *sent)
+                return
+
             modules.currency.receive_pending(sender_account)
-            balance_return = rpc.account_balance(account='{}'.format(sender_account))
+            balance_raw = modules.balances.get_balance(sender_account, fresh=True)['balance']
 
-            if len(message['dm_array']) == 2:
-                receiver_account = message['dm_array'][1].lower()
-            else:
-                receiver_account = message['dm_array'][2].lower()
+            receiver_account = command.address
 
             if rpc.validate_account_number(receiver_account) == 0:
                 invalid_account_text = ("The account number you provided is invalid.  Please double check and "
                                         "resend your request.")
                 modules.social.send_dm(message['sender_id'], invalid_account_text, message['system'])
-                logging.info("{}: The xrb account number is invalid: {}".format(datetime.now(), receiver_account))
+                logging.info("The xrb account number is invalid: %s", receiver_account)
 
-            elif balance_return['balance'] == 0:
+            elif balance_raw == 0:
                 no_balance_text = ("You have 0 balance in your account.  Please deposit to your address {} to "
                                    "send more tips!".format(sender_account))
                 modules.social.send_dm(message['sender_id'], no_balance_text, message['system'])
-                logging.info("{}: The user tried to withdraw with 0 balance".format(datetime.now()))
+                logging.info("The user tried to withdraw with 0 balance")
 
             else:
-                if len(message['dm_array']) == 3:
-                    try:
-                        withdraw_amount = Decimal(message['dm_array'][1])
-                    except Exception as e:
-                        logging.info("{}: withdraw no number ERROR: {}".format(datetime.now(), e))
+                if command.amount_text is not None:
+                    withdraw_amount_raw = command.amount
+                    if withdraw_amount_raw is None:
+                        logging.info("withdraw no number ERROR: %s", command.amount_text)
                         invalid_amount_text = ("You did not send a number to withdraw.  Please resend with the format"
                                                "!withdraw <account> or !withdraw <amount> <account>")
                         modules.social.send_dm(message['sender_id'], invalid_amount_text, message['system'])
                         return
-                    withdraw_amount_raw = int(withdraw_amount * 1000000000000000000000000000000)
-                    if Decimal(withdraw_amount_raw) > Decimal(balance_return['balance']):
+                    if withdraw_amount_raw > balance_raw:
                         not_enough_balance_text = ("You do not have that much NANO in your account.  To withdraw your "
                                                    "full amount, send !withdraw <account>")
                         modules.social.send_dm(message['sender_id'], not_enough_balance_text, message['system'])
                         return
                 else:
-                    withdraw_amount_raw = balance_return['balance']
-                    withdraw_amount = balance_return['balance'] / 1000000000000000000000000000000
+                    withdraw_amount_raw = balance_raw
                 # send the total balance to the provided account
-                work = modules.currency.get_pow(sender_account)
-                if work == '':
-                    logging.info("{}: processed without work".format(datetime.now()))
-                    send_hash = rpc.send(wallet="{}".format(WALLET), source="{}".format(sender_account),
-                                         destination="{}".format(receiver_account), amount=withdraw_amount_raw)
-                else:
-                    logging.info("{}: processed with work: {} using wallet: {}".format(datetime.now(), work, WALLET))
-                    send_hash = rpc.send(wallet="{}".format(WALLET), source="{}".format(sender_account),
-                                         destination="{}".format(receiver_account), amount=withdraw_amount_raw,
-                                         work=work)
-                logging.info("{}: send_hash = {}".format(datetime.now(), send_hash))
-                # respond that the withdraw has been processed
-                withdraw_text = ("You have successfully withdrawn {} NANO!  You can check the "
-                                 "transaction at https://nanocrawler.cc/explorer/block/{}"
-                                 .format(withdraw_amount, send_hash))
-                modules.social.send_dm(message['sender_id'], withdraw_text, message['system'])
-                logging.info("{}: Withdraw processed.  Hash: {}".format(datetime.now(), send_hash))
+                try:
+                    send_hash = make_command_send(message, sender_account, receiver_account, withdraw_amount_raw)
+                except ValueError as e:
+                    logging.info("Ledger withdraw failed: %s", e)
+                    send_settlement_reply(message, 'withdraw')
+                    return
+                send_withdraw_reply(message, withdraw_amount_raw, send_hash)
     else:
         incorrect_withdraw_text = ("I didn't understand your withdraw request.  Please resend with !withdraw "
                                    "<optional:amount> <account>.  Example, !withdraw 1 xrb_aigakjkfa343tm3h1kj would "
@@ -495,7 +381,22 @@ def withdraw_process(message):
                                    "xrb_aigakjkfa343tm3h1kj would withdraw your entire balance to account "
                                    "xrb_aigakjkfa343tm3h1kj.")
         modules.social.send_dm(message['sender_id'], incorrect_withdraw_text, message['system'])
-        logging.info("{}: User sent a withdraw with invalid syntax.".format(datetime.now()))
+        logging.info("User sent a withdraw with invalid syntax.")
+
+
+def send_settlement_reply(message, action):
+    settlement_text = ("Part of your balance is still being settled.  Please try your {} again in a few "
+                       "minutes.".format('withdraw' if action == 'withdraw' else 'donation'))
+    modules.social.send_dm(message['sender_id'], settlement_text, message['system'])
+
+
+def send_withdraw_reply(message, withdraw_amount_raw, send_hash):
+    # respond that the withdraw has been processed
+    withdraw_text = ("You have successfully withdrawn {} NANO!  You can check the "
+                     "transaction at https://nanocrawler.cc/explorer/block/{}"
+                     .format(withdraw_amount_raw.to_nano(), send_hash))
+    modules.social.send_dm(message['sender_id'], withdraw_text, message['system'])
+    logging.info("Withdraw processed.  Hash: %s", send_hash)
 
 
 def donate_process(message):
@@ -503,75 +404,79 @@ def donate_process(message):
     When the user sends !donate, send the provided amount from the user's account to the tip bot's donation wallet.
     If the user has no balance or account, reply with an error.
     """
-    logging.info("{}: in donate_process.".format(datetime.now()))
+    logging.info("in donate_process.")
 
-    if len(message['dm_array']) >= 2:
+    command = message['command']
+    if command.amount_text is not None:
         sender_account_call = (
             "SELECT account FROM users where user_id = {} and users.system = '{}'".format(message['sender_id'],
                                                                                           message['system']))
         donate_data = modules.db.get_db_data(sender_account_call)
         sender_account = donate_data[0][0]
-        send_amount = message['dm_array'][1]
+
+        try:
+            sent = resume_command_send(message, sender_account)
+        except ValueError as e:
+            logging.info("Ledger donation failed: %s", e)
+            send_settlement_reply(message, 'donate')
+            return ''
+        if sent is not None:
+            send_donate_reply(message, *sent)
+            return ''
 
         modules.currency.receive_pending(sender_account)
 
-        balance_return = rpc.account_balance(account='{}'.format(sender_account))
-        balance = balance_return['balance'] / 1000000000000000000000000000000
+        balance_raw = modules.balances.get_balance(sender_account, fresh=True)['balance']
         receiver_account = BOT_ACCOUNT
 
-        try:
-            logging.info("{}: The user is donating {} NANO".format(datetime.now(), Decimal(send_amount)))
-        except Exception as e:
-            logging.info("{}: ERROR IN CONVERTING DONATION AMOUNT: {}".format(datetime.now(), e))
+        send_amount_raw = command.amount
+        if send_amount_raw is None:
+            logging.info("ERROR IN CONVERTING DONATION AMOUNT: %s", command.amount_text)
             wrong_donate_text = "Only number amounts are accepted.  Please resend as !donate 1234"
             modules.social.send_dm(message['sender_id'], wrong_donate_text, message['system'])
             return ''
-        logging.info("balance: {} - send_amount: {}".format(Decimal(balance), Decimal(send_amount)))
-        if Decimal(balance) < Decimal(send_amount):
+        logging.info("The user is donating %s NANO", send_amount_raw.to_nano())
+        logging.info("balance: %s - send_amount: %s", balance_raw.to_nano(), send_amount_raw.to_nano())
+        if balance_raw < send_amount_raw:
             large_donate_text = ("Your balance is only {} NANO and you tried to send {}.  Please add more NANO"
-                                 " to your account, or lower your donation amount.".format(balance,
-                                                                                           Decimal(send_amount)))
+                                 " to your account, or lower your donation amount.".format(balance_raw.to_nano(),
+                                                                                           send_amount_raw.to_nano()))
             modules.social.send_dm(message['sender_id'], large_donate_text, message['system'])
-            logging.info("{}: User tried to donate more than their balance.".format(datetime.now()))
+            logging.info("User tried to donate more than their balance.")
 
-        elif Decimal(send_amount) < Decimal(MIN_TIP):
+        elif send_amount_raw < MIN_TIP_RAW:
             small_donate_text = ("The minimum donation amount is {}.  Please update your donation amount "
                                  "and resend.".format(MIN_TIP))
             modules.social.send_dm(message['sender_id'], small_donate_text, message['system'])
-            logging.info("{}: User tried to donate less than 0.000001".format(datetime.now()))
+            logging.info("User tried to donate less than 0.000001")
 
         else:
-            send_amount_raw = Decimal(send_amount) * 1000000000000000000000000000000
-            work = modules.currency.get_pow(sender_account)
-            if work == '':
-                logging.info("{}: Processing donation without work.".format(datetime.now()))
-                send_hash = rpc.send(wallet="{}".format(WALLET), source="{}".format(sender_account),
-                                     destination="{}".format(receiver_account), amount="{:f}".format(send_amount_raw))
-            else:
-                logging.info("{}: Processing donation with work: {}".format(datetime.now(), work))
-                send_hash = rpc.send(wallet="{}".format(WALLET), source="{}".format(sender_account),
-                                     destination="{}".format(receiver_account), amount="{:f}".format(send_amount_raw),
-                                     work=work)
-
-            logging.info("{}: send_hash = {}".format(datetime.now(), send_hash))
-
-            donate_text = ("Thank you for your generosity!  You have successfully donated {} NANO!  You can check the "
-                           "transaction at https://nanocrawler.cc/explorer/block/{}".format(send_amount, send_hash))
-            modules.social.send_dm(message['sender_id'], donate_text, message['system'])
-            logging.info("{}: {} NANO donation processed.  Hash: {}".format(datetime.now(), Decimal(send_amount),
-                                                                            send_hash))
+            try:
+                send_hash = make_command_send(message, sender_account, receiver_account, send_amount_raw)
+            except ValueError as e:
+                logging.info("Ledger donation failed: %s", e)
+                send_settlement_reply(message, 'donate')
+                return ''
+            send_donate_reply(message, send_amount_raw, send_hash)
 
     else:
         incorrect_donate_text = "Incorrect syntax.  Please use the format !donate 1234"
         modules.social.send_dm(message['sender_id'], incorrect_donate_text, message['system'])
-        logging.info("{}: User sent a donation with invalid syntax".format(datetime.now()))
+
+
+def send_donate_reply(message, send_amount_raw, send_hash):
+    donate_text = ("Thank you for your generosity!  You have successfully donated {} NANO!  You can check the "
+                   "transaction at https://nanocrawler.cc/explorer/block/{}".format(send_amount_raw.to_nano(),
+                                                                                    send_hash))
+    modules.social.send_dm(message['sender_id'], donate_text, message['system'])
+    logging.info("%s NANO donation processed.  Hash: %s", send_amount_raw.to_nano(), send_hash)
 
 
 def tip_process(message, users_to_tip, request_json):
     """
     Main orchestration process to handle tips
     """
-    logging.info("{}: in tip_process".format(datetime.now()))
+    logging.info("in tip_process")
 
     message, users_to_tip = modules.social.set_tip_list(message, users_to_tip, request_json)
     if len(users_to_tip) < 1 and message['system'] != 'telegram':
@@ -580,6 +485,11 @@ def tip_process(message, users_to_tip, request_json):
         modules.social.send_reply(message, no_users_text)
         return
 
+    # A retried job only sends the tips its earlier attempts didn't record
+    if users_to_tip and modules.currency.find_unsent_tips(message, users_to_tip) == 0:
+        logging.info("Tips for %s were already sent.", message['id'])
+        return
+
     message = modules.social.validate_sender(message)
     if message['sender_account'] is None or message['tip_amount'] <= 0:
         return
@@ -588,8 +498,7 @@ def tip_process(message, users_to_tip, request_json):
     if message['tip_amount'] <= 0:
         return
 
-    for t_index in range(0, len(users_to_tip)):
-        modules.currency.send_tip(message, users_to_tip, t_index)
+    modules.currency.send_tips(message, users_to_tip)
 
     # Inform the user that all tips were sent.
     if len(users_to_tip) >= 2:
@@ -598,6 +507,10 @@ def tip_process(message, users_to_tip, request_json):
                                                                                  message['sender_account']))
         modules.social.send_reply(message, multi_tip_success)
 
+    elif len(users_to_tip) == 1 and message['send_hash'] is None:
+        tip_success = "You have successfully sent your {} $NANO tip.".format(message['tip_amount_text'])
+        modules.social.send_reply(message, tip_success)
+
     elif len(users_to_tip) == 1:
         tip_success = ("You have successfully sent your {} $NANO tip.  Check this transaction at "
                        "https://nanocrawler.cc/explorer/block/{}".format(message['tip_amount_text'],
@@ -0,0 +1,223 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+import modules.media
+import modules.registry
+
+# Read config and parse constants
+config = modules.registry.config
+
+# A sender waits up to this long for a token.  Anything longer goes back on the queue until the limit resets.
+MAX_TOKEN_WAIT = 5
+
+# Connect to Twitter
+twitterAPI = modules.registry.twitter_request_api
+
+# Connect to Telegram
+telegram_bot = modules.registry.telegram_bot
+
+
+class RateLimited(Exception):
+    """
+    The message can't be sent until the platform's rate limit resets, retry_after seconds from now
+    """
+
+    def __init__(self, retry_after, reason):
+        super(RateLimited, self).__init__(reason)
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    """
+    Allows rate sends a second on average, in bursts of up to capacity.  Twitter's rate limit headers can empty the
+    bucket until the limit's reset time.
+    """
+
+    def __init__(self, name, rate, capacity):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available.  Raises RateLimited if that would take more than MAX_TOKEN_WAIT.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+
+            if wait > MAX_TOKEN_WAIT:
+                raise RateLimited(wait, "{} is rate limited".format(self.name))
+            time.sleep(wait)
+
+    def block(self, until):
+        with self.lock:
+            self.tokens = 0
+            self.blocked_until = max(self.blocked_until, until)
+
+    def update_from_headers(self, headers):
+        """
+        Hold off until the reset time once Twitter reports no requests left in the window
+        """
+        remaining = headers.get('x-rate-limit-remaining')
+        reset = headers.get('x-rate-limit-reset')
+        if remaining is not None and reset is not None and int(remaining) == 0:
+            self.block(int(reset))
+
+
+def new_bucket(name, config_key, default_rate):
+    rate = config.getfloat('webhooks', config_key, fallback=default_rate)
+    return TokenBucket(name, rate, max(1, math.ceil(rate * MAX_TOKEN_WAIT)))
+
+
+# A send takes a token from its platform's bucket and from its endpoint's bucket
+PLATFORM_BUCKETS = {
+    'twitter': new_bucket('twitter', 'outbound_rate_twitter', 1),
+    'telegram': new_bucket('telegram', 'outbound_rate_telegram', 25)
+}
+ENDPOINT_BUCKETS = {
+    'direct_messages/events/new': new_bucket('direct_messages/events/new', 'outbound_rate_twitter_dm', 0.5),
+    'media/upload': new_bucket('media/upload', 'outbound_rate_twitter_media', 0.2),
+    'statuses/update': new_bucket('statuses/update', 'outbound_rate_twitter_reply', 0.2),
+    'sendMessage': new_bucket('sendMessage', 'outbound_rate_telegram_message', 25)
+}
+
+
+def twitter_request(endpoint, params=None, files=None):
+    """
+    Make a Twitter API request within the rate limits.  Raises RateLimited on a 429, and an Exception on a server
+    error so the job is retried.  Returns the response, or None if Twitter refused the request for good.
+    """
+    PLATFORM_BUCKETS['twitter'].acquire()
+    ENDPOINT_BUCKETS[endpoint].acquire()
+    r = twitterAPI.request(endpoint, params, files)
+    ENDPOINT_BUCKETS[endpoint].update_from_headers(r.headers)
+
+    if r.status_code == 429:
+        reset = int(r.headers.get('x-rate-limit-reset', time.time() + 60))
+        ENDPOINT_BUCKETS[endpoint].block(reset)
+        raise RateLimited(max(1, reset - time.time()), "Twitter {} returned 429".format(endpoint))
+    if r.status_code >= 500:
+        raise Exception("Twitter {} ERROR: {} : {}".format(endpoint, r.status_code, r.text))
+    if r.status_code not in (200, 201):
+        logging.info("Twitter %s ERROR: %s : %s", endpoint, r.status_code, r.text)
+        return None
+
+    return r
+
+
+def telegram_send(**kwargs):
+    """
+    Send a Telegram message within the rate limits.  Raises RateLimited when Telegram asks us to slow down, and lets
+    network errors through so the job is retried.
+    """
+    # Imported here, like the client itself in modules.registry, so Twitter-only processes never load it
+    import telegram
+
+    PLATFORM_BUCKETS['telegram'].acquire()
+    ENDPOINT_BUCKETS['sendMessage'].acquire()
+    try:
+        telegram_bot.sendMessage(**kwargs)
+    except telegram.error.RetryAfter as e:
+        PLATFORM_BUCKETS['telegram'].block(time.time() + e.retry_after)
+        raise RateLimited(e.retry_after, "Telegram sendMessage returned 429")
+    except (telegram.error.NetworkError, telegram.error.TimedOut):
+        raise
+    except telegram.error.TelegramError as e:
+        # e.g. the user blocked the bot, which no retry will fix
+        logging.info("Telegram sendMessage ERROR: %s", e)
+
+
+def twitter_dm(receiver, text, media_id=None):
+    message_data = {'text': '{}'.format(text)}
+    if media_id is not None:
+        message_data['attachment'] = {'type': 'media', 'media': {'id': '{}'.format(media_id)}}
+    data = {
+        'event': {
+            'type': 'message_create', 'message_create': {
+                'target': {
+                    'recipient_id': '{}'.format(receiver)
+                }, 'message_data': message_data
+            }
+        }
+    }
+
+    return twitter_request('direct_messages/events/new', json.dumps(data))
+
+
+def upload_media(path):
+    """
+    Upload an image from the media store for use in DMs, or reuse the media ID of an earlier upload.  Returns the media
+    ID, or None if the upload was refused.
+    """
+    key = modules.media.media_key(path)
+    media_id = modules.media.get_media_id(key)
+    if media_id is not None:
+        return media_id
+
+    # Shared DM media can be attached to any number of DMs until it expires
+    with open(path, 'rb') as file:
+        r = twitter_request('media/upload', {'media_category': 'dm_image', 'shared': 'true'}, {'media': file.read()})
+    if r is None:
+        return None
+
+    upload = r.json()
+    media_id = upload['media_id_string']
+    logging.info("media_id: %s", media_id)
+    modules.media.set_media_id(key, media_id, upload.get('expires_after_secs', 86400))
+
+    return media_id
+
+
+def deliver(payload):
+    """
+    Job handler for the outbound lane: send one message queued by modules.social
+    """
+    if payload['kind'] == 'dm' and payload['system'] == 'twitter':
+        twitter_dm(payload['receiver'], payload['text'])
+
+    elif payload['kind'] == 'dm' and payload['system'] == 'telegram':
+        telegram_send(chat_id=payload['receiver'], text=payload['text'])
+
+    elif payload['kind'] == 'img':
+        media_id = upload_media(payload['path'])
+        if media_id is not None and twitter_dm(payload['receiver'], payload['text'], media_id) is None:
+            # Twitter dropped the media before we expected, so upload it again
+            modules.media.forget_media_id(modules.media.media_key(payload['path']))
+            media_id = upload_media(payload['path'])
+            if media_id is not None:
+                twitter_dm(payload['receiver'], payload['text'], media_id)
+
+    elif payload['kind'] == 'reply' and payload['system'] == 'twitter':
+        twitter_request('statuses/update', {'status': payload['text'], 'in_reply_to_status_id': payload['reply_to']})
+
+    elif payload['kind'] == 'reply' and payload['system'] == 'telegram':
+        telegram_send(chat_id=payload['chat_id'], reply_to_message_id=payload['reply_to'], text=payload['text'])
+
+
+def reset_bucket_locks():
+    """
+    A forked child can't wait on a lock a thread of its parent held at the fork
+    """
+    for bucket in list(PLATFORM_BUCKETS.values()) + list(ENDPOINT_BUCKETS.values()):
+        bucket.lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_bucket_locks)
@@ -0,0 +1,129 @@
+import functools
+import hashlib
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from flask import Response, current_app, request
+
+import modules.registry
+
+# Read config and parse constants
+config = modules.registry.config
+
+# Seconds a rendered page is served as is, per page
+PAGE_CACHE_TTL = {
+    'index': config.getint('webhooks', 'page_cache_ttl_index', fallback=60),
+    'tippers': config.getint('webhooks', 'page_cache_ttl_tippers', fallback=300),
+    'tiplist': config.getint('webhooks', 'page_cache_ttl_tiplist', fallback=60),
+    'about': config.getint('webhooks', 'page_cache_ttl_about', fallback=300)
+}
+# Seconds past its TTL a page is still served while it's rendered again in the background.  Past that, the request
+# that finds it waits for the new render.
+PAGE_CACHE_STALE = config.getint('webhooks', 'page_cache_stale', fallback=600)
+
+# Page name -> {'body', 'etag', 'last_modified', 'fresh_until', 'stale_until', 'refreshing'}
+pages = {}
+pages_lock = threading.Lock()
+# Page name -> lock held while the page is rendered in the foreground, so a cold page is only rendered once
+render_locks = {}
+
+
+def render(name, ttl, view, args, kwargs):
+    """
+    Render the page and store it.  Last-Modified only moves when the page actually changed, so clients holding the
+    previous copy keep getting 304s.
+    """
+    body = view(*args, **kwargs)
+    etag = hashlib.sha256(body.encode('utf-8')).hexdigest()[:32]
+    now = time.time()
+    with pages_lock:
+        previous = pages.get(name)
+        if previous is not None and previous['etag'] == etag:
+            last_modified = previous['last_modified']
+        else:
+            last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+        page = {
+            'body': body,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fresh_until': now + ttl,
+            'stale_until': now + ttl + PAGE_CACHE_STALE,
+            'refreshing': False
+        }
+        pages[name] = page
+
+    return page
+
+
+def refresh_in_background(app, name, ttl, view, args, kwargs):
+    """
+    Render the page again off the request thread.  The render runs in a request context of its own, as templates call
+    url_for and friends that need one, not just an app context.
+    """
+    try:
+        with app.test_request_context('/'):
+            render(name, ttl, view, args, kwargs)
+    except Exception as e:
+        logging.info("Error refreshing cached page %s: %s", name, e)
+        with pages_lock:
+            if name in pages:
+                pages[name]['refreshing'] = False
+
+
+def render_once(name, ttl, view, args, kwargs):
+    """
+    Render the page in the foreground.  Requests arriving while it renders wait and take the same result.
+    """
+    with pages_lock:
+        render_lock = render_locks.setdefault(name, threading.Lock())
+    with render_lock:
+        with pages_lock:
+            page = pages.get(name)
+        if page is not None and time.time() < page['stale_until']:
+            return page
+        return render(name, ttl, view, args, kwargs)
+
+
+def page_response(page):
+    response = Response(page['body'], mimetype='text/html')
+    response.set_etag(page['etag'])
+    response.last_modified = page['last_modified']
+    response.cache_control.public = True
+    response.cache_control.max_age = max(0, int(page['fresh_until'] - time.time()))
+    response.headers['Cache-Control'] += ', stale-while-revalidate={}'.format(PAGE_CACHE_STALE)
+
+    return response.make_conditional(request)
+
+
+def cached_page(name):
+    """
+    Serve the view's page from memory for its TTL in PAGE_CACHE_TTL, with an ETag and Last-Modified for conditional
+    requests.  Once the TTL is up the old page is served while one background thread renders a new one.  The view
+    must return the page's HTML and can't depend on the request, as every request gets the same page.
+    """
+    ttl = PAGE_CACHE_TTL[name]
+
+    def decorator(view):
+        @functools.wraps(view)
+        def cached_view(*args, **kwargs):
+            now = time.time()
+            start_refresh = False
+            with pages_lock:
+                page = pages.get(name)
+                if page is not None and page['fresh_until'] <= now < page['stale_until'] and not page['refreshing']:
+                    page['refreshing'] = True
+                    start_refresh = True
+
+            if page is None or now >= page['stale_until']:
+                page = render_once(name, ttl, view, args, kwargs)
+            elif start_refresh:
+                threading.Thread(target=refresh_in_background, name='page-refresh-{}'.format(name), daemon=True,
+                                 args=(current_app._get_current_object(), name, ttl, view, args, kwargs)).start()
+
+            return page_response(page)
+
+        return cached_view
+
+    return decorator
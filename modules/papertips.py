@@ -0,0 +1,355 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import modules.balances
+import modules.currency
+import modules.db
+import modules.ledger
+import modules.node
+import modules.pdfs
+import modules.registry
+from modules.amount import RawAmount
+
+# Read config and parse constants
+config = modules.registry.config
+
+WALLET = config.get('webhooks', 'wallet')
+BASE_URL = config.get('routes', 'base_url')
+PAPERTIP_EXPIRY_DAYS = config.getint('webhooks', 'papertip_expiry_days', fallback=30)
+PAPERTIP_MAX_TIPS = config.getint('webhooks', 'papertip_max_tips', fallback=160)
+PAPERTIP_RENDER_PROCESSES = config.getint('webhooks', 'papertip_render_processes', fallback=2)
+
+# Rendered sheets are stored under a hash of everything on them, so a sheet is only rendered once
+PAPERTIP_DIR = '{}/papertips'.format(os.getcwd())
+# The layout of static/papertip.css on A4
+TIPS_PER_ROW = 4
+TIPS_PER_PAGE = 16
+CURRENCY_MARKS = {'USD': '$', 'EUR': u"\u20AC", 'GBP': u"\u00A3"}
+SHEET_DATE_FORMAT = "%b %d, %y"
+# paper_tips.claimed
+TIP_UNCLAIMED = 0
+TIP_CLAIMED = 1
+TIP_RETURNED = 2
+
+# Connect to Nano node
+rpc = modules.node.rpc
+
+render_pool = None
+# PDF path -> Future of the render writing it
+renders = {}
+render_lock = threading.Lock()
+# Sheet ID -> path of its rendered PDF.  A sheet doesn't change once it's made.
+sheet_paths = {}
+
+
+def reset_renders():
+    """
+    A forked child can't use its parent's render processes, so it starts its own when it needs them
+    """
+    global render_pool, render_lock
+    render_pool = None
+    render_lock = threading.Lock()
+    renders.clear()
+
+
+os.register_at_fork(after_in_child=reset_renders)
+
+
+def claim_link(claim_code):
+    return '{}/tips/{}'.format(BASE_URL, claim_code)
+
+
+def load_tip(claim_code):
+    """
+    Return the funded tip with the claim code and what its sheet says it's worth, or None if there's no such tip
+    """
+    tip_call = ("SELECT t.account, t.amount_raw, t.claimed, s.source_account, s.fiat, s.fiat_amount, s.nano_amount, "
+                "s.expires_ts FROM paper_tips t JOIN paper_tip_sheets s ON s.sheet_id = t.sheet_id "
+                "WHERE t.claim_code = %s AND t.send_hash IS NOT NULL")
+    tip_data = modules.db.get_db_data(tip_call, [claim_code])
+    if not tip_data:
+        return None
+    account, amount_raw, claimed, source_account, fiat, fiat_amount, nano_amount, expires_ts = tip_data[0]
+
+    return {
+        'claim_code': claim_code,
+        'account': account,
+        'amount_raw': RawAmount(int(amount_raw)),
+        'claimed': claimed,
+        'source_account': source_account,
+        'currency_mark': CURRENCY_MARKS.get(fiat, '{} '.format(fiat)),
+        'fiat_amount': '{:.2f}'.format(fiat_amount),
+        'nano_amount': format(nano_amount.normalize(), 'f'),
+        'expired': expires_ts <= datetime.now(),
+        'exp_date': expires_ts.strftime(SHEET_DATE_FORMAT)
+    }
+
+
+def set_tip_claimed(claim_code, claimed, previous):
+    """
+    Move a tip from one claimed state to another, returning False if it wasn't in the previous state.  A tip can only
+    be claimed before its sheet expires and only returned after.
+    """
+    expiry_check = ''
+    if claimed == TIP_CLAIMED:
+        expiry_check = ' AND s.expires_ts > NOW()'
+    elif claimed == TIP_RETURNED:
+        expiry_check = ' AND s.expires_ts <= NOW()'
+
+    db = modules.db.get_connection()
+    db_cursor = db.cursor()
+    try:
+        db_cursor.execute("UPDATE paper_tips t JOIN paper_tip_sheets s ON s.sheet_id = t.sheet_id SET t.claimed = %s "
+                          "WHERE t.claim_code = %s AND t.claimed = %s AND t.send_hash IS NOT NULL" + expiry_check,
+                          [claimed, claim_code, previous])
+        changed = db_cursor.rowcount == 1
+        db.commit()
+    finally:
+        db_cursor.close()
+        db.close()
+
+    return changed
+
+
+def pay_out_tip(tip, destination, claimed):
+    """
+    Mark the tip claimed or returned, receive its funding into its account and send it all to destination.  Returns
+    the send hash, or None if the tip was already taken.  If the send fails the tip is left unclaimed, and as the send
+    id is the claim code the retry can't pay it out twice.
+    """
+    if not set_tip_claimed(tip['claim_code'], claimed, TIP_UNCLAIMED):
+        return None
+
+    try:
+        # Tip accounts aren't in the confirmation subscription, so their funding is received here
+        for block in rpc.pending(account=tip['account']):
+            modules.currency.receive_block(tip['account'], block)
+        send_hash = modules.ledger.publish_send(tip['account'], destination, tip['amount_raw'],
+                                                'paper-out-{}'.format(tip['claim_code']))
+    except Exception as e:
+        logging.info("Error paying out paper tip %s to %s: %s", tip['claim_code'], destination, e)
+        set_tip_claimed(tip['claim_code'], TIP_UNCLAIMED, claimed)
+        raise e
+    modules.balances.invalidate_balance(destination)
+    logging.info("Paper tip %s paid out to %s under hash %s", tip['claim_code'], destination, send_hash)
+
+    return send_hash
+
+
+def claim_tip(claim_code, destination):
+    """
+    Send an unexpired tip to the account of whoever holds its claim code.  Returns the send hash, or None if the tip
+    doesn't exist, expired or was already claimed.
+    """
+    tip = load_tip(claim_code)
+    if tip is None or tip['claimed'] != TIP_UNCLAIMED or tip['expired']:
+        return None
+
+    return pay_out_tip(tip, destination, TIP_CLAIMED)
+
+
+def return_expired_tips():
+    """
+    Send every tip that expired unclaimed back to the account its sheet was funded from.  Returns how many were sent.
+    """
+    expired_call = ("SELECT t.claim_code FROM paper_tips t JOIN paper_tip_sheets s ON s.sheet_id = t.sheet_id "
+                    "WHERE t.claimed = %s AND t.send_hash IS NOT NULL AND s.expires_ts <= NOW()")
+    returned = 0
+    for row in modules.db.get_db_data(expired_call, [TIP_UNCLAIMED]):
+        tip = load_tip(row[0])
+        try:
+            if pay_out_tip(tip, tip['source_account'], TIP_RETURNED) is not None:
+                returned += 1
+        except Exception:
+            # Logged by pay_out_tip, the next sweep tries it again
+            pass
+
+    return returned
+
+
+def fund_tips(source_account, tips, amount_raw):
+    """
+    Send amount_raw to each tip's account and return the hashes of the sends published, in order.  With local signing
+    the sends are one chain of blocks with their work generated in parallel.  Through the node wallet, the work for
+    each send is generated from the hash of the one before, without looking the frontier up again.
+    """
+    if modules.currency.LOCAL_SIGNING:
+        return modules.currency.send_blocks(source_account, [("paper-{}".format(tip['claim_code']), tip['account'],
+                                                              amount_raw) for tip in tips])
+
+    send_hashes = []
+    try:
+        for tip in tips:
+            work = modules.currency.get_pow(source_account) if not send_hashes else \
+                modules.currency.generate_work(send_hashes[-1])
+            send_args = {'wallet': WALLET, 'source': source_account, 'destination': tip['account'],
+                         'amount': "{}".format(int(amount_raw)), 'id': "paper-{}".format(tip['claim_code'])}
+            if work:
+                send_args['work'] = work
+            send_hashes.append(rpc.send(**send_args))
+    except Exception as e:
+        logging.info("Error funding paper tips, %s of %s sent: %s", len(send_hashes), len(tips), e)
+        if not send_hashes:
+            raise e
+    finally:
+        modules.balances.invalidate_balance(source_account)
+
+    modules.currency.precache_work(send_hashes[-1])
+
+    return send_hashes
+
+
+def create_sheet(source_account, count, fiat_amount, fiat='USD'):
+    """
+    Make a sheet of count paper tips worth fiat_amount each, funded from source_account, and start rendering it.  The
+    price is fetched once for the sheet and the tip accounts are made with one accounts_create call.  Returns the
+    sheet ID.
+    """
+    if not 0 < count <= PAPERTIP_MAX_TIPS:
+        raise ValueError("A sheet holds 1 to {} tips".format(PAPERTIP_MAX_TIPS))
+
+    fiat = fiat.upper()
+    nano_amount = modules.currency.get_fiat_conversion(fiat, 'NANO', fiat_amount)
+    nano_price = Decimal('{}'.format(modules.currency.get_fiat_price(fiat, 'NANO')))
+    amount_raw = RawAmount.from_nano('{}'.format(nano_amount))
+    balance = modules.balances.get_balance(source_account, fresh=True)['balance']
+    if balance < amount_raw * count:
+        raise ValueError("Balance of {} is less than {}".format(balance.to_nano(), (amount_raw * count).to_nano()))
+
+    sheet_id = secrets.token_hex(8)
+    accounts = rpc.accounts_create(wallet="{}".format(WALLET), count=count, work=False)
+    tips = [{'claim_code': secrets.token_urlsafe(12), 'account': account} for account in accounts]
+    expires = datetime.now() + timedelta(days=PAPERTIP_EXPIRY_DAYS)
+
+    db = modules.db.get_connection()
+    db_cursor = db.cursor()
+    try:
+        db_cursor.execute("INSERT INTO paper_tip_sheets (sheet_id, source_account, fiat, fiat_amount, nano_amount, "
+                          "nano_price, tip_count, expires_ts) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
+                          [sheet_id, source_account, fiat, Decimal('{}'.format(fiat_amount)), nano_amount, nano_price,
+                           count, expires])
+        db_cursor.executemany("INSERT INTO paper_tips (claim_code, sheet_id, position, account, amount_raw) "
+                              "VALUES (%s, %s, %s, %s, %s)",
+                              [(tip['claim_code'], sheet_id, position, tip['account'], int(amount_raw))
+                               for position, tip in enumerate(tips)])
+        db.commit()
+    finally:
+        db_cursor.close()
+        db.close()
+
+    send_hashes = fund_tips(source_account, tips, amount_raw)
+    db = modules.db.get_connection()
+    db_cursor = db.cursor()
+    try:
+        db_cursor.executemany("UPDATE paper_tips SET send_hash = %s WHERE claim_code = %s",
+                              [(send_hash, tip['claim_code']) for tip, send_hash in zip(tips, send_hashes)])
+        db.commit()
+    finally:
+        db_cursor.close()
+        db.close()
+    logging.info("Created paper tip sheet %s with %s of %s tips funded", sheet_id, len(send_hashes), count)
+
+    sheet_pdf(sheet_id)
+
+    return sheet_id
+
+
+def load_sheet(sheet_id):
+    """
+    Return everything printed on the sheet, with only its funded tips, or None if there's no such sheet
+    """
+    sheet_call = ("SELECT fiat, fiat_amount, nano_amount, nano_price, created_ts, expires_ts "
+                  "FROM paper_tip_sheets WHERE sheet_id = %s")
+    sheet_data = modules.db.get_db_data(sheet_call, [sheet_id])
+    if not sheet_data:
+        return None
+    fiat, fiat_amount, nano_amount, nano_price, created_ts, expires_ts = sheet_data[0]
+
+    tips_call = ("SELECT claim_code FROM paper_tips WHERE sheet_id = %s AND send_hash IS NOT NULL "
+                 "ORDER BY position")
+    tips_data = modules.db.get_db_data(tips_call, [sheet_id])
+
+    return {
+        'sheet_id': sheet_id,
+        'currency_mark': CURRENCY_MARKS.get(fiat, '{} '.format(fiat)),
+        'fiat_amount': '{:.2f}'.format(fiat_amount),
+        'nano_amount': format(nano_amount.normalize(), 'f'),
+        'nano_price': format(nano_price.normalize(), 'f'),
+        'gen_date': created_ts.strftime(SHEET_DATE_FORMAT),
+        'exp_date': expires_ts.strftime(SHEET_DATE_FORMAT),
+        'tips': [{'claim_code': row[0], 'link': claim_link(row[0])} for row in tips_data],
+        'tips_per_page': TIPS_PER_PAGE,
+        'tips_per_row': TIPS_PER_ROW
+    }
+
+
+def sheet_path(sheet):
+    """
+    Where the sheet's PDF is stored: a hash of the sheet's contents and of the template and stylesheet it's drawn with
+    """
+    content = hashlib.sha256(json.dumps(sheet, sort_keys=True).encode('utf-8'))
+    layout_paths = ['{}/papertip.html'.format(modules.pdfs.TEMPLATE_DIR), '{}/static/papertip.css'.format(os.getcwd())]
+    for layout_path in layout_paths:
+        with open(layout_path, 'rb') as file:
+            content.update(file.read())
+
+    return '{}/{}.pdf'.format(PAPERTIP_DIR, content.hexdigest()[:32])
+
+
+def finish_render(path, future):
+    with render_lock:
+        renders.pop(path, None)
+    if future.exception() is not None:
+        logging.info("Error rendering paper tip sheet %s: %s", path, future.exception())
+
+
+def start_render(sheet, path):
+    """
+    Render the sheet in the render processes, unless it's already being rendered.  Returns the render's Future.
+    """
+    global render_pool
+    with render_lock:
+        future = renders.get(path)
+        if future is not None:
+            return future
+        if render_pool is None:
+            os.makedirs(PAPERTIP_DIR, exist_ok=True)
+            # Spawned, so the render processes don't inherit this process' threads and connections
+            render_pool = ProcessPoolExecutor(max_workers=PAPERTIP_RENDER_PROCESSES,
+                                              mp_context=multiprocessing.get_context('spawn'))
+        future = render_pool.submit(modules.pdfs.render_sheet, sheet, path)
+        renders[path] = future
+
+    future.add_done_callback(lambda done: finish_render(path, done))
+    return future
+
+
+def sheet_pdf(sheet_id, wait=False):
+    """
+    Return the path of the sheet's PDF.  If it hasn't been rendered, the render is started and None is returned, or
+    with wait the render is waited on.  Raises KeyError for an unknown sheet.
+    """
+    path = sheet_paths.get(sheet_id)
+    if path is not None and os.path.isfile(path):
+        return path
+
+    sheet = load_sheet(sheet_id)
+    if sheet is None:
+        raise KeyError(sheet_id)
+    path = sheet_path(sheet)
+    if not os.path.isfile(path):
+        future = start_render(sheet, path)
+        if not wait:
+            return None
+        future.result()
+
+    sheet_paths[sheet_id] = path
+    return path
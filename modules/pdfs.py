@@ -1,5 +1,38 @@
-from flask_weasyprint import HTML
+import base64
+import io
+import os
 
+import jinja2
+import pyqrcode
 
-def create_pdf(pdf_data):
-    return HTML('/templates/papertip.html'.format(pdf_data)).write_pdf()
+# This module runs in the paper tip render processes, so it only imports what rendering needs
+TEMPLATE_DIR = '{}/templates'.format(os.getcwd())
+QR_SCALE = 4
+
+template_env = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_DIR), autoescape=True)
+
+
+def qr_data_uri(text):
+    png = io.BytesIO()
+    pyqrcode.create(text).png(png, scale=QR_SCALE, quiet_zone=2)
+    return 'data:image/png;base64,{}'.format(base64.b64encode(png.getvalue()).decode('ascii'))
+
+
+def render_sheet(sheet, path):
+    """
+    Render a paper tip sheet to a PDF at path.  The QR codes are drawn in memory and embedded in the page, so the only
+    files read are the template and its static assets.  Returns the path.
+    """
+    from weasyprint import HTML
+
+    tips = [dict(tip, qr=qr_data_uri(tip['link'])) for tip in sheet['tips']]
+    html = template_env.get_template('papertip.html').render(dict(sheet, tips=tips))
+    pdf = HTML(string=html, base_url=os.getcwd()).write_pdf()
+
+    # Write then rename, so a request never serves half a file
+    temp_path = '{}.{}'.format(path, os.getpid())
+    with open(temp_path, 'wb') as file:
+        file.write(pdf)
+    os.replace(temp_path, path)
+
+    return path
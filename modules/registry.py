@@ -0,0 +1,86 @@
+import configparser
+import os
+import threading
+
+# Read config once for every module in the process
+config = configparser.ConfigParser()
+config.read('{}/webhookconfig.ini'.format(os.getcwd()))
+
+
+def new_twitter_api():
+    import tweepy
+
+    auth = tweepy.OAuthHandler(config.get('webhooks', 'consumer_key'), config.get('webhooks', 'consumer_secret'))
+    auth.set_access_token(config.get('webhooks', 'access_token'), config.get('webhooks', 'access_token_secret'))
+    return tweepy.API(auth)
+
+
+def new_twitter_request_api():
+    # Secondary API for non-tweepy supported requests
+    from TwitterAPI import TwitterAPI
+
+    return TwitterAPI(config.get('webhooks', 'consumer_key'), config.get('webhooks', 'consumer_secret'),
+                      config.get('webhooks', 'access_token'), config.get('webhooks', 'access_token_secret'))
+
+
+def new_telegram_bot():
+    import telegram
+
+    return telegram.Bot(token=config.get('webhooks', 'telegram_key'))
+
+
+# Client name -> function building it.  The client libraries are only imported by the factories, so a process that
+# never uses a client doesn't pay for importing it either.
+CLIENT_FACTORIES = {
+    'twitter': new_twitter_api,
+    'twitter_request': new_twitter_request_api,
+    'telegram': new_telegram_bot
+}
+
+clients = {}
+client_lock = threading.Lock()
+
+
+def get_client(name):
+    """
+    Return the process' shared client, building it on first use
+    """
+    client = clients.get(name)
+    if client is None:
+        with client_lock:
+            client = clients.get(name)
+            if client is None:
+                client = CLIENT_FACTORIES[name]()
+                clients[name] = client
+
+    return client
+
+
+def reset_clients():
+    """
+    Drop the clients after a fork, so the child builds its own instead of sharing its parent's connections
+    """
+    global client_lock
+    client_lock = threading.Lock()
+    clients.clear()
+
+
+os.register_at_fork(after_in_child=reset_clients)
+
+
+class LazyClient(object):
+    """
+    Module level stand in for a shared client.  Attribute access goes to the client, which is built the first time
+    it's needed.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        return getattr(get_client(self.name), attribute)
+
+
+twitter_api = LazyClient('twitter')
+twitter_request_api = LazyClient('twitter_request')
+telegram_bot = LazyClient('telegram')
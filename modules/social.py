@@ -1,42 +1,24 @@
-import configparser
-import json
 import logging
-import os
-from datetime import datetime
 from decimal import Decimal
 
-import nano
-import pyqrcode
-import telegram
-import tweepy
-from TwitterAPI import TwitterAPI
-
+import modules.balances
+import modules.commands
 import modules.currency
 import modules.db
-
-# Set Log File
-logging.basicConfig(handlers=[logging.FileHandler('{}/webhooks.log'.format(os.getcwd()), 'a', 'utf-8')],
-                    level=logging.INFO)
+import modules.identity
+import modules.jobs
+import modules.logs
+import modules.media
+import modules.node
+import modules.registry
+from modules.amount import RawAmount
 
 # Read config and parse constants
-config = configparser.ConfigParser()
-config.read('{}/webhookconfig.ini'.format(os.getcwd()))
-
-# Twitter API connection settings
-CONSUMER_KEY = config.get('webhooks', 'consumer_key')
-CONSUMER_SECRET = config.get('webhooks', 'consumer_secret')
-ACCESS_TOKEN = config.get('webhooks', 'access_token')
-ACCESS_TOKEN_SECRET = config.get('webhooks', 'access_token_secret')
-
-# Secondary API for non-tweepy supported requests
-twitterAPI = TwitterAPI(CONSUMER_KEY, CONSUMER_SECRET, ACCESS_TOKEN, ACCESS_TOKEN_SECRET)
-
-# Telegram API
-TELEGRAM_KEY = config.get('webhooks', 'telegram_key')
+config = modules.registry.config
 
 # Constants
 MIN_TIP = config.get('webhooks', 'min_tip')
-NODE_IP = config.get('webhooks', 'node_ip')
+MIN_TIP_RAW = RawAmount.from_nano(MIN_TIP)
 
 # IDs
 BOT_ID_TWITTER = config.get('webhooks', 'bot_id_twitter')
@@ -44,89 +26,50 @@ BOT_ID_TELEGRAM = config.get('webhooks', 'bot_id_telegram')
 BASE_URL = config.get('routes', 'base_url')
 TELEGRAM_URI = config.get('routes', 'telegram_uri')
 
-# Connect to Twitter
-auth = tweepy.OAuthHandler(CONSUMER_KEY, CONSUMER_SECRET)
-auth.set_access_token(ACCESS_TOKEN, ACCESS_TOKEN_SECRET)
-api = tweepy.API(auth)
-
 # Connect to Telegram
-telegram_bot = telegram.Bot(token=TELEGRAM_KEY)
+telegram_bot = modules.registry.telegram_bot
 
 # Connect to Nano node
-rpc = nano.rpc.Client(NODE_IP)
+rpc = modules.node.rpc
+
+
+def queue_message(payload):
+    """
+    Hand a message to the outbound dispatcher, which sends it within the platform's rate limits.  The caller doesn't
+    wait on the send, so a tip is never held up by its notifications.
+    """
+    # The send is logged under the event that caused it
+    if modules.logs.current_event_id() is not None:
+        payload['event_id'] = modules.logs.current_event_id()
+    # Funds may already have moved by the time a message is queued, so a failure here is kept for later rather than
+    # failing the job that sent it
+    try:
+        modules.jobs.enqueue('outbound', payload)
+    except Exception as e:
+        logging.info("Error queuing %s message to %s, spooling it: %s", payload['system'],
+                     payload.get('receiver', payload.get('chat_id')), e)
+        modules.jobs.spool_outbound(payload)
 
 
 def send_dm(receiver, message, system):
     """
     Send the provided message to the provided receiver
     """
-    if system == 'twitter':
-        data = {
-            'event': {
-                'type': 'message_create', 'message_create': {
-                    'target': {
-                        'recipient_id': '{}'.format(receiver)
-                    }, 'message_data': {
-                        'text': '{}'.format(message)
-                    }
-                }
-            }
-        }
-
-        r = twitterAPI.request('direct_messages/events/new', json.dumps(data))
-
-        if r.status_code != 200:
-            logging.info('Send DM - Twitter ERROR: {} : {}'.format(r.status_code, r.text))
-
-    elif system == 'telegram':
-        try:
-            telegram_bot.sendMessage(chat_id=receiver, text=message)
-        except Exception as e:
-            logging.info("{}: Send DM - Telegram ERROR: {}".format(datetime.now(), e))
-            pass
+    queue_message({'kind': 'dm', 'system': system, 'receiver': receiver, 'text': '{}'.format(message)})
 
 
 def send_img(receiver, path, message):
-    file = open(path, 'rb')
-    qr_data = file.read()
-    r = twitterAPI.request('media/upload', None, {'media': qr_data})
-
-    if r.status_code == 200:
-        media_id = r.json()['media_id']
-        logging.info('media_id: {}'.format(media_id))
-        msg_data = {
-            'event': {
-                'type': 'message_create',
-                'message_create': {
-                    'target': {
-                        'recipient_id': '{}'.format(receiver)
-                    },
-                    'message_data': {
-                        'text': '{}'.format(message),
-                        'attachment': {
-                            'type': 'media',
-                            'media': {
-                                'id': '{}'.format(media_id)
-                            }
-                        }
-                    }
-                }
-            }
-        }
-
-        r = twitterAPI.request('direct_messages/events/new', json.dumps(msg_data))
-
-        if r.status_code != 200:
-            logging.info('Send image ERROR: {} : {}'.format(r.status_code, r.text))
+    queue_message({'kind': 'img', 'system': 'twitter', 'receiver': receiver, 'path': path,
+                   'text': '{}'.format(message)})
 
 
 def set_message_info(status, message):
     """
     Set the tweet information into the message dictionary
     """
-    logging.info("{}: in set_message_info".format(datetime.now()))
+    logging.debug("in set_message_info")
     if status.get('retweeted_status'):
-        logging.info("{}: Retweets are ignored.".format(datetime.now()))
+        logging.info("Retweets are ignored.")
         message['id'] = None
     else:
         message['id'] = status.get('id')
@@ -142,36 +85,30 @@ def set_message_info(status, message):
 
         if status.get('truncated') is False:
             dm_text = status.get('text')
+            entities = status.get('entities', {})
         else:
             dm_text = status.get('extended_tweet', {}).get('full_text')
+            entities = status.get('extended_tweet', {}).get('entities', {})
+        # Mentioned users come with their IDs, so tip receivers rarely need an API call
+        message['mentions'] = entities.get('user_mentions', [])
 
-        dm_text = dm_text.replace('\n', ' ')
-        dm_text = dm_text.lower()
-
-        message['text'] = dm_text.split(" ")
+        message['text'] = modules.commands.tokenize(dm_text)
 
     return message
 
 
 def check_message_action(message):
     """
-    Check to see if there are any key action values mentioned in the tweet.
+    Parse the message for a !tip command, its amount and its receivers.  The parsed command is kept in
+    message['command'] for the later steps.
     """
-    logging.info("{}: in check_message_action.".format(datetime.now()))
-    if message['system'] == 'telegram':
-        try:
-            check_for_ntb = message['text'].index("@nanotipbot")
-        except ValueError:
-            message['action'] = None
-            return message
-    try:
-        message['action_index'] = message['text'].index("!tip")
-    except ValueError:
+    logging.debug("in check_message_action")
+    message['command'] = modules.commands.parse_tip(message['text'], message.get('sender_screen_name'))
+    if message['system'] == 'telegram' and not message['command'].mentions_bot:
         message['action'] = None
         return message
 
-    message['action'] = message['text'][message['action_index']].lower()
-    message['starting_point'] = message['action_index'] + 1
+    message['action'] = message['command'].action
 
     return message
 
@@ -180,12 +117,10 @@ def validate_tip_amount(message):
     """
     Validate the tweet includes an amount to tip, and if that tip amount is greater than the minimum tip amount.
     """
-    logging.info("{}: in validate_tip_amount".format(datetime.now()))
-    try:
-        message['tip_amount'] = Decimal(message['text'][message['starting_point']])
-    except Exception:
-        logging.info("{}: Tip amount was not a number: {}".format(datetime.now(),
-                                                                  message['text'][message['starting_point']]))
+    logging.debug("in validate_tip_amount")
+    message['tip_amount'] = message['command'].amount
+    if message['tip_amount'] is None:
+        logging.info("Tip amount was not a number: %s", message['command'].amount_text)
         not_a_number_text = 'Looks like the value you entered to tip was not a number.  You can try to tip ' \
                             'again using the format !tip 1234 @username'
         send_reply(message, not_a_number_text)
@@ -193,69 +128,43 @@ def validate_tip_amount(message):
         message['tip_amount'] = -1
         return message
 
-    if Decimal(message['tip_amount']) < Decimal(MIN_TIP):
+    if message['tip_amount'] < MIN_TIP_RAW:
         min_tip_text = ("The minimum tip amount is {} NANO.  Please update your tip amount and try again."
                         .format(MIN_TIP))
         send_reply(message, min_tip_text)
 
         message['tip_amount'] = -1
-        logging.info("{}: User tipped less than {} NANO.".format(datetime.now(), MIN_TIP))
-        return message
-
-    try:
-        message['tip_amount_raw'] = Decimal(message['tip_amount']) * 1000000000000000000000000000000
-    except Exception as e:
-        logging.info("{}: Exception converting tip_amount to tip_amount_raw".format(datetime.now()))
-        logging.info("{}: {}".format(datetime.now(), e))
-        message['tip_amount'] = -1
+        logging.info("User tipped less than %s NANO.", MIN_TIP)
         return message
 
-    # create a string to remove scientific notation from small decimal tips
-    if str(message['tip_amount'])[0] == ".":
-        message['tip_amount_text'] = "0{}".format(str(message['tip_amount']))
-    else:
-        message['tip_amount_text'] = str(message['tip_amount'])
+    message['tip_amount_text'] = message['tip_amount'].to_nano()
 
     return message
 
 
 def set_tip_list(message, users_to_tip, request_json):
     """
-    Loop through the message starting after the tip amount and identify any users that were tagged for a tip.  Add the
-    user object to the users_to_tip dict to process the tips.
+    Look up the users the parsed command tagged for a tip.  Add the user object to the users_to_tip dict to process
+    the tips.
     """
-    logging.info("{}: in set_tip_list.".format(datetime.now()))
-
-    # Identify the first user to string multi tips.  Once a non-user is mentioned, end the user list
-
-    first_user_flag = False
+    logging.debug("in set_tip_list")
 
     if message['system'] == 'twitter':
-        for t_index in range(message['starting_point'] + 1, len(message['text'])):
-            if first_user_flag and len(message['text'][t_index]) > 0 and str(message['text'][t_index][0]) != "@":
-                logging.info("users identified, regular text breaking the loop: {}".format(message['text'][t_index][0]))
-                break
-            if len(message['text'][t_index]) > 0 and (
-                    str(message['text'][t_index][0]) == "@" and str(message['text'][t_index]).lower() != (
-                    "@" + str(message['sender_screen_name']).lower())):
-                if not first_user_flag:
-                    first_user_flag = True
-                try:
-                    user_info = api.get_user(message['text'][t_index])
-                except tweepy.TweepError as e:
-                    logging.info("{}: The user sent a !tip command with a mistyped user: {}".format(
-                        datetime.now(), message['text'][t_index]))
-                    logging.info("{}: Tip List Tweep error: {}".format(datetime.now(), e))
-                    users_to_tip.clear()
-                    return message, users_to_tip
-
-                user_dict = {'receiver_id': user_info.id, 'receiver_screen_name': user_info.screen_name,
-                             'receiver_account': None, 'receiver_register': None}
-                users_to_tip.append(user_dict)
-                logging.info("{}: Users_to_tip: {}".format(datetime.now(), users_to_tip))
+        # Resolve all the receivers at once, from the tweet's mentions where possible
+        mentioned_users = modules.identity.resolve_screen_names(message['command'].mentions, message.get('mentions'))
+        for screen_name in message['command'].mentions:
+            user_info = mentioned_users.get(screen_name.lower())
+            if user_info is None:
+                logging.info("The user sent a !tip command with a mistyped user: @%s", screen_name)
+                users_to_tip.clear()
+                return message, users_to_tip
+
+            user_dict = {'receiver_id': user_info['id'], 'receiver_screen_name': user_info['screen_name'],
+                         'receiver_account': None, 'receiver_register': None}
+            users_to_tip.append(user_dict)
 
     if message['system'] == 'telegram':
-        logging.info("trying to set tiplist in telegram: {}".format(message))
+        logging.debug("setting tip list for telegram message %s in chat %s", message['id'], message['chat_id'])
 
         if 'reply_to_message' in request_json['message']:
             if len(users_to_tip) == 0:
@@ -273,9 +182,8 @@ def set_tip_list(message, users_to_tip, request_json):
                                  'receiver_account': None, 'receiver_register': None}
                     users_to_tip.append(user_dict)
                 else:
-                    logging.info("User not found in DB: chat ID:{} - member name:{}".
-                                 format(message['chat_id'], request_json['message']['reply_to_message']['from']
-                                                                        ['first_name']))
+                    logging.info("User not found in DB: chat ID:%s - member name:%s", message['chat_id'],
+                                 request_json['message']['reply_to_message']['from']['first_name'])
                     missing_user_message = ("{} not found in our records.  In order to tip them, they need to be a "
                                             "member of the channel.  If they are in the channel, please have them "
                                             "send a message in the chat so I can add them.".
@@ -284,44 +192,33 @@ def set_tip_list(message, users_to_tip, request_json):
                     users_to_tip.clear()
                     return message, users_to_tip
         else:
-            for t_index in range(message['starting_point'] + 1, len(message['text'])):
-                if first_user_flag and len(message['text'][t_index]) > 0 and str(message['text'][t_index][0]) != "@":
-                    logging.info("users identified, regular text breaking the loop: {}".format(message['text'][t_index][0]))
-                    break
-                if len(message['text'][t_index]) > 0:
-                    if str(message['text'][t_index][0]) == "@" and str(message['text'][t_index]).lower() != (
-                            "@" + str(message['sender_screen_name']).lower()):
-                        check_user_call = ("SELECT member_id, member_name FROM telegram_chat_members "
-                                           "WHERE chat_id = {} and member_name = '{}'".format(message['chat_id'],
-                                                                                              message['text'][t_index][1:]))
+            for screen_name in message['command'].mentions:
+                check_user_call = ("SELECT member_id, member_name FROM telegram_chat_members "
+                                   "WHERE chat_id = {} and member_name = '{}'".format(message['chat_id'], screen_name))
 
-                        user_check_data = modules.db.get_db_data(check_user_call)
-                        if user_check_data:
-                            receiver_id = user_check_data[0][0]
-                            receiver_screen_name = user_check_data[0][1]
-                            duplicate_user = False
-
-                            for u_index in range(0, len(users_to_tip)):
-                                if users_to_tip[u_index]['receiver_id'] == receiver_id:
-                                    duplicate_user = True
-
-                            if not duplicate_user:
-                                if not first_user_flag:
-                                    first_user_flag = True
-                                logging.info("User tipped via searching the string for mentions")
-                                user_dict = {'receiver_id': receiver_id, 'receiver_screen_name': receiver_screen_name,
-                                             'receiver_account': None, 'receiver_register': None}
-                                users_to_tip.append(user_dict)
-                        else:
-                            logging.info("User not found in DB: chat ID:{} - member name:{}".
-                                         format(message['chat_id'], message['text'][t_index][1:]))
-                            missing_user_message = ("{} not found in our records.  In order to tip them, they need to be a "
-                                                    "member of the channel.  If they are in the channel, please have them "
-                                                    "send a message in the chat so I can add them.".
-                                                    format(message['text'][t_index]))
-                            send_reply(message, missing_user_message)
-                            users_to_tip.clear()
-                            return message, users_to_tip
+                user_check_data = modules.db.get_db_data(check_user_call)
+                if user_check_data:
+                    receiver_id = user_check_data[0][0]
+                    receiver_screen_name = user_check_data[0][1]
+                    duplicate_user = False
+
+                    for u_index in range(0, len(users_to_tip)):
+                        if users_to_tip[u_index]['receiver_id'] == receiver_id:
+                            duplicate_user = True
+
+                    if not duplicate_user:
+                        logging.debug("telegram user %s added via mentions in the text", receiver_id)
+                        user_dict = {'receiver_id': receiver_id, 'receiver_screen_name': receiver_screen_name,
+                                     'receiver_account': None, 'receiver_register': None}
+                        users_to_tip.append(user_dict)
+                else:
+                    logging.info("User not found in DB: chat ID:%s - member name:%s", message['chat_id'], screen_name)
+                    missing_user_message = ("@{} not found in our records.  In order to tip them, they need to be a "
+                                            "member of the channel.  If they are in the channel, please have them "
+                                            "send a message in the chat so I can add them.".format(screen_name))
+                    send_reply(message, missing_user_message)
+                    users_to_tip.clear()
+                    return message, users_to_tip
             try:
                 text_mentions = request_json['message']['entities']
                 for mention in text_mentions:
@@ -334,15 +231,14 @@ def set_tip_list(message, users_to_tip, request_json):
                         if user_check_data:
                             receiver_id = user_check_data[0][0]
                             receiver_screen_name = user_check_data[0][1]
-                            logging.info("telegram user added via mention list.")
-                            logging.info("mention: {}".format(mention))
+                            logging.debug("telegram user %s added via mention list", receiver_id)
 
                             user_dict = {'receiver_id': receiver_id, 'receiver_screen_name': receiver_screen_name,
                                          'receiver_account': None, 'receiver_register': None}
                             users_to_tip.append(user_dict)
                         else:
-                            logging.info("User not found in DB: chat ID:{} - member name:{}".
-                                         format(message['chat_id'], mention['user']['first_name']))
+                            logging.info("User not found in DB: chat ID:%s - member name:%s", message['chat_id'],
+                                         mention['user']['first_name'])
                             missing_user_message = ("{} not found in our records.  In order to tip them, they need to be a "
                                                     "member of the channel.  If they are in the channel, please have them "
                                                     "send a message in the chat so I can add them.".
@@ -353,7 +249,8 @@ def set_tip_list(message, users_to_tip, request_json):
             except:
                 pass
 
-    logging.info("{}: Users_to_tip: {}".format(datetime.now(), users_to_tip))
+    # Only the receivers' names are logged, as the list is filled in further as the tip is processed
+    logging.debug("users to tip: %s", [user['receiver_screen_name'] for user in users_to_tip])
     message['total_tip_amount'] = message['tip_amount']
     if len(users_to_tip) > 0 and message['tip_amount'] != -1:
         message['total_tip_amount'] *= len(users_to_tip)
@@ -365,9 +262,7 @@ def validate_sender(message):
     """
     Validate that the sender has an account with the tip bot, and has enough NANO to cover the tip.
     """
-    logging.info("{}: validating sender".format(datetime.now()))
-    logging.info("sender id: {}".format(message['sender_id']))
-    logging.info("system: {}".format(message['system']))
+    logging.debug("validating sender %s on %s", message['sender_id'], message['system'])
     db_call = "SELECT account, register FROM users where user_id = {} AND users.system = '{}'".format(message['sender_id'],
                                                                                                       message['system'])
     sender_account_info = modules.db.get_db_data(db_call)
@@ -377,7 +272,7 @@ def validate_sender(message):
                            "an account.")
         send_reply(message, no_account_text)
 
-        logging.info("{}: User tried to send a tip without an account.".format(datetime.now()))
+        logging.info("User tried to send a tip without an account.")
         message['sender_account'] = None
         return message
 
@@ -390,8 +285,8 @@ def validate_sender(message):
         modules.db.set_db_data(db_call, db_values)
 
     modules.currency.receive_pending(message['sender_account'])
-    message['sender_balance_raw'] = rpc.account_balance(account='{}'.format(message['sender_account']))
-    message['sender_balance'] = message['sender_balance_raw']['balance'] / 1000000000000000000000000000000
+    message['sender_balance_raw'] = modules.balances.get_balance(message['sender_account'], fresh=True)['balance']
+    message['sender_balance'] = message['sender_balance_raw'].to_nano()
 
     return message
 
@@ -400,13 +295,13 @@ def validate_total_tip_amount(message):
     """
     Validate that the sender has enough Nano to cover the tip to all users
     """
-    logging.info("{}: validating total tip amount".format(datetime.now()))
-    if message['sender_balance_raw']['balance'] < (message['total_tip_amount'] * 1000000000000000000000000000000):
+    logging.debug("validating total tip amount")
+    if message['sender_balance_raw'] < message['total_tip_amount']:
         not_enough_text = ("You do not have enough NANO to cover this {} NANO tip.  Please check your balance by "
-                           "sending a DM to me with !balance and retry.".format(message['total_tip_amount']))
+                           "sending a DM to me with !balance and retry.".format(message['total_tip_amount'].to_nano()))
         send_reply(message, not_enough_text)
 
-        logging.info("{}: User tried to send more than in their account.".format(datetime.now()))
+        logging.info("User tried to send more than in their account.")
         message['tip_amount'] = -1
         return message
 
@@ -416,13 +311,11 @@ def validate_total_tip_amount(message):
 def send_reply(message, text):
     if message['system'] == 'twitter':
         text = '@{} '.format(message['sender_screen_name']) + text
-        try:
-            api.update_status(text, message['id'])
-        except tweepy.TweepError as e:
-            logging.info("{}: Send Reply Tweepy Error: {}".format(datetime.now(), e))
+        queue_message({'kind': 'reply', 'system': 'twitter', 'reply_to': message['id'], 'text': text})
 
     elif message['system'] == 'telegram':
-        telegram_bot.sendMessage(chat_id=message['chat_id'], reply_to_message_id=message['id'], text=text)
+        queue_message({'kind': 'reply', 'system': 'telegram', 'chat_id': message['chat_id'],
+                       'reply_to': message['id'], 'text': text})
 
 
 def check_telegram_member(chat_id, chat_name, member_id, member_name):
@@ -431,17 +324,17 @@ def check_telegram_member(chat_id, chat_name, member_id, member_name):
                                                                       member_id))
     user_check_data = modules.db.get_db_data(check_user_call)
 
-    logging.info("checking if user exists")
+    logging.debug("checking if telegram user %s exists", member_id)
     if not user_check_data:
-        logging.info("{}: User {}-{} not found in DB, inserting".format(datetime.now(), chat_id, member_name))
+        logging.info("User %s-%s not found in DB, inserting", chat_id, member_name)
         new_chat_member_call = ("INSERT INTO telegram_chat_members (chat_id, chat_name, member_id, member_name) "
                                 "VALUES (%s, %s, %s, %s)")
         new_chat_member_values = [chat_id, chat_name, member_id, member_name]
         modules.db.set_db_data(new_chat_member_call, new_chat_member_values)
 
     elif user_check_data[0][1] != member_name:
-        logging.info("Member ID {} name incorrect in DB.  Stored value: {}  Updating to {}"
-                     .format(member_id, user_check_data[0][1], member_name))
+        logging.info("Member ID %s name incorrect in DB.  Stored value: %s  Updating to %s", member_id,
+                     user_check_data[0][1], member_name)
 
         update_name_call = ("UPDATE telegram_chat_members "
                             "SET member_name = %s "
@@ -452,27 +345,13 @@ def check_telegram_member(chat_id, chat_name, member_id, member_name):
     return
 
 
-def get_qr_code(sender_id, sender_account, sm_system):
-    """
-    Check to see if a QR code has been generated for the sender_id / system combination.  If not, generate one.
-    """
-    qr_exists = os.path.isfile('{}/qr/{}-{}.png'.format(os.getcwd(), sender_id, sm_system))
-
-    if not qr_exists:
-        print("No QR exists, generating a QR for account {}".format(sender_account))
-        account_qr = pyqrcode.create('{}'.format(sender_account))
-        account_qr.png('{}/qr/{}-{}.png'.format(os.getcwd(), sender_id, sm_system), scale=4)
-
-
 def send_account_message(account_text, message, account):
     """
     Send a message to the user with their account information.  If twitter, include a QR code for scanning.
     """
 
     if message['system'] == 'twitter':
-        get_qr_code(message['sender_id'], account, message['system'])
-        path = ('{}/qr/{}-{}.png'.format(os.getcwd(), message['sender_id'], message['system']))
-        send_img(message['sender_id'], path, account_text)
+        send_img(message['sender_id'], modules.media.qr_path(account), account_text)
     elif message['system'] != 'twitter':
         send_dm(message['sender_id'], account_text, message['system'])
 
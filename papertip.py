@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+# DEPENDENCIES =========================================
+from datetime import datetime
+
+import argparse
+import logging
+
+import modules.logs
+import modules.papertips
+
+# Set Log File
+modules.logs.setup('webhooks.log')
+
+
+def main():
+    # Make a sheet of funded paper tips and wait for its PDF.  The claim codes on the sheet spend real funds, so the
+    # PDF is only written to the papertips directory for the operator, never served over HTTP.
+    parser = argparse.ArgumentParser(description='Create a sheet of funded paper tips')
+    parser.add_argument('source_account', help='Bot wallet account the tips are funded from')
+    parser.add_argument('count', type=int, help='Number of tips on the sheet')
+    parser.add_argument('amount', help='Value of each tip in the fiat currency')
+    parser.add_argument('--fiat', default='USD', help='Fiat currency of the amount (default USD)')
+    args = parser.parse_args()
+
+    sheet_id = modules.papertips.create_sheet(args.source_account, args.count, args.amount, args.fiat)
+    path = modules.papertips.sheet_pdf(sheet_id, wait=True)
+    logging.info("{}: Paper tip sheet {} rendered to {}".format(datetime.now(), sheet_id, path))
+    print("Sheet {}: {}".format(sheet_id, path))
+
+
+# The render processes import this file again, so the sheet is only made when it's run
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+# DEPENDENCIES =========================================
+from datetime import datetime
+
+import logging
+
+import modules.logs
+from modules.ledger import LEDGER_MODE, settle
+
+# Set Log File
+modules.logs.setup('/root/webhooks/settlement.log')
+
+
+def main():
+    # Settle the internal ledger on chain.  Run from cron while ledger_mode is on, and once more after turning it off
+    # so no unsettled amounts are left behind.
+    if not LEDGER_MODE:
+        logging.info("{}: ledger_mode is off, settling any remaining ledger amounts.".format(datetime.now()))
+
+    settle()
+
+    logging.info("{}: completed ledger settlement.".format(datetime.now()))
+
+
+# Only run as a script, so importing it, e.g. to time its imports, doesn't settle
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import unittest
+
+from modules.amount import RAW_PER_NANO, RawAmount
+
+
+class FromNanoTest(unittest.TestCase):
+
+    def test_whole_and_fraction(self):
+        self.assertEqual(RawAmount.from_nano('1'), RAW_PER_NANO)
+        self.assertEqual(RawAmount.from_nano('1.01'), RAW_PER_NANO + RAW_PER_NANO // 100)
+        self.assertEqual(RawAmount.from_nano('.001'), RAW_PER_NANO // 1000)
+        self.assertEqual(RawAmount.from_nano('2.'), 2 * RAW_PER_NANO)
+        self.assertEqual(RawAmount.from_nano('0'), 0)
+
+    def test_smallest_unit(self):
+        self.assertEqual(RawAmount.from_nano('0.' + '0' * 29 + '1'), 1)
+
+    def test_exact_past_float_precision(self):
+        # 0.1 + 0.2 is not 0.3 in float, but is in raw
+        self.assertEqual(RawAmount.from_nano('0.1') + RawAmount.from_nano('0.2'), RawAmount.from_nano('0.3'))
+        fraction = '123456789' * 3
+        self.assertEqual(RawAmount.from_nano('123456789.' + fraction),
+                         123456789 * RAW_PER_NANO + int(fraction) * 1000)
+
+    def test_non_string_input(self):
+        self.assertEqual(RawAmount.from_nano(5), 5 * RAW_PER_NANO)
+
+    def test_returns_raw_amount(self):
+        self.assertIsInstance(RawAmount.from_nano('1'), RawAmount)
+        self.assertIsInstance(RawAmount.from_nano('1') + 1, RawAmount)
+
+    def test_invalid(self):
+        for text in ['', '.', 'abc', '-1', '+1', '1e5', '1.2.3', '1,5', ' 1', '١', '0.' + '1' * 31]:
+            with self.assertRaises(ValueError, msg=text):
+                RawAmount.from_nano(text)
+
+
+class ToNanoTest(unittest.TestCase):
+
+    def test_format(self):
+        self.assertEqual(RawAmount.from_nano('1').to_nano(), '1')
+        self.assertEqual(RawAmount.from_nano('0.001').to_nano(), '0.001')
+        self.assertEqual(RawAmount.from_nano('10.50').to_nano(), '10.5')
+        self.assertEqual(RawAmount(1).to_nano(), '0.' + '0' * 29 + '1')
+        self.assertEqual(RawAmount(0).to_nano(), '0')
+        self.assertEqual(RawAmount(-RAW_PER_NANO // 2).to_nano(), '-0.5')
+
+    def test_round_trip(self):
+        for text in ['1', '0.000001', '1234.5678', '340282366.920938463463374607431768211455']:
+            self.assertEqual(RawAmount.from_nano(text).to_nano(), text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+
+from modules.amount import RawAmount
+from modules.commands import parse_dm, parse_tip, tokenize
+
+ACCOUNT = 'nano_1natrium1o3z5519ifou7xii8crpxpk8y65qmkih8e8bpsjri651oza8imdd'
+
+
+class ParseTipTest(unittest.TestCase):
+
+    def test_amount_and_mentions(self):
+        command = parse_tip(tokenize('@NanoTipBot !tip 1.5 @alice @Bob thanks!'))
+        self.assertEqual(command.action, 'tip')
+        self.assertEqual(command.amount_text, '1.5')
+        self.assertEqual(command.amount, RawAmount.from_nano('1.5'))
+        self.assertEqual(command.mentions, ['alice', 'bob'])
+        self.assertTrue(command.mentions_bot)
+
+    def test_mentions_stop_at_first_other_word(self):
+        command = parse_tip(tokenize('!tip 1 @alice for the help @bob'))
+        self.assertEqual(command.mentions, ['alice'])
+
+    def test_sender_is_left_out(self):
+        command = parse_tip(tokenize('!tip 1 @alice @Carol'), sender_screen_name='carol')
+        self.assertEqual(command.mentions, ['alice'])
+
+    def test_newlines_split_tokens(self):
+        command = parse_tip(tokenize('!tip 1\n@alice'))
+        self.assertEqual(command.mentions, ['alice'])
+
+    def test_no_tip_command(self):
+        command = parse_tip(tokenize('@NanoTipBot hello @alice'))
+        self.assertIsNone(command.action)
+        self.assertIsNone(command.amount)
+        self.assertEqual(command.mentions, [])
+        self.assertTrue(command.mentions_bot)
+
+    def test_invalid_amount(self):
+        command = parse_tip(tokenize('!tip lots @alice'))
+        self.assertEqual(command.action, 'tip')
+        self.assertEqual(command.amount_text, 'lots')
+        self.assertIsNone(command.amount)
+
+    def test_missing_amount(self):
+        command = parse_tip(tokenize('@alice !tip'))
+        self.assertIsNone(command.amount_text)
+        self.assertIsNone(command.amount)
+
+    def test_address_before_mentions(self):
+        command = parse_tip(tokenize('!tip 1 {}'.format(ACCOUNT)))
+        self.assertEqual(command.address, ACCOUNT)
+        self.assertEqual(command.mentions, [])
+
+
+class ParseDmTest(unittest.TestCase):
+
+    def test_aliases(self):
+        for text, action in [('!balance', 'balance'), ('/bal', 'balance'), ('!B', 'balance'), ('/start', 'help'),
+                             ('!deposit', 'account'), ('!w', 'withdraw'), ('!pt', 'privatetip')]:
+            self.assertEqual(parse_dm(text).action, action, text)
+
+    def test_unknown_command(self):
+        self.assertIsNone(parse_dm('hello there').action)
+
+    def test_withdraw_all(self):
+        command = parse_dm('!withdraw {}'.format(ACCOUNT.upper()))
+        self.assertEqual(command.action, 'withdraw')
+        self.assertEqual(command.address, ACCOUNT)
+        self.assertIsNone(command.amount_text)
+        self.assertIsNone(command.amount)
+
+    def test_withdraw_amount(self):
+        command = parse_dm('!withdraw 0.5 {}'.format(ACCOUNT))
+        self.assertEqual(command.amount_text, '0.5')
+        self.assertEqual(command.amount, RawAmount.from_nano('0.5'))
+        self.assertEqual(command.address, ACCOUNT)
+
+    def test_amount_after_address(self):
+        command = parse_dm('!withdraw {} 2'.format(ACCOUNT))
+        self.assertEqual(command.amount, RawAmount.from_nano('2'))
+        self.assertEqual(command.address, ACCOUNT)
+
+    def test_invalid_amount_is_kept(self):
+        # A mistyped amount must not read as a withdraw of the whole balance
+        command = parse_dm('!withdraw 1,5 {}'.format(ACCOUNT))
+        self.assertEqual(command.amount_text, '1,5')
+        self.assertIsNone(command.amount)
+
+    def test_donate(self):
+        command = parse_dm('!donate  10')
+        self.assertEqual(command.action, 'donate')
+        self.assertEqual(command.amount, RawAmount.from_nano('10'))
+
+    def test_mentions(self):
+        command = parse_dm('!tip 1 @alice @NanoTipBot')
+        self.assertEqual(command.mentions, ['alice'])
+        self.assertTrue(command.mentions_bot)
+        self.assertEqual(command.amount_text, '1')
+
+
+if __name__ == '__main__':
+    unittest.main()
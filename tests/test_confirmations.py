@@ -0,0 +1,177 @@
+import asyncio
+import base64
+import hashlib
+import json
+import queue
+import socket
+import struct
+import threading
+import unittest
+from unittest import mock
+
+import modules.confirmations
+
+ACCOUNT = 'nano_1natrium1o3z5519ifou7xii8crpxpk8y65qmkih8e8bpsjri651oza8imdd'
+SENDER = 'nano_3t6k35gi95xu6tergt6p69ck76ogmitsa8mnijtpxm9fkcm736xtoncuohr3'
+BLOCK_HASH = '87434F8041869A01C8F6F263B87972D7BA443A72E0A97D7A3FD0CCC2358FD6F9'
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class StandInNode(object):
+    """
+    Minimal RFC 6455 server standing in for the node's websocket.  It takes one connection, records the JSON messages
+    the client sends, and sends a confirmation of a send to ACCOUNT once the client subscribes.
+    """
+
+    def __init__(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.url = 'ws://127.0.0.1:{}'.format(self.server.getsockname()[1])
+        self.received = queue.Queue()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.close()
+
+    def serve(self):
+        connection, _ = self.server.accept()
+        request = b''
+        while b'\r\n\r\n' not in request:
+            request += connection.recv(1024)
+        headers = dict(line.split(': ', 1) for line in request.decode().split('\r\n')[1:] if ': ' in line)
+        accept = base64.b64encode(hashlib.sha1((headers['Sec-WebSocket-Key'] + WS_GUID).encode()).digest()).decode()
+        connection.sendall('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                           'Sec-WebSocket-Accept: {}\r\n\r\n'.format(accept).encode())
+
+        subscribe = json.loads(self.read_frame(connection))
+        self.received.put(subscribe)
+        self.send_frame(connection, json.dumps({'ack': 'subscribe'}))
+        self.send_frame(connection, json.dumps({
+            'topic': 'confirmation',
+            'message': {
+                'account': SENDER,
+                'hash': BLOCK_HASH,
+                'block': {'subtype': 'send', 'link_as_account': ACCOUNT.replace('nano_', 'xrb_')}
+            }
+        }))
+        # Keep the connection open until the test closes the server
+        try:
+            while self.read_frame(connection):
+                pass
+        except OSError:
+            pass
+
+    @staticmethod
+    def read_exactly(connection, length):
+        data = b''
+        while len(data) < length:
+            chunk = connection.recv(length - len(data))
+            if not chunk:
+                raise OSError('Connection closed')
+            data += chunk
+        return data
+
+    def read_frame(self, connection):
+        first, second = self.read_exactly(connection, 2)
+        length = second & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self.read_exactly(connection, 2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.read_exactly(connection, 8))[0]
+        # Frames from a client are always masked
+        mask = self.read_exactly(connection, 4)
+        payload = self.read_exactly(connection, length)
+        return bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload)).decode()
+
+    @staticmethod
+    def send_frame(connection, text):
+        payload = text.encode()
+        if len(payload) < 126:
+            header = struct.pack('!BB', 0x81, len(payload))
+        else:
+            header = struct.pack('!BBH', 0x81, 126, len(payload))
+        connection.sendall(header + payload)
+
+
+class SubscriptionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.node = StandInNode()
+        self.addCleanup(self.node.close)
+        # Nothing here touches the DB or the node RPC
+        patches = [
+            mock.patch('modules.db.get_db_data', return_value=[(ACCOUNT,)]),
+            mock.patch('modules.db.get_lock', return_value=mock.Mock()),
+            mock.patch('modules.db.release_lock'),
+            mock.patch('modules.confirmations.receive_backlog'),
+            mock.patch('modules.balances.invalidate_balance'),
+            mock.patch.object(modules.confirmations, 'CONFIRMATION_WS', self.node.url),
+            mock.patch.object(modules.confirmations, 'receive_queue', queue.Queue())
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(modules.confirmations.subscribed.clear)
+
+    def test_confirmed_send_is_queued_for_receive(self):
+        threading.Thread(target=modules.confirmations.subscription_loop, args=(self.node.url,), daemon=True).start()
+
+        subscribe = self.node.received.get(timeout=10)
+        self.assertEqual(subscribe['action'], 'subscribe')
+        self.assertEqual(subscribe['topic'], 'confirmation')
+        self.assertEqual(subscribe['options']['accounts'], [ACCOUNT])
+
+        self.assertEqual(modules.confirmations.receive_queue.get(timeout=10), (ACCOUNT, BLOCK_HASH))
+        self.assertTrue(modules.confirmations.subscription_alive())
+        modules.confirmations.receive_backlog.assert_called_once_with([ACCOUNT])
+
+    def test_not_alive_without_a_subscriber(self):
+        modules.confirmations.subscribed.clear()
+        with mock.patch('modules.db.get_db_data', return_value=[(None,)]):
+            modules.confirmations.alive_check['checked'] = 0
+            self.assertFalse(modules.confirmations.subscription_alive())
+
+
+
+class ReceiveOrderTest(unittest.TestCase):
+
+    def test_blocks_received_in_order_per_account(self):
+        received = []
+
+        async def receive_block(account, block):
+            received.append(('start', account, block))
+            await asyncio.sleep(0.05)
+            received.append(('end', account, block))
+
+        async def pending_blocks(accounts, batch_size):
+            return {'A': ['a3'], 'B': ['b1']}
+
+        patches = [
+            mock.patch('modules.aionode.receive_block', receive_block),
+            mock.patch('modules.aionode.pending_blocks', pending_blocks),
+            mock.patch.object(modules.confirmations, 'receive_queue', queue.Queue()),
+            mock.patch.object(modules.confirmations, 'subscription_loop', lambda url: None),
+            mock.patch.object(modules.confirmations, 'receive_thread', None)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        modules.confirmations.start_subscription('ws://127.0.0.1:1')
+        for incoming in [('A', 'a1'), ('A', 'a2'), ('A', 'a1')]:
+            modules.confirmations.receive_queue.put(incoming)
+        modules.confirmations.receive_backlog(['A', 'B'])
+        modules.confirmations.receive_queue.join()
+
+        account_a = [event for event in received if event[1] == 'A']
+        self.assertEqual(account_a, [('start', 'A', 'a1'), ('end', 'A', 'a1'), ('start', 'A', 'a2'),
+                                     ('end', 'A', 'a2'), ('start', 'A', 'a3'), ('end', 'A', 'a3')])
+        # B doesn't wait for A's blocks
+        self.assertLess(received.index(('start', 'B', 'b1')), received.index(('end', 'A', 'a1')))
+
+
+if __name__ == '__main__':
+    unittest.main()
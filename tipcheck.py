@@ -2,52 +2,41 @@
 
 # DEPENDENCIES =========================================
 from datetime import datetime
-from decimal import Decimal
-from TwitterAPI import TwitterAPI
-import telegram
 from nano import convert
 from modules.db import get_db_data, set_db_data
 from modules.social import send_dm
 from modules.currency import get_pow
+from modules.amount import RawAmount
+from modules.node import rpc
+from modules.balances import get_balances, invalidate_balance
+import modules.logs
+import modules.registry
 
-import MySQLdb, re, requests, nano, tweepy, configparser, logging, json
+import MySQLdb, re, requests, nano, tweepy, logging, json
 
 # CONFIG CONSTANTS =====================================
-config = configparser.ConfigParser()
-config.read('webhookconfig.ini')
+config = modules.registry.config
 
-CONSUMER_KEY = config.get('webhooks', 'consumer_key')
-CONSUMER_SECRET = config.get('webhooks', 'consumer_secret')
-ACCESS_TOKEN = config.get('webhooks', 'access_token')
-ACCESS_TOKEN_SECRET = config.get('webhooks', 'access_token_secret')
 DB_HOST = config.get('webhooks', 'host')
 DB_USER = config.get('webhooks', 'user')
 DB_PW = config.get('webhooks', 'password')
 DB_SCHEMA = config.get('webhooks', 'schema')
 WALLET = config.get('webhooks', 'wallet')
-NODE_IP = config.get('webhooks', 'node_ip')
 BOT_ACCOUNT = config.get('webhooks', 'bot_account')
 WORK_SERVER = config.get('webhooks', 'work_server')
 WORK_KEY = config.get('webhooks', 'work_key')
-TELEGRAM_KEY = config.get('webhooks', 'telegram_key')
 
 
 # Connect to Twitter
-auth = tweepy.OAuthHandler(CONSUMER_KEY, CONSUMER_SECRET)
-auth.set_access_token(ACCESS_TOKEN, ACCESS_TOKEN_SECRET)
-api = tweepy.API(auth)
+api = modules.registry.twitter_api
 # Secondary API for non-tweepy supported requests
-twitterAPI = TwitterAPI(CONSUMER_KEY, CONSUMER_SECRET, ACCESS_TOKEN, ACCESS_TOKEN_SECRET)
-
-# Connect to Nano Node
-rpc = nano.rpc.Client(NODE_IP)
+twitterAPI = modules.registry.twitter_request_api
 
 # Connect to Telegram
-telegram_bot = telegram.Bot(token=TELEGRAM_KEY)
+telegram_bot = modules.registry.telegram_bot
 
 # Set Log File
-logging.basicConfig(handlers=[logging.FileHandler('/root/webhooks/unregistered.log', 'a', 'utf-8')],
-                    level=logging.INFO)
+modules.logs.setup('/root/webhooks/unregistered.log')
 
 
 def unregistered_user_reminder(day_difference, dm_text):
@@ -155,18 +144,33 @@ def return_tips():
                            "AND tip_bot.tip_list.processed = 2;")
     tip_list = get_db_data(tips_to_return_call)
 
+    # Look up every receiver's balance in one call, and track it as tips are returned
+    receiver_balances = {}
+    if tip_list:
+        balances = get_balances([tip[2] for tip in tip_list])
+        receiver_balances = {account: balance['balance'] for account, balance in balances.items()}
+
     for tip in tip_list:
         transaction_id = tip[0]
         sender_id = tip[1]
         receiver_account = tip[2]
-        amount = Decimal(tip[3])
+        amount = RawAmount.from_nano(tip[3])
 
         logging.info("{}: Returning tip {}".format(datetime.now(), transaction_id))
 
         sender_account_call = "SELECT account FROM users WHERE user_id = {}".format(sender_id)
         sender_account_info = get_db_data(sender_account_call)
         sender_account = sender_account_info[0][0]
-        send_amount = int(amount * 1000000000000000000000000000000)
+        send_amount = int(amount)
+
+        if receiver_balances[receiver_account] < amount:
+            logging.info("{}: Insufficient balance to return tip {}".format(datetime.now(), transaction_id))
+            insufficient_balance_call = ("UPDATE tip_bot.tip_list "
+                                         "SET processed = 6 "
+                                         "WHERE dm_id = %s;")
+            set_db_data(insufficient_balance_call, [transaction_id, ])
+            continue
+        receiver_balances[receiver_account] -= amount
 
         work = get_pow(receiver_account)
         try:
@@ -176,6 +180,7 @@ def return_tips():
             else:
                 send_hash = rpc.send(wallet="{}".format(WALLET), source="{}".format(receiver_account),
                                      destination="{}".format(sender_account), amount=send_amount, work=work)
+            invalidate_balance(receiver_account)
             logging.info("{}: Tip returned under hash: {}".format(str(datetime.now()), send_hash))
         except nano.rpc.RPCException as e:
             logging.info("{}: Insufficient balance to return.  Descriptive error: {}".format(datetime.now(), e))
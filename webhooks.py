@@ -1,42 +1,36 @@
 import base64
-import configparser
 from decimal import Decimal
 import hashlib
 import hmac
 import json
 import logging
-import os
-from datetime import timedelta, datetime
 from http import HTTPStatus
+from urllib.parse import urlencode
 
-import nano
 import requests
-import telegram
-import tweepy
 from flask import Flask, render_template, request, Response
-from flask_weasyprint import HTML, render_pdf
 
+import modules.aionode
+import modules.assets
+import modules.balances
 import modules.currency
 import modules.db
+import modules.feed
+import modules.identity
+import modules.jobs
+import modules.logs
+import modules.node
 import modules.orchestration
+import modules.pagecache
+import modules.papertips
+import modules.registry
 import modules.social
 
 # Set Log File
-logging.basicConfig(handlers=[logging.FileHandler('webhooks.log', 'a', 'utf-8')],
-                    level=logging.INFO)
+modules.logs.setup('webhooks.log')
 
 # Read config and parse constants
-config = configparser.ConfigParser()
-config.read('webhookconfig.ini')
-
-# Twitter API connection settings
-CONSUMER_KEY = config.get('webhooks', 'consumer_key')
-CONSUMER_SECRET = config.get('webhooks', 'consumer_secret')
-ACCESS_TOKEN = config.get('webhooks', 'access_token')
-ACCESS_TOKEN_SECRET = config.get('webhooks', 'access_token_secret')
-
-# Telegram API
-TELEGRAM_KEY = config.get('webhooks', 'telegram_key')
+config = modules.registry.config
 
 # IDs
 BOT_ID_TWITTER = config.get('webhooks', 'bot_id_twitter')
@@ -51,81 +45,33 @@ TELEGRAM_URI = config.get('routes', 'telegram_uri')
 TELEGRAM_SET_URI = config.get('routes', 'telegram_set_uri')
 BASE_URL = config.get('routes', 'base_url')
 
+# Most screen names /webhooks/twitter/getaccounts takes in one request, one users/lookup call's worth
+GETACCOUNTS_MAX = 100
+
 # Set up Flask routing
 app = Flask(__name__)
+# Templates link to the fingerprinted assets from build_assets.py through these
+app.jinja_env.globals.update(asset_url=modules.assets.asset_url, image_url=modules.assets.image_url,
+                             image_srcset=modules.assets.image_srcset)
 
 # Connect to Twitter
-auth = tweepy.OAuthHandler(CONSUMER_KEY, CONSUMER_SECRET)
-auth.set_access_token(ACCESS_TOKEN, ACCESS_TOKEN_SECRET)
-api = tweepy.API(auth)
+api = modules.registry.twitter_api
 
 # Connect to Telegram
-telegram_bot = telegram.Bot(token=TELEGRAM_KEY)
+telegram_bot = modules.registry.telegram_bot
 
 # Connect to Nano Node
-NODE_IP = config.get('webhooks', 'node_ip')
-rpc = nano.rpc.Client(NODE_IP)
-
-
-# Flask routing
-@app.route('/test/papertip')
-def papertiptest():
-
-    exp_length = 30
-
-    currency_amount = 5.00
-    currency_type = 'EUR'
-    crypto_currency = 'NANO'
-    nano_amount = modules.currency.get_fiat_conversion(currency_type, crypto_currency, currency_amount)
-
-    if currency_type == 'USD':
-        currency_mark = '$'
-    elif currency_type == 'EUR':
-        currency_mark = u"\u20AC"
-    else:
-        currency_mark = u"\u00A3"
-
-    gen_date = datetime.now().strftime("%b %d, %y")
-    exp_date = (datetime.now() + timedelta(days=exp_length)).strftime("%b %d, %y")
-    nano_price = modules.currency.get_fiat_price(currency_type, crypto_currency)
-    qr_img = "papertipqr.png"
-    qr_link = "https://nanotipbot.com/tips/iaoi4fat-haa-32aaa"
-    num_tip = 6
-
-    return render_template('/templates/papertip.html', nano_amount=nano_amount, currency_mark=currency_mark,
-                           currency_amount=currency_amount, gen_date=gen_date, exp_date=exp_date, nano_price=nano_price,
-                           qr_img=qr_img, qr_link=qr_link, num_tip=num_tip)
-
-
-@app.route('/test/papertippdf')
-def paperpdf():
-
-    exp_length = 30
-
-    currency_amount = 5.00
-    currency_type = 'USD'
-    crypto_currency = 'NANO'
-    nano_amount = modules.currency.get_fiat_conversion(currency_type, crypto_currency, currency_amount)
-
-    if currency_type == 'USD':
-        currency_mark = '$'
-    elif currency_type == 'EUR':
-        currency_mark = u"\u20AC"
-    else:
-        currency_mark = u"\u00A3"
+rpc = modules.node.rpc
+rpc.start_health_checks()
 
-    gen_date = datetime.now().strftime("%b %d, %y")
-    exp_date = (datetime.now() + timedelta(days=exp_length)).strftime("%b %d, %y")
-    nano_price = modules.currency.get_fiat_price(currency_type, crypto_currency)
-    qr_img = "papertipqr.png"
-    qr_link = "https://nanotipbot.com/tips/iaoi4fat-haa-32aaa"
-    num_tip = 12
+# Keep the node stats for the about page cached in memory
+modules.currency.start_network_stats()
 
-    html = render_template('papertip.html', nano_amount=nano_amount, currency_mark=currency_mark,
-                           currency_amount=currency_amount, gen_date=gen_date, exp_date=exp_date, nano_price=nano_price,
-                           qr_img=qr_img, qr_link=qr_link, num_tip=num_tip)
 
-    return render_pdf(HTML(string=html))
+# Flask routing
+@app.route('{}/<path:filename>'.format(modules.assets.BUILD_URL))
+def built_asset(filename):
+    return modules.assets.send_asset(filename, request.accept_encodings)
 
 
 @app.route('/tutorial')
@@ -136,6 +82,7 @@ def tutorial():
 
 @app.route('/about')
 @app.route('/about.html')
+@modules.pagecache.cached_page('about')
 def about():
     btc_energy = 887000
     nano_energy = 0.032
@@ -168,6 +115,7 @@ def thanks():
 
 @app.route('/tippers')
 @app.route('/tippers.html')
+@modules.pagecache.cached_page('tippers')
 def tippers():
     largest_tip = ("SELECT user_name, amount, account, a.system, timestamp "
                    "FROM tip_bot.tip_list AS a, tip_bot.users AS b "
@@ -196,36 +144,57 @@ def tippers():
                            top_tipper_date=top_tipper_date)
 
 
+def render_tip_feed(system, screen_name, cursor):
+    tips, next_cursor = modules.feed.get_tips(system, screen_name, cursor)
+    older_url = None
+    if next_cursor is not None:
+        # Built by hand, as the cached first page is rendered outside of a request
+        older_args = {'cursor': next_cursor, 'system': system, 'user': screen_name}
+        older_url = '/tiplist?{}'.format(urlencode({name: value for name, value in older_args.items() if value}))
+    return render_template('tiplist.html', tips=tips, older_url=older_url)
+
+
+@modules.pagecache.cached_page('tiplist')
+def tip_list_first_page():
+    return render_tip_feed(None, None, None)
+
+
 @app.route('/tiplist')
 def tip_list():
-    tip_list_call = ("SELECT t1.user_name AS 'Sender ID', t2.user_name AS 'Receiver ID', t1.amount, "
-                     "t1.account AS 'Sender Account', t2.account AS 'Receiver Account', t1.system, t1.timestamp "
-                     "FROM "
-                     "(SELECT user_name, amount, account, a.system, timestamp "
-                     "FROM tip_bot.tip_list AS a, tip_bot.users AS b "
-                     "WHERE user_id = sender_id "
-                     "AND user_name IS NOT NULL "
-                     "AND processed = 2 "
-                     "AND user_name != 'mitche50' "
-                     "ORDER BY timestamp desc "
-                     "LIMIT 50) AS t1 "
-                     "JOIN "
-                     "(SELECT user_name, account, timestamp "
-                     "FROM tip_bot.tip_list, tip_bot.users "
-                     "WHERE user_id = receiver_id "
-                     "AND user_name IS NOT NULL "
-                     "AND processed = 2 "
-                     "ORDER BY timestamp DESC "
-                     "LIMIT 20) AS t2 "
-                     "ON t1.timestamp = t2.timestamp")
-    tip_list_table = modules.db.get_db_data(tip_list_call)
-    print(tip_list_table)
-    return render_template('tiplist.html', tip_list_table=tip_list_table)
+    # The latest tips come from the page cache.  Older pages and filtered feeds are keyset reads, so they're rendered
+    # as they're asked for.
+    if not request.args:
+        return tip_list_first_page()
+    try:
+        return render_tip_feed(request.args.get('system'), request.args.get('user'), request.args.get('cursor'))
+    except ValueError:
+        return "Invalid cursor", HTTPStatus.BAD_REQUEST
+
+
+@app.route('/api/tips', methods=["GET"])
+def tip_feed():
+    """
+    The tip feed as JSON, newest first.  Pass next_cursor back as cursor for the next page.  Takes optional system,
+    user (screen name) and limit parameters.
+    """
+    try:
+        limit = int(request.args.get('limit', modules.feed.FEED_PAGE_SIZE))
+        tips, next_cursor = modules.feed.get_tips(request.args.get('system'), request.args.get('user'),
+                                                  request.args.get('cursor'), limit)
+    except ValueError:
+        return "Invalid cursor or limit", HTTPStatus.BAD_REQUEST
+
+    response = Response(json.dumps({'tips': [modules.feed.tip_json(tip) for tip in tips],
+                                    'next_cursor': next_cursor}))
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Content-Type'] = 'application/json'
+    return response, HTTPStatus.OK
 
 
 @app.route('/')
 @app.route('/index')
 @app.route('/index.html')
+@modules.pagecache.cached_page('index')
 def index():
     r = requests.get('https://api.coinmarketcap.com/v2/ticker/1567/')
     rx = r.json()
@@ -284,12 +253,12 @@ def get_twitter_account(screen_name):
                             "WHERE user_id = '{}' AND users.system = 'twitter';".format(user.id_str))
             account_return = modules.db.get_db_data(account_call)
             modules.currency.receive_pending(account_return[0][0])
-            balance_return = rpc.account_balance(account="{}".format(account_return[0][0]))
+            balance_return = modules.balances.get_balance(account_return[0][0])
             account_dict = {
                 'user_id': user.id_str,
                 'account': account_return[0],
-                'balance': str(balance_return['balance'] / 1000000000000000000000000000000),
-                'pending': str(balance_return['pending'] / 1000000000000000000000000000000)
+                'balance': balance_return['balance'].to_nano(),
+                'pending': balance_return['pending'].to_nano()
             }
             response = Response(json.dumps(account_dict))
             response.headers['Access-Control-Allow-Credentials'] = True
@@ -297,7 +266,7 @@ def get_twitter_account(screen_name):
             response.headers['Content-Type'] = 'application/json'
             return response, HTTPStatus.OK
         else:
-            logging.info('{}: No user found.'.format(datetime.now()))
+            logging.info("No user found.")
             account_dict = {
                 'user_id': None,
                 'account': None,
@@ -310,7 +279,7 @@ def get_twitter_account(screen_name):
             response.headers['Content-Type'] = 'application/json'
             return response, HTTPStatus.OK
     except Exception as e:
-        logging.info('{}: ERROR in get_twitter_account(webhooks.py): {}'.format(datetime.now(), e))
+        logging.info("ERROR in get_twitter_account(webhooks.py): %s", e)
         account_dict = {
             'user_id': None,
             'account': None,
@@ -324,13 +293,86 @@ def get_twitter_account(screen_name):
         return response, HTTPStatus.OK
 
 
+def get_twitter_accounts(screen_names):
+    """
+    Return {screen name: account dict} in the format of get_twitter_account for the screen names, with one users/lookup
+    call, one users query and one accounts_balances call for all of them.  Pending blocks are reported, not received.
+    """
+    accounts = {screen_name: {'user_id': None, 'account': None, 'balance': None, 'pending': None}
+                for screen_name in screen_names}
+    users = modules.identity.resolve_screen_names(screen_names)
+    if not users:
+        return accounts
+
+    user_ids = [user['id'] for user in users.values()]
+    account_call = ("SELECT user_id, account FROM users WHERE users.system = 'twitter' AND user_id IN ({})"
+                    .format(', '.join(['%s'] * len(user_ids))))
+    user_accounts = {int(row[0]): row[1] for row in modules.db.get_db_data(account_call, user_ids)}
+    balances = modules.balances.get_balances(list(user_accounts.values())) if user_accounts else {}
+
+    for screen_name in screen_names:
+        user = users.get(screen_name.lower())
+        if user is None:
+            continue
+        accounts[screen_name]['user_id'] = str(user['id'])
+        account = user_accounts.get(int(user['id']))
+        if account is not None:
+            accounts[screen_name]['account'] = account
+            accounts[screen_name]['balance'] = balances[account]['balance'].to_nano()
+            accounts[screen_name]['pending'] = balances[account]['pending'].to_nano()
+
+    return accounts
+
+
+@app.route('/webhooks/twitter/getaccounts', methods=["GET", "POST"])
+def get_twitter_accounts_batch():
+    """
+    Batch get_twitter_account for the browser extension.  Takes up to GETACCOUNTS_MAX screen names, as a comma separated
+    screen_names parameter or a JSON body of {"screen_names": [...]}, and returns {screen name: account}.
+    """
+    if request.method == 'POST':
+        requested = (request.get_json(silent=True) or {}).get('screen_names') or []
+    else:
+        requested = request.args.get('screen_names', '').split(',')
+    screen_names = []
+    for screen_name in requested:
+        screen_name = '{}'.format(screen_name).strip().lstrip('@')
+        if screen_name and screen_name not in screen_names:
+            screen_names.append(screen_name)
+    if len(screen_names) > GETACCOUNTS_MAX:
+        return "At most {} screen names can be looked up at once".format(GETACCOUNTS_MAX), HTTPStatus.BAD_REQUEST
+
+    try:
+        accounts = get_twitter_accounts(screen_names)
+    except Exception as e:
+        logging.info("ERROR in get_twitter_accounts_batch(webhooks.py): %s", e)
+        accounts = None
+
+    response = Response(json.dumps(accounts if accounts is not None else {'error': 'Lookup failed, try again'}))
+    response.headers['Access-Control-Allow-Credentials'] = True
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Content-Type'] = 'application/json'
+    if accounts is None:
+        # A failed lookup must not be mistaken for accounts that don't exist, by the extension or any cache
+        response.status_code = HTTPStatus.SERVICE_UNAVAILABLE
+        response.cache_control.no_store = True
+        return response
+
+    # Balances are cached for this long anyway, so the extension and any proxy can reuse the answer
+    response.cache_control.public = True
+    response.cache_control.max_age = modules.balances.BALANCE_CACHE_TTL
+    response.add_etag()
+    return response.make_conditional(request)
+
+
 @app.route('/webhooks/twitter/refreshbalance/<account>', methods=["GET"])
 def refresh_balance(account):
     try:
-        balance_return = rpc.account_balance(account="{}".format(account))
+        # The extension asks for this after a deposit or a tip, so the cached balance is the one it doesn't want
+        balance_return = modules.balances.get_balance(account, fresh=True)
         balance_dict = {
-            'balance': balance_return[0],
-            'pending': balance_return[1]
+            'balance': balance_return['balance'].to_nano(),
+            'pending': balance_return['pending'].to_nano()
         }
         response = Response(json.dumps(balance_dict))
         response.headers['Access-Control-Allow-Credentials'] = True
@@ -339,185 +381,82 @@ def refresh_balance(account):
 
         return response, HTTPStatus.OK
     except Exception as e:
-        logging.info("{}: ERROR in refresh_balance (webhooks.py): {}".format(datetime.now, e))
+        logging.info("ERROR in refresh_balance (webhooks.py): %s", e)
         return e, HTTPStatus.BAD_REQUEST
 
 
+@app.route('/tips/<claim_code>', methods=["GET", "POST"])
+def paper_tip(claim_code):
+    """
+    Claim page for the QR code on a paper tip.  Posting an account sends the tip to it.
+    """
+    tip = modules.papertips.load_tip(claim_code)
+    if tip is None:
+        return render_template('papertipclaim.html', tip=None), HTTPStatus.NOT_FOUND
+
+    error = None
+    send_hash = None
+    if request.method == 'POST' and tip['claimed'] == modules.papertips.TIP_UNCLAIMED and not tip['expired']:
+        destination = request.form.get('account', '').strip()
+        if rpc.validate_account_number(destination) == 0:
+            error = "That account number is invalid, please check it and try again."
+        else:
+            try:
+                send_hash = modules.papertips.claim_tip(claim_code, destination)
+            except Exception as e:
+                logging.info("ERROR in paper_tip (webhooks.py): %s", e)
+                return render_template('papertipclaim.html', tip=tip,
+                                       error="The tip couldn't be sent right now, please try again later."), \
+                    HTTPStatus.SERVICE_UNAVAILABLE
+            if send_hash is None:
+                tip = modules.papertips.load_tip(claim_code)
+
+    return render_template('papertipclaim.html', tip=tip, error=error, send_hash=send_hash,
+                           destination=request.form.get('account')), HTTPStatus.OK
+
+
+@app.route('/webhooks/node/stats', methods=["GET"])
+def node_stats():
+    """
+    Per node health and latency, and latency histograms of the async RPC client calls made by this process
+    """
+    response = Response(json.dumps({'nodes': rpc.stats(),
+                                    'async_latency': modules.aionode.aiorpc.latency_histograms()}))
+    response.headers['Content-Type'] = 'application/json'
+
+    return response, HTTPStatus.OK
+
+
+@app.route('/webhooks/jobs/stats', methods=["GET"])
+def job_stats():
+    """
+    Queue depth, dead letters, rejections, deferrals, shed jobs and recent wait and run times for each job lane
+    """
+    response = Response(json.dumps(modules.jobs.lane_stats()))
+    response.headers['Content-Type'] = 'application/json'
+
+    return response, HTTPStatus.OK
+
+
 @app.route(TELEGRAM_URI, methods=["POST"])
 def telegram_event():
-    message = {
-        # id:                     ID of the received tweet - Error logged through None value
-        # text:                   A list containing the text of the received tweet, split by ' '
-        # sender_id:              Twitter ID of the user sending the tip
-        # sender_screen_name:     Twitter Handle of the user sending the tip
-        # sender_account:         Nano account of sender - Error logged through None value
-        # sender_register:        Registration status with Tip Bot of sender account
-        # sender_balance_raw:     Amount of Nano in sender's account, stored in raw
-        # sender_balance:         Amount of Nano in sender's account, stored in Nano
-
-        # action_index:           Location of key action value *(currently !tip only)
-        # action:                 Action found in the received tweet - Error logged through None value
-
-        # starting_point:         Location of action sent via tweet (currently !tip only)
-
-        # tip_amount:             Value of tip to be sent to receiver(s) - Error logged through -1
-        # tip_amount_text:        Value of the tip stored in a string to prevent formatting issues
-        # total_tip_amount:       Equal to the tip amount * number of users to tip
-        # tip_id:                 ID of the tip, used to prevent double sending of tips.  Comprised of
-        #                         message['id'] + index of user in users_to_tip
-        # send_hash:              Hash of the send RPC transaction
-        # system:                 System that the command was sent from
-    }
-
-    users_to_tip = [
-        # List including dictionaries for each user to send a tip.  Each index will include
-        # the below parameters
-        #    receiver_id:            Twitter ID of the user receiving a tip
-        #    receiver_screen_name:   Twitter Handle of the user receiving a tip
-        #    receiver_account:       Nano account of receiver
-        #    receiver_register:      Registration status with Tip Bot of reciever account
-    ]
-    message['system'] = 'telegram'
+    """
+    Queue the update for the job workers and acknowledge it right away, even if admission control defers or sheds it
+    """
     request_json = request.get_json()
-    if 'message' in request_json.keys():
-        if request_json['message']['chat']['type'] == 'private':
-            logging.info("Direct message received in Telegram.  Processing.")
-            message['sender_id'] = request_json['message']['from']['id']
-            try:
-                message['sender_screen_name'] = request_json['message']['from']['username']
-            except KeyError:
-                if 'first_name' in request_json['message']['from'].keys():
-                    message['sender_screen_name'] = request_json['message']['from']['first_name']
-                if 'last_name' in request_json['message']['from'].keys():
-                    message['sender_screen_name'] = \
-                        message['sender_screen_name'] + ' ' + request_json['message']['from']['last_name']
-            message['dm_id'] = request_json['update_id']
-            message['text'] = request_json['message']['text']
-            message['dm_array'] = message['text'].split(" ")
-            message['dm_action'] = message['dm_array'][0].lower()
-
-            logging.info("{}: action identified: {}".format(datetime.now(), message['dm_action']))
-
-            modules.orchestration.parse_action(message)
-
-        elif (request_json['message']['chat']['type'] == 'supergroup' or
-              request_json['message']['chat']['type'] == 'group'):
-
-            if 'forward_from' in request_json['message']:
-                return '', HTTPStatus.OK
-
-            if 'text' in request_json['message']:
-                message['sender_id'] = request_json['message']['from']['id']
-                if 'username' in request_json['message']['from']:
-                    message['sender_screen_name'] = request_json['message']['from']['username']
-                else:
-                    if 'first_name' in request_json['message']['from'].keys():
-                        message['sender_screen_name'] = request_json['message']['from']['first_name']
-                    if 'last_name' in request_json['message']['from'].keys():
-                        message['sender_screen_name'] = \
-                            message['sender_screen_name'] + ' ' + request_json['message']['from']['last_name']
-                message['id'] = request_json['message']['message_id']
-                message['chat_id'] = request_json['message']['chat']['id']
-                message['chat_name'] = request_json['message']['chat']['title']
-
-                modules.social.check_telegram_member(message['chat_id'], message['chat_name'], message['sender_id'],
-                                                     message['sender_screen_name'])
-
-                message['text'] = request_json['message']['text']
-                message['text'] = message['text'].replace('\n', ' ')
-                message['text'] = message['text'].lower()
-                message['text'] = message['text'].split(' ')
-
-                message = modules.social.check_message_action(message)
-                if message['action'] is None:
-                    return '', HTTPStatus.OK
-
-                message = modules.social.validate_tip_amount(message)
-                if message['tip_amount'] <= 0:
-                    return '', HTTPStatus.OK
-
-                if message['action'] != -1 and str(message['sender_id']) != str(BOT_ID_TELEGRAM):
-                    new_pid = os.fork()
-                    if new_pid == 0:
-                        try:
-                            bot_status = config.get('webhooks', 'bot_status')
-                            if bot_status == 'maintenance':
-                                modules.social.send_dm(message['sender_id'],
-                                                       "The tip bot is in maintenance.  Check @NanoTipBot on Twitter "
-                                                       "for more information.",
-                                                       message['system'])
-                            else:
-                                modules.orchestration.tip_process(message, users_to_tip, request_json)
-                        except Exception as e:
-                            logging.info("Exception: {}".format(e))
-                            raise e
-
-                        os._exit(0)
-                    else:
-                        return '', HTTPStatus.OK
-            elif 'new_chat_member' in request_json['message']:
-                logging.info("new member joined chat, adding to DB")
-                chat_id = request_json['message']['chat']['id']
-                chat_name = request_json['message']['chat']['title']
-                member_id = request_json['message']['new_chat_member']['id']
-                if 'username' in request_json['message']['new_chat_member']:
-                    member_name = request_json['message']['new_chat_member']['username']
-                else:
-                    member_name = None
-
-                new_chat_member_call = (
-                    "INSERT IGNORE INTO telegram_chat_members (chat_id, chat_name, member_id, member_name) "
-                    "VALUES (%s, %s, %s, %s)")
-                new_member_values = [chat_id, chat_name, member_id, member_name]
-                err = modules.db.set_db_data(new_chat_member_call, new_member_values)
-                if err is not None:
-                    return 'ok'
-
-            elif 'left_chat_member' in request_json['message']:
-                chat_id = request_json['message']['chat']['id']
-                chat_name = request_json['message']['chat']['title']
-                member_id = request_json['message']['left_chat_member']['id']
-                if 'username' in request_json['message']['left_chat_member']:
-                    member_name = request_json['message']['left_chat_member']['username']
-                else:
-                    member_name = None
-                logging.info("member {}-{} left chat {}-{}, removing from DB.".format(member_id, member_name, chat_id,
-                                                                                      chat_name))
-
-                remove_member_call = ("DELETE FROM telegram_chat_members "
-                                      "WHERE chat_id = %s AND member_id = %s")
-                remove_member_values = [chat_id, member_id]
-                err = modules.db.set_db_data(remove_member_call, remove_member_values)
-                if err is not None:
-                    return 'ok'
-
-            elif 'group_chat_created' in request_json['message']:
-                chat_id = request_json['message']['chat']['id']
-                chat_name = request_json['message']['chat']['title']
-                member_id = request_json['message']['from']['id']
-                member_name = request_json['message']['from']['username']
-                logging.info("member {} created chat {}, inserting creator into DB.".format(member_name, chat_name))
-                new_chat_call = ("INSERT IGNORE INTO telegram_chat_members (chat_id, chat_name, member_id, member_name) "
-                                 "VALUES (%s, %s, %s, %s)")
-                new_chat_values = [chat_id, chat_name, member_id, member_name]
-                err = modules.db.set_db_data(new_chat_call, new_chat_values)
-                if err is not None:
-                    return 'ok'
+    try:
+        modules.jobs.enqueue('telegram_update', request_json)
+    except modules.jobs.QueueFull:
+        # Telegram redelivers updates that weren't acknowledged
+        return '', HTTPStatus.SERVICE_UNAVAILABLE
 
-        else:
-            logging.info("request: {}".format(request_json))
     return 'ok'
 
 
-@app.route(TWITTER_URI, methods=["POST"])
-def twitter_event_received():
-    message = {}
-    users_to_tip = []
-
-    message['system'] = 'twitter'
-    request_json = request.get_json()
-    auth_header = request.headers.get('X-Twitter-Webhooks-Signature')
-    request_data = request.get_data()
+def twitter_signature(request_data):
+    """
+    The signature Twitter sends in X-Twitter-Webhooks-Signature for a webhook body
+    """
     validation = hmac.new(
         key=bytes(key, 'utf-8'),
         msg=request_data,
@@ -525,15 +464,48 @@ def twitter_event_received():
     )
 
     digested = base64.b64encode(validation.digest())
-    compare_auth = 'sha256=' + format(str(digested)[2:-1])
+    return 'sha256=' + format(str(digested)[2:-1])
+
+
+def twitter_jobs(request_json):
+    """
+    The jobs to queue for a Twitter webhook delivery, as (job_type, payload) pairs.  Twitter can batch several events
+    into one delivery, so every event is queued.  DMs carry their sender's profile from the delivery's users map, and
+    the follows are sent as one job.
+    """
+    jobs = []
+    users = request_json.get('users', {})
+    for dm_event in request_json.get('direct_message_events', []):
+        sender_id = dm_event.get('message_create', {}).get('sender_id')
+        if sender_id == BOT_ID_TWITTER:
+            continue
+        if sender_id in users:
+            dm_event = dict(dm_event, sender=users[sender_id])
+        jobs.append(('twitter_dm', dm_event))
+
+    for tweet_event in request_json.get('tweet_create_events', []):
+        jobs.append(('twitter_tweet', tweet_event))
+
+    follow_events = request_json.get('follow_events', [])
+    if follow_events:
+        jobs.append(('twitter_follows', follow_events))
+
+    return jobs
+
+
+@app.route(TWITTER_URI, methods=["POST"])
+def twitter_event_received():
+    request_json = request.get_json()
+    auth_header = request.headers.get('X-Twitter-Webhooks-Signature')
+    compare_auth = twitter_signature(request.get_data())
     try:
-        logging.info("hash comparison: {}".format(hmac.compare_digest(auth_header, compare_auth)))
+        logging.info("hash comparison: %s", hmac.compare_digest(auth_header, compare_auth))
     except Exception as e:
         if request.headers.getlist("X-Forwarded-For"):
             ip = request.headers.getlist("X-Forwarded-For")[0]
         else:
             ip = request.remote_addr
-        logging.info("auth header not provided, probable malicious access attempt from IP: {}".format(ip))
+        logging.info("auth header not provided, probable malicious access attempt from IP: %s", ip)
         return 'You are not allowed to access this webhook.', HTTPStatus.BAD_REQUEST
 
     if not hmac.compare_digest(auth_header, compare_auth):
@@ -541,113 +513,17 @@ def twitter_event_received():
             ip = request.headers.getlist("X-Forwarded-For")[0]
         else:
             ip = request.remote_addr
-        logging.info("auth header not provided, probable malicious access attempt from IP: {}".format(ip))
+        logging.info("auth header not provided, probable malicious access attempt from IP: %s", ip)
         return 'You are not allowed to access this webhook.', HTTPStatus.BAD_REQUEST
 
-    if 'direct_message_events' in request_json.keys():
-        """
-        User sent a DM to the bot.  Parse the DM, see if there is an action provided and perform it.
-        If no action is provided, reply with an error.
-        Each action spawns a child process that will handle the requested action and terminate after completion.
-        """
-        # DM received, process that
-        dm_object = request_json['direct_message_events'][0]
-        message_object = request_json['direct_message_events'][0].get('message_create', {})
-
-        message['sender_id'] = message_object.get('sender_id')
-
-        if message['sender_id'] == BOT_ID_TWITTER:
-            logging.info("Message from bot ignored.")
-            return '', HTTPStatus.OK
-
-        user_info = api.get_user(message['sender_id'])
-        message['sender_screen_name'] = user_info.screen_name
-        message['dm_id'] = dm_object.get('id')
-        message['text'] = message_object.get('message_data', {}).get('text')
-        message['dm_array'] = message['text'].split(" ")
-        message['dm_action'] = message['dm_array'][0].lower()
-
-        logging.info("Processing direct message.")
-
-        # Update DB with new DM
-        dm_insert_call = ("INSERT INTO dm_list (dm_id, processed, sender_id, dm_text) "
-                          "VALUES (%s, 0, %s, %s)")
-        dm_insert_values = [message['dm_id'], message['sender_id'], message['text']]
-        err = modules.db.set_db_data(dm_insert_call, dm_insert_values)
-        if err is not None:
-            return 'ok'
-
-        logging.info("{}: action identified: {}".format(datetime.now(), message['dm_action']))
-        # Check for action on DM
-        modules.orchestration.parse_action(message)
-
-        return '', HTTPStatus.OK
-
-    elif 'tweet_create_events' in request_json.keys():
-        """
-        A tweet was received.  The bot will parse the tweet, see if there are any tips and process them.
-        Error handling will cover if the sender doesn't have an account, doesn't have enough to cover the tips,
-        sent to an invalid username, didn't send an amount to tip or didn't send a !tip command.
-        """
-
-        tweet_object = request_json['tweet_create_events'][0]
-
-        message = modules.social.set_message_info(tweet_object, message)
-        if message['id'] is None:
-            return '', HTTPStatus.OK
-
-        message = modules.social.check_message_action(message)
-        if message['action'] is None:
-            logging.info("{}: Mention of nano tip bot without a !tip command.".format(datetime.now()))
-            return '', HTTPStatus.OK
-
-        message = modules.social.validate_tip_amount(message)
-        if message['tip_amount'] <= 0:
-            return '', HTTPStatus.OK
-
-        if message['action'] != -1 and str(message['sender_id']) != str(BOT_ID_TWITTER):
-            new_pid = os.fork()
-            if new_pid == 0:
-                try:
-                    bot_status = config.get('webhooks', 'bot_status')
-                    if bot_status == 'maintenance':
-                        modules.social.send_dm(message['sender_id'],
-                                               "The tip bot is in maintenance.  Check @NanoTipBot on Twitter for more "
-                                               "information.",
-                                               message['system'])
-                    else:
-                        api.create_favorite(message['id'])
-                        modules.orchestration.tip_process(message, users_to_tip, request_json)
-                except Exception as e:
-                    logging.info("Exception: {}".format(e))
-                    raise e
-
-                os._exit(0)
-            else:
-                return '', HTTPStatus.OK
-
-        elif str(message['sender_id']) == str(BOT_ID_TWITTER):
-            logging.info("{}: TipBot sent a message.".format(datetime.now()))
-
-        return '', HTTPStatus.OK
-
-    elif 'follow_events' in request_json.keys():
-        """
-        New user followed the bot.  Send a welcome message.
-        """
-        logging.info("{}: New user followed, sending help message.".format(datetime.now()))
-        request_json = request.get_json()
-        follow_object = request_json['follow_events'][0]
-        follow_source = follow_object.get('source', {})
-        message['sender_id'] = follow_source.get('id')
-
-        modules.orchestration.help_process(message)
-
-        return '', HTTPStatus.OK
+    # Each event is queued for the job workers, the webhook only acknowledges it.  Under load, admission control may
+    # defer or shed the job, but the delivery is still acknowledged.
+    try:
+        modules.jobs.enqueue_batch(twitter_jobs(request_json))
+    except modules.jobs.QueueFull:
+        return '', HTTPStatus.SERVICE_UNAVAILABLE
 
-    else:
-        # Event type not supported
-        return '', HTTPStatus.OK
+    return '', HTTPStatus.OK
 
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# DEPENDENCIES =========================================
+from multiprocessing import Process
+from threading import Thread
+
+import logging
+import time
+
+import modules.confirmations
+import modules.currency
+import modules.jobs
+import modules.logs
+import modules.node
+import modules.papertips
+
+# CONFIG CONSTANTS =====================================
+SUPERVISE_INTERVAL = 5
+SWEEP_INTERVAL = 60
+
+# Set Log File
+modules.logs.setup('webhooks.log')
+
+
+def run_worker(lane):
+    # Threads don't survive the fork, so each worker starts its own node health checks
+    modules.node.rpc.start_health_checks()
+    modules.currency.load_signing_keys()
+    # Lanes with more than one thread per worker share the process, e.g. the outbound rate limits
+    for index in range(modules.jobs.LANES[lane].get('threads', 1) - 1):
+        Thread(target=modules.jobs.work_loop, args=(lane,), name='job-{}-{}'.format(lane, index), daemon=True).start()
+    modules.jobs.work_loop(lane)
+
+
+def start_worker(lane, index):
+    worker = Process(target=run_worker, args=(lane,), name='job-worker-{}-{}'.format(lane, index), daemon=True)
+    worker.start()
+    logging.info("Started %s job worker %s with pid %s", lane, index, worker.pid)
+
+    return worker
+
+
+def main():
+    # Keep a fixed pool of workers for each lane consuming the jobs table, replacing any that exit
+    workers = {(lane, index): start_worker(lane, index)
+               for lane in modules.jobs.LANES for index in range(modules.jobs.LANES[lane]['workers'])}
+    # Receive incoming blocks as the node confirms them, if a node websocket is configured
+    modules.confirmations.start_subscription()
+    last_sweep = 0
+    while True:
+        for (lane, index), worker in workers.items():
+            if not worker.is_alive():
+                logging.info("%s job worker %s exited with code %s, restarting", lane, index, worker.exitcode)
+                worker.join()
+                workers[(lane, index)] = start_worker(lane, index)
+
+        if time.time() - last_sweep > SWEEP_INTERVAL:
+            try:
+                modules.jobs.sweep_jobs()
+            except Exception as e:
+                logging.info("Error sweeping jobs: %s", e)
+            try:
+                modules.papertips.return_expired_tips()
+            except Exception as e:
+                logging.info("Error returning expired paper tips: %s", e)
+            last_sweep = time.time()
+
+        time.sleep(SUPERVISE_INTERVAL)
+
+
+# Only run as a script, so importing it, e.g. to time its imports, doesn't start the supervisor
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,18 @@
-from webhooks import app
+import modules.registry
+
+# server_mode picks the app served from here: wsgi (default) for the Flask app with worker.py processing jobs, or asgi
+# for the asyncio app, e.g. uvicorn wsgi:app
+config = modules.registry.config
+SERVER_MODE = config.get('webhooks', 'server_mode', fallback='wsgi')
+
+if SERVER_MODE == 'asgi':
+    from asgi import app
+else:
+    from webhooks import app
 
 if __name__ == "__main__":
-    app.run()
+    if SERVER_MODE == 'asgi':
+        import uvicorn
+        uvicorn.run(app, host='0.0.0.0')
+    else:
+        app.run()